@@ -0,0 +1,123 @@
+"""
+Benchmark the streaming volume_csv_month_clean_sep against the split/join pipeline it replaced.
+
+Reports peak traced memory, the part of it spent on intermediate copies, and run time
+for a synthetic report in the new OCC format. Run from the occ-daily-volume directory:
+
+    python benchmarks/bench_clean_sep.py [--rows N] [--repeat N]
+"""
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import occ
+
+
+def legacy_clean_sep(csv_data: str) -> dict:
+    """
+    The replaced implementation, kept here only as the benchmark baseline
+    """
+    bad_lines = ["YTD", "Avg"]
+    csv_data = csv_data.replace(",\r\n", "\r\n")
+    csv_list = csv_data.split("\r\n")
+    if "Daily OCC Contract Volume" in csv_list[0]:
+        date_str = csv_list[0].split("-")[-1].strip()
+        report_date = datetime.strptime(date_str, "%B %Y").date()
+    else:
+        report_date = datetime.strptime(csv_list[1].split(": ")[1].split(",")[0], "%m/%d/%Y").date()
+    bad_lines.append(report_date.strftime("%b"))
+    filtered_lines = []
+    in_section = False
+    for line in csv_list:
+        if "Daily Volume by Exchange" in line or "Daily OCC Contract Volume" in line:
+            in_section = True
+            continue
+        if "Futures and Options on Futures" in line or "Daily Futures Contract Volume" in line:
+            in_section = True
+            filtered_lines.append('')
+            continue
+        if in_section:
+            if line.strip() == '' or line.strip() == ',,,' or line.strip() == ',':
+                continue
+            if any(b in line for b in bad_lines):
+                continue
+            if "Report Date" in line:
+                continue
+            filtered_lines.append(line)
+    csv_split = "\n".join(filtered_lines).split("\n\n")
+    return {
+        "contracts": csv_split[0],
+        "contracts_headers": csv_split[0].split("\n")[0].split(","),
+        "futures": csv_split[1],
+        "futures_headers": csv_split[1].split("\n")[1].split(","),
+    }
+
+
+def make_report(rows: int) -> str:
+    """
+    Build a synthetic report in the new OCC format with the given number of daily rows
+    """
+    start = date(2025, 12, 31)
+    lines = [
+        "Daily OCC Contract Volume - December 2025",
+        "Date,Equity,Index/Others,Debt,Futures,OCC Total",
+    ]
+    for i in range(rows):
+        day = (start - timedelta(days=i)).strftime("%m/%d/%Y")
+        lines.append(f'{day},"45,727,373","5,185,170","0","123,957","51,036,500",')
+    lines += [
+        'Dec Total,"1,181,470,562","113,033,687","0","3,923,237","1,298,427,486",',
+        'Dec Avg,"53,703,207","5,137,895","0","178,329","59,019,431",',
+        'YTD Total.,"13,949,423,944","1,257,706,797","0","56,740,599","15,263,871,340",',
+        "",
+        "",
+        "Daily Futures Contract Volume -December 2025",
+        "Date,Equity,Index/Others,OOF,OCC Total",
+    ]
+    for i in range(rows):
+        day = (start - timedelta(days=i)).strftime("%m/%d/%Y")
+        lines.append(f'{day},"0","123,957","0","123,957",')
+    lines.append('Dec Total,"0","3,922,362","875","3,923,237",')
+    return "\r\n".join(lines) + "\r\n"
+
+
+def measure(func, report: str, repeat: int) -> tuple:
+    """
+    Return (peak bytes, retained bytes, seconds per call) for func(report).
+    Peak minus retained is what the call allocated for intermediate copies.
+    """
+    func(report)
+    tracemalloc.start()
+    result = func(report)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    seconds = timeit.timeit(lambda: func(report), number=repeat) / repeat
+    return peak, retained, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark volume_csv_month_clean_sep")
+    parser.add_argument("--rows", type=int, default=23, help="daily rows per table")
+    parser.add_argument("--repeat", type=int, default=2000, help="timing repetitions")
+    args = parser.parse_args()
+
+    report = make_report(args.rows)
+    legacy, streaming = legacy_clean_sep(report), occ.volume_csv_month_clean_sep(report)
+    assert legacy["contracts"] == streaming["contracts"]
+    assert legacy["futures"] == streaming["futures"]
+
+    print(f"report: {len(report):,} chars, {args.rows} rows per table")
+    print(f"{'implementation':<12} {'peak bytes':>12} {'intermediate':>12} {'us/call':>10}")
+    for name, func in (("legacy", legacy_clean_sep), ("streaming", occ.volume_csv_month_clean_sep)):
+        peak, retained, seconds = measure(func, report, args.repeat)
+        print(f"{name:<12} {peak:>12,} {peak - retained:>12,} {seconds * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
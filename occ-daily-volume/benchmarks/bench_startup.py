@@ -0,0 +1,91 @@
+"""
+Benchmark CLI startup of a read-only top N query on the stdlib fast path against the full
+pandas code path.
+
+Runs volume-top-n.py in fresh interpreters under -X importtime and reports wall time,
+total import time and the heaviest top-level imports of each path. The query runs on a
+migrated copy of the database, so the bundled file is left untouched. Run from the
+occ-daily-volume directory:
+
+    python benchmarks/bench_startup.py [--database FILE] [--repeat N] [-- CLI ARGS]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+CLI = os.path.join(SCRIPT_DIR, "volume-top-n.py")
+# Runs the CLI with the fast path disabled, as the baseline
+FULL_PATH = (
+    "import runpy, sys; sys.path.insert(0, {root!r}); import common.fastpath; "
+    "common.fastpath.query_top_n = lambda *args, **kwargs: None; "
+    "sys.argv = sys.argv[1:]; runpy.run_path(sys.argv[0], run_name='__main__')"
+)
+
+
+def run(command: list) -> tuple:
+    """
+    Return (seconds, stdout, stderr) of one run of command
+    """
+    started = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True, check=True, cwd=SCRIPT_DIR)
+    return time.perf_counter() - started, result.stdout, result.stderr
+
+
+def import_times(stderr: str) -> tuple:
+    """
+    Return (total import microseconds, {top-level module: cumulative microseconds}) from
+    the -X importtime report
+    """
+    total, top_level = 0, {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        total += int(self_us)
+        if not name.startswith("  "):
+            top_level[name.strip()] = int(cumulative_us)
+    return total, top_level
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CLI startup of a read-only query")
+    parser.add_argument(
+        "--database",
+        default=os.path.join(SCRIPT_DIR, "data", "volume-top-n.sqlite"),
+        help="database to copy and query",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="runs per path")
+    parser.add_argument("cli_args", nargs="*", default=["-n", "10"], help="query arguments")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database = os.path.join(tmpdir, "volume-top-n.sqlite")
+        shutil.copyfile(args.database, database)
+        query = ["-D", database, *args.cli_args]
+        paths = {
+            "fast": [sys.executable, "-X", "importtime", CLI, *query],
+            "full": [sys.executable, "-X", "importtime", "-c", FULL_PATH.format(root=SCRIPT_DIR), CLI, *query],
+        }
+        # The first full run migrates the copy, so both paths then answer the same query
+        outputs = {name: run(command)[1] for name, command in reversed(paths.items())}
+        assert outputs["fast"] == outputs["full"], "fast and full paths printed different tables"
+
+        print(f"query: volume-top-n.py {' '.join(args.cli_args)}, best of {args.repeat} runs")
+        print(f"{'path':<6} {'wall ms':>9} {'import ms':>10}  heaviest imports")
+        for name, command in paths.items():
+            runs = [run(command) for _ in range(args.repeat)]
+            seconds = min(r[0] for r in runs)
+            totals = [import_times(r[2]) for r in runs]
+            total, top_level = min(totals, key=lambda t: t[0])
+            heaviest = sorted(top_level.items(), key=lambda item: -item[1])[:3]
+            summary = ", ".join(f"{module} {us / 1000:.0f}" for module, us in heaviest)
+            print(f"{name:<6} {seconds * 1000:>9.0f} {total / 1000:>10.0f}  {summary}")
+
+
+if __name__ == "__main__":
+    main()
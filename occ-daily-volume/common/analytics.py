@@ -0,0 +1,190 @@
+"""
+Volume spike analytics: rank days by how unusual they were rather than by raw volume
+
+Rolling statistics are computed from prefix sums of a column (running count, sum and
+sum of squares), so the mean and standard deviation of any trailing window are two
+subtractions per day. The prefix sums do not depend on the window length and are cached
+next to a snapshot, so repeated queries only redo the subtractions.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+import common.dataframe
+from common.schema import DEFAULT_WINDOW, SPIKE_METRICS
+
+logger = logging.getLogger(__name__)
+
+# Column holding each metric's score
+SPIKE_COLUMNS = {"zscore": "Z-Score", "ratio": "Ratio", "percentile": "Year Percentile"}
+
+
+def rolling_state(values) -> np.ndarray:
+    """
+    Prefix count, sum and sum of squares of the non-missing values
+
+    :param values: column values, oldest first
+    :return: array of shape (3, len(values) + 1) whose column k covers the first k values
+    :rtype: np.ndarray
+    """
+    values = np.asarray(values, dtype="float64")
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0.0)
+    state = np.zeros((3, len(values) + 1))
+    np.cumsum(present, out=state[0, 1:])
+    np.cumsum(filled, out=state[1, 1:])
+    np.cumsum(filled * filled, out=state[2, 1:])
+    return state
+
+
+def trailing_stats(state: np.ndarray, window: int, lo: int = 0, hi: int = None) -> tuple:
+    """
+    Mean and sample standard deviation of the window days before each day, excluding
+    the day itself. Days with less than a full window of history get NaN.
+
+    :param state: prefix sums from rolling_state
+    :type state: np.ndarray
+    :param window: number of trailing days
+    :type window: int
+    :param lo: first day to compute
+    :type lo: int
+    :param hi: position after the last day to compute, None for the end
+    :type hi: int
+    :return: (mean, standard deviation) arrays for days lo to hi
+    :rtype: tuple
+    """
+    hi = state.shape[1] - 1 if hi is None else hi
+    end = np.arange(lo, hi)
+    begin = end - window
+    valid = begin >= 0
+    begin = np.maximum(begin, 0)
+    count, total, squares = state[:, end] - state[:, begin]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / count
+        variance = (squares - count * mean * mean) / (count - 1)
+        std = np.sqrt(np.maximum(variance, 0.0))
+    mean[~valid | (count < 2)] = np.nan
+    std[np.isnan(mean) | (std == 0)] = np.nan
+    return mean, std
+
+
+def year_percentiles(dates, values) -> np.ndarray:
+    """
+    Percentile of each value among the days of its year
+
+    :param dates: dates, oldest first
+    :param values: column values
+    :return: percentiles from 0 to 100, NaN for missing values
+    :rtype: np.ndarray
+    """
+    years = common.dataframe.date_group_keys(dates, "year")
+    ranks = pd.Series(np.asarray(values, dtype="float64")).groupby(years).rank(pct=True)
+    return ranks.to_numpy() * 100
+
+
+def spike_top_n(
+    dates,
+    values,
+    number: int,
+    metric: str = "zscore",
+    window: int = DEFAULT_WINDOW,
+    column: str = "OCC Total",
+    state: np.ndarray = None,
+    by: str = None,
+    start=None,
+    end=None,
+    last: int = None,
+) -> pd.DataFrame:
+    """
+    Days that stood out most from their history. Scores are computed for the requested
+    dates only, but against the full history before them.
+
+    :param dates: dates of the column, oldest first
+    :param values: column values
+    :param number: number of days to return, per group with by
+    :type number: int
+    :param metric: "zscore" or "ratio" against the trailing window, or "percentile" within the year
+    :type metric: str
+    :param window: number of trailing days for zscore and ratio
+    :type window: int
+    :param column: name of the column, used for the output
+    :type column: str
+    :param state: cached prefix sums of the values, None to compute them
+    :type state: np.ndarray
+    :param by: "year", "month" or "weekday" to rank within each group, None to rank overall
+    :type by: str
+    :param start: first date to rank, None for the oldest
+    :param end: last date to rank, None for the newest
+    :param last: only rank the latest days of the range, None for all of them
+    :type last: int
+    :return: top days with the column, its trailing average and the score, largest first
+    :rtype: pd.DataFrame
+    """
+    if metric not in SPIKE_METRICS:
+        raise ValueError(f"Unknown metric '{metric}', expected one of: {', '.join(SPIKE_METRICS)}")
+    if window < 2:
+        raise ValueError(f"window must be at least 2 days, not {window}")
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    values = np.asarray(values, dtype="float64")
+    lo, hi = common.dataframe.date_bounds(dates, start, end, last)
+    if metric == "percentile":
+        scores = year_percentiles(dates, values)[lo:hi]
+        average = None
+    else:
+        if state is None:
+            state = rolling_state(values)
+        average, std = trailing_stats(state, window, lo, hi)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if metric == "zscore":
+                scores = (values[lo:hi] - average) / std
+            else:
+                # A trailing window without volume has no ratio, as a flat one has no z-score
+                scores = values[lo:hi] / np.where(average == 0, np.nan, average)
+    keys = None if by is None else common.dataframe.date_group_keys(dates[lo:hi], by)
+    top = common.dataframe.top_n_positions(scores, number, keys)
+    top = top[~np.isnan(scores[top])]
+    out_df = pd.DataFrame(
+        {column: values[lo:hi][top]},
+        index=pd.DatetimeIndex(dates[lo:hi][top].astype("datetime64[ns]"), name="Date"),
+    )
+    if average is not None:
+        out_df[f"{window}-Day Average"] = average[top]
+    out_df[SPIKE_COLUMNS[metric]] = scores[top]
+    logger.debug(f"Ranked {hi - lo} days of {column} by {metric}")
+    return out_df
+
+
+def query_spikes(storage, number: int, column: str = "OCC Total", db_table: str = None, snapshot=None, **kwargs):
+    """
+    Rank days of a stored table with spike_top_n, reading the column from the snapshot
+    with its cached rolling state when one is given, otherwise from storage
+
+    :param storage: storage the table is kept in
+    :type storage: common.storage.Storage
+    :param number: number of days to return
+    :type number: int
+    :param column: column to score
+    :type column: str
+    :param db_table: table to read, defaults to the contracts table
+    :type db_table: str
+    :param snapshot: up to date snapshot of the table, None to read from storage
+    :type snapshot: common.snapshot.Snapshot
+    :param kwargs: metric, window and date window arguments of spike_top_n
+    :return: top days, largest score first
+    :rtype: pd.DataFrame
+    """
+    if snapshot is not None:
+        state = snapshot.rolling_state(column)
+        dates, values = snapshot.dates, snapshot.columns[column]
+    else:
+        column_df = storage.read_table(db_table or storage.db_table, columns=[column])
+        if column_df.empty:
+            return pd.DataFrame()
+        state = None
+        dates, values = column_df.index, column_df[column]
+    return spike_top_n(dates, values, number, column=column, state=state, **kwargs)
+
+
+if __name__ == "__main__":
+    print("This file cannot be run directly.")
@@ -0,0 +1,197 @@
+"""
+Content-addressed, compressed on-disk cache of raw monthly reports from theocc.com
+
+Responses are stored once per unique body under objects/<sha256>.gz, and each report
+month and format points at its body through a small ref file under refs/.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from collections import Counter
+from datetime import date, datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def _ref_path(cache_dir: str, req_date: date, req_format: str) -> Path:
+    """
+    Path of the ref file for a report month and format
+
+    :param cache_dir: cache directory
+    :type cache_dir: str
+    :param req_date: report month
+    :type req_date: date
+    :param req_format: report format
+    :type req_format: str
+    :return: ref file path
+    :rtype: Path
+    """
+    return Path(cache_dir) / "refs" / f"{req_date.strftime('%Y%m')}.{req_format.lower()}"
+
+
+def _object_path(cache_dir: str, digest: str) -> Path:
+    """
+    Path of the compressed object for a content digest
+
+    :param cache_dir: cache directory
+    :type cache_dir: str
+    :param digest: sha256 hex digest of the raw response
+    :type digest: str
+    :return: object file path
+    :rtype: Path
+    """
+    return Path(cache_dir) / "objects" / f"{digest}.gz"
+
+
+def _atomic_write(path: Path, data: bytes) -> None:
+    """
+    Write a file atomically so concurrent readers never see a partial file
+
+    :param path: destination path
+    :type path: Path
+    :param data: file contents
+    :type data: bytes
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def cache_put(cache_dir: str, req_date: date, req_format: str, raw_data: str) -> str:
+    """
+    Store a raw monthly report in the cache
+
+    :param cache_dir: cache directory
+    :type cache_dir: str
+    :param req_date: report month
+    :type req_date: date
+    :param req_format: report format
+    :type req_format: str
+    :param raw_data: raw response body from OCC
+    :type raw_data: str
+    :return: sha256 hex digest of the stored body
+    :rtype: str
+    """
+    raw_bytes = raw_data.encode("utf-8")
+    digest = hashlib.sha256(raw_bytes).hexdigest()
+    object_path = _object_path(cache_dir, digest)
+    if not object_path.is_file():
+        _atomic_write(object_path, gzip.compress(raw_bytes, mtime=0))
+    _atomic_write(_ref_path(cache_dir, req_date, req_format), digest.encode("ascii"))
+    logger.debug(
+        f"Cached {req_date.strftime('%B %Y')} report ({len(raw_bytes):,} bytes) as {digest[:12]}"
+    )
+    return digest
+
+
+def cache_get(cache_dir: str, req_date: date, req_format: str):
+    """
+    Read a raw monthly report from the cache
+
+    :param cache_dir: cache directory
+    :type cache_dir: str
+    :param req_date: report month
+    :type req_date: date
+    :param req_format: report format
+    :type req_format: str
+    :return: raw response body, or None if the month is not cached
+    :rtype: str
+    """
+    try:
+        digest = _ref_path(cache_dir, req_date, req_format).read_text().strip()
+        compressed = _object_path(cache_dir, digest).read_bytes()
+    except FileNotFoundError:
+        return None
+    raw_bytes = gzip.decompress(compressed)
+    if hashlib.sha256(raw_bytes).hexdigest() != digest:
+        logger.warning(f"Cached report for {req_date.strftime('%B %Y')} is corrupt, ignoring")
+        return None
+    return raw_bytes.decode("utf-8")
+
+
+def cache_months(cache_dir: str, req_format: str) -> list:
+    """
+    List the report months available in the cache
+
+    :param cache_dir: cache directory
+    :type cache_dir: str
+    :param req_format: report format
+    :type req_format: str
+    :return: cached report months, oldest first
+    :rtype: list
+    """
+    refs_dir = Path(cache_dir) / "refs"
+    if not refs_dir.is_dir():
+        return []
+    months = [
+        datetime.strptime(ref.stem, "%Y%m").date()
+        for ref in refs_dir.glob(f"*.{req_format.lower()}")
+    ]
+    return sorted(months)
+
+
+def cache_evict(cache_dir: str, max_bytes: int = None, max_age_days: float = None) -> int:
+    """
+    Evict cached reports older than max_age_days, then the least recently stored reports
+    until the compressed objects fit in max_bytes. Unreferenced objects are removed.
+
+    :param cache_dir: cache directory
+    :type cache_dir: str
+    :param max_bytes: maximum total size of cached objects, None for no limit
+    :type max_bytes: int
+    :param max_age_days: maximum age of a cached report in days, None for no limit
+    :type max_age_days: float
+    :return: number of reports evicted
+    :rtype: int
+    """
+    refs_dir = Path(cache_dir) / "refs"
+    if not refs_dir.is_dir():
+        return 0
+    # Oldest first, as (mtime, ref path, digest)
+    refs = sorted(
+        (ref.stat().st_mtime, ref, ref.read_text().strip())
+        for ref in refs_dir.iterdir()
+        if not ref.name.startswith(".")
+    )
+    ref_counts = Counter(digest for _, _, digest in refs)
+    sizes = {}
+    for digest in ref_counts:
+        object_path = _object_path(cache_dir, digest)
+        sizes[digest] = object_path.stat().st_size if object_path.is_file() else 0
+    total = sum(sizes.values())
+    cutoff = time.time() - max_age_days * 86400 if max_age_days is not None else None
+
+    evicted = 0
+    for mtime, ref, digest in refs:
+        expired = cutoff is not None and mtime < cutoff
+        oversized = max_bytes is not None and total > max_bytes
+        if not (expired or oversized):
+            break
+        ref.unlink()
+        evicted += 1
+        ref_counts[digest] -= 1
+        if ref_counts[digest] == 0:
+            total -= sizes[digest]
+
+    objects_dir = Path(cache_dir) / "objects"
+    if objects_dir.is_dir():
+        for object_path in objects_dir.glob("*.gz"):
+            if ref_counts[object_path.name[: -len(".gz")]] <= 0:
+                object_path.unlink()
+    if evicted:
+        logger.info(f"Evicted {evicted} cached reports from {cache_dir}")
+    return evicted
+
+
+if __name__ == "__main__":
+    print("This file cannot be run directly.")
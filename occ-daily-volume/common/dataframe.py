@@ -1,35 +1,221 @@
+import numpy as np
 import pandas as pd
-from tabulate import tabulate
 
+import common.schema
+import common.table
 
-def pretty_print_df(df_to_print: pd.DataFrame):
+# Pandas period codes for each aggregate granularity
+GRANULARITY_PERIODS = {"month": "M", "year": "Y"}
+
+
+def format_numbers(values, decimals: int = 0) -> np.ndarray:
+    """
+    Format numbers with thousands separators, as '{:,.0f}'.format does, for a whole column
+    at once: digits are laid out in a character grid and the separators are inserted as
+    whole grid columns rather than value by value
+
+    :param values: numbers to format
+    :param decimals: decimal places
+    :type decimals: int
+    :return: formatted numbers, 'nan' for missing values and 'inf' or '-inf' for infinities
+    :rtype: np.ndarray
+    """
+    values = np.asarray(values, dtype="float64")
+    if not len(values):
+        return np.array([], dtype=str)
+    missing = ~np.isfinite(values)
+    magnitude = np.abs(np.where(missing, 0.0, values))
+    if decimals or magnitude.max() >= 2 ** 63:
+        # printf rounding matches str.format for values halfway between decimals
+        text = np.char.mod(f"%.{decimals}f", magnitude)
+        digits, _, fraction = np.char.partition(text, ".").T
+    else:
+        # Both round whole numbers half to even
+        digits = np.rint(magnitude).astype("int64").astype(str)
+    width = max(digits.dtype.itemsize // 4, 1)
+    chars = np.char.rjust(digits, width).view("U1").reshape(len(digits), width)
+    out_width = width + (width - 1) // 3
+    out = np.full((len(digits), out_width), " ", dtype="U1")
+    for j in range(width):
+        place = width - 1 - j  # power of ten of this digit
+        position = out_width - 1 - place - place // 3
+        out[:, position] = chars[:, j]
+        if place and place % 3 == 0:
+            out[:, position + 1] = np.where(chars[:, j] != " ", ",", " ")
+    formatted = np.char.lstrip(out.view(f"U{out_width}").ravel())
+    if decimals:
+        formatted = np.char.add(np.char.add(formatted, "."), fraction)
+    formatted = np.where(np.isinf(values), "inf", formatted)
+    formatted = np.where(np.signbit(values) & ~np.isnan(values), np.char.add("-", formatted), formatted)
+    return np.where(np.isnan(values), "nan", formatted)
+
+
+def pretty_print_df(df_to_print: pd.DataFrame, date_format: str = '%Y-%m-%d', decimals: dict = None):
     """
-    Print dataframe in a pretty table format
+    Print dataframe in a pretty table format. Columns are formatted vectorized, then
+    the table is written to stdout row by row.
 
     :param df_to_print: dataframe to print
     :type df_to_print: pd.DataFrame
+    :param date_format: strftime format of the index, e.g. '%Y-%m' for monthly rows
+    :type date_format: str
+    :param decimals: decimal places of columns that are not whole numbers, e.g. scores
+    :type decimals: dict
+    """
+    decimals = decimals or {}
+    # Position number column with an empty name, then the index
+    headers = ['', df_to_print.index.name or 'index', *df_to_print.columns]
+    cells = [
+        np.arange(1, len(df_to_print) + 1).astype(str),
+        np.asarray(df_to_print.index.strftime(date_format), dtype=str),
+    ]
+    for col in df_to_print.columns:
+        values = df_to_print[col]
+        if pd.api.types.is_datetime64_any_dtype(values.dtype):
+            cells.append(values.dt.strftime('%Y-%m-%d').fillna('').to_numpy(dtype=str))
+        elif pd.api.types.is_numeric_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype):
+            cells.append(format_numbers(values.to_numpy(dtype="float64", na_value=np.nan), decimals.get(col, 0)))
+        else:
+            cells.append(values.astype(str).to_numpy(dtype=str))
+    widths = [
+        max(len(str(header)) + 2, int(np.char.str_len(column).max()) if len(column) else 0)
+        for header, column in zip(headers, cells)
+    ]
+    for line in common.table.render_table(headers, zip(*cells), widths=widths):
+        print(line)
+
+
+def df_rows(df: pd.DataFrame) -> tuple:
+    """
+    Columns and rows of a dataframe, index first, for common.output.write_rows. Each column
+    is converted to Python values at once, then the rows are zipped up one at a time.
+
+    :param df: dataframe indexed by date
+    :type df: pd.DataFrame
+    :return: (column names, iterator of rows as tuples of dates, numbers and None)
+    :rtype: tuple
+    """
+    values = [df.index.date]
+    for col in df.columns:
+        column = df[col]
+        if pd.api.types.is_datetime64_any_dtype(column.dtype):
+            column = column.dt.date
+        values.append(column.astype(object).where(column.notna(), None).tolist())
+    return [df.index.name or 'index', *df.columns], zip(*values)
+
+
+def write_arrow(df: pd.DataFrame, sink) -> None:
+    """
+    Write a dataframe, index first, as an Arrow IPC stream. Numeric and datetime columns
+    are handed to Arrow as their numpy buffers without copying.
+
+    :param df: dataframe indexed by date
+    :type df: pd.DataFrame
+    :param sink: binary stream to write to, e.g. sys.stdout.buffer
+    :raises ImportError: if pyarrow is not installed
+    """
+    try:
+        import pyarrow as pa
+    except ImportError as e:
+        raise ImportError("The arrow output format requires pyarrow: pip install pyarrow") from e
+    arrays = [pa.array(df.index.to_numpy())]
+    arrays += [pa.array(df[col].to_numpy(), from_pandas=True) for col in df.columns]
+    batch = pa.RecordBatch.from_arrays(arrays, names=[df.index.name or 'index', *map(str, df.columns)])
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+
+
+def volume_aggregate_df(daily_df: pd.DataFrame, granularity: str) -> pd.DataFrame:
+    """
+    Aggregate daily volume into months or years: the sum, mean, max and date of the max
+    of every column, and the number of trading days
+
+    :param daily_df: daily volume indexed by Date
+    :type daily_df: pd.DataFrame
+    :param granularity: "month" or "year"
+    :type granularity: str
+    :return: one row per period, indexed by the first day of the period
+    :rtype: pd.DataFrame
+    """
+    periods = daily_df.index.to_period(GRANULARITY_PERIODS[granularity]).to_timestamp()
+    grouped = daily_df.groupby(periods)
+    aggregates = {}
+    for column in daily_df.columns:
+        values = grouped[column]
+        aggregates[f"{column} Sum"] = values.sum(min_count=1)
+        aggregates[f"{column} Mean"] = values.mean()
+        aggregates[f"{column} Max"] = values.max()
+        aggregates[f"{column} Max Date"] = values.apply(
+            lambda s: s.idxmax() if s.notna().any() else pd.NaT
+        ).astype("datetime64[ns]")
+    aggregates["Trading Days"] = grouped.size()
+    aggregate_df = pd.DataFrame(aggregates)
+    aggregate_df.index.name = "Date"
+    return aggregate_df
+
+
+def date_group_keys(dates, by: str) -> np.ndarray:
+    """
+    Integer group of each date, increasing chronologically (weekdays from Monday)
+
+    :param dates: dates, as datetime64 values or a DatetimeIndex
+    :param by: "year", "month" or "weekday"
+    :type by: str
+    :return: group of each date
+    :rtype: np.ndarray
+    """
+    days = np.asarray(dates, dtype="datetime64[D]")
+    if by == "year":
+        return days.astype("datetime64[Y]").astype("int64")
+    if by == "month":
+        return days.astype("datetime64[M]").astype("int64")
+    if by == "weekday":
+        # 1970-01-01, day 0, was a Thursday
+        return (days.astype("int64") + 3) % 7
+    raise ValueError(f"Unknown grouping '{by}', expected one of: {', '.join(common.schema.GROUP_BY_SQL)}")
+
+
+def date_bounds(dates: np.ndarray, start=None, end=None, last: int = None) -> tuple:
+    """
+    Positions of the dates in a window, found by binary search on the sorted dates
+
+    :param dates: sorted datetime64[D] dates
+    :type dates: np.ndarray
+    :param start: first date, None for the oldest
+    :param end: last date, None for the newest
+    :param last: keep only the latest dates in the range, None for all
+    :type last: int
+    :return: (first position, position after the last)
+    :rtype: tuple
+    """
+    lo = 0 if start is None else int(np.searchsorted(dates, np.datetime64(start, "D"), side="left"))
+    hi = len(dates) if end is None else int(np.searchsorted(dates, np.datetime64(end, "D"), side="right"))
+    if last is not None:
+        lo = max(lo, hi - last)
+    return lo, hi
+
+
+def top_n_positions(values, number: int, keys: np.ndarray = None) -> np.ndarray:
+    """
+    Positions of the largest values, overall or within each group. A single sort on
+    (group, value) ranks every group at once; missing values rank last.
+
+    :param values: values to rank
+    :param number: number of positions to return, per group with keys
+    :type number: int
+    :param keys: group of each value, None to rank overall
+    :type keys: np.ndarray
+    :return: positions, group by group and largest first
+    :rtype: np.ndarray
     """
-    df_display = df_to_print.copy()
-    df_display.index = df_display.index.strftime('%Y-%m-%d')
-    df_display = df_display.reset_index()
-
-    # Manually format numeric columns to strings with commas
-    for col in df_display.select_dtypes(include='number').columns:
-        df_display[col] = df_display[col].apply('{:,.0f}'.format)
-
-    # Insert position number column with an empty name
-    df_display.insert(0, '', range(1, len(df_display) + 1))
-
-    print(
-        tabulate(
-            df_display,
-            headers=df_display.columns,
-            tablefmt="psql",
-            numalign="right",
-            stralign="right",
-            showindex=False
-        )
-    )
+    values = np.asarray(values, dtype="float64")
+    descending = -np.where(np.isnan(values), -np.inf, values)
+    if keys is None:
+        return np.argsort(descending, kind="stable")[: max(number, 0)]
+    order = np.lexsort((descending, keys))
+    sorted_keys = keys[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_keys, sorted_keys, side="left")
+    return order[rank < number]
 
 
 if __name__ == "__main__":
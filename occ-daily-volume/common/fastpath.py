@@ -0,0 +1,201 @@
+"""
+Read-only top N queries answered with sqlite3 and the standard library only
+
+Importing pandas, numpy and requests takes far longer than a top N query on an indexed
+SQLite table. The CLI tries this path first for plain read-only queries, and falls back
+to the full code path, which also migrates the database, for anything it cannot answer.
+"""
+import logging
+import os
+import sqlite3 as sql
+from datetime import timedelta
+from pathlib import Path
+
+import common.schema
+import common.table
+
+logger = logging.getLogger(__name__)
+
+
+def _database_path(database_conf: dict, base_dir: str, location: str = None):
+    """
+    SQLite file selected in the database section of the config file, as in
+    common.storage.storage_from_config
+
+    :param database_conf: database section of the config file
+    :type database_conf: dict
+    :param base_dir: directory relative paths are resolved against
+    :type base_dir: str
+    :param location: database file overriding the config file
+    :type location: str
+    :return: database filepath, or None if another backend is configured
+    :rtype: str
+    """
+    if database_conf.get("backend", "sqlite") != "sqlite":
+        return None
+    path = location or database_conf["sqlite"]["db_filepath"]
+    return path if os.path.isabs(path) else os.path.join(base_dir, path)
+
+
+def query_top_n(database_conf: dict, base_dir: str, location: str = None, dataset: str = "contracts", **query):
+    """
+    Run common.sqlite.db_query_top_n without pandas, if the database is up to date
+
+    :param database_conf: database section of the config file
+    :type database_conf: dict
+    :param base_dir: directory relative paths are resolved against
+    :type base_dir: str
+    :param location: database file overriding the config file
+    :type location: str
+    :param dataset: "contracts" or "futures"
+    :type dataset: str
+    :param query: number, column, granularity, by, start, end and last, see common.schema.db_top_n_query
+    :return: (column names, iterator of rows as tuples, empty if the query found no rows),
+        or None if the full code path is needed. Cached queries, see
+        common.schema.query_is_cached, are read through the query cache, and the rest
+        straight from the open cursor.
+    :rtype: tuple
+    """
+    db_filepath = _database_path(database_conf, base_dir, location)
+    sqlite_conf = database_conf.get("sqlite") or {}
+    db_table = sqlite_conf.get("db_table_futures" if dataset == "futures" else "db_table")
+    if db_filepath is None or db_table is None or not Path(db_filepath).is_file():
+        return None
+    cache_entries = sqlite_conf.get("query_cache_entries", common.schema.QUERY_CACHE_ENTRIES)
+    cached = common.schema.query_is_cached(query.get("by"), cache_entries)
+    # Only the query cache is ever written, never the volume tables
+    mode = "rw" if cached else "ro"
+    conn = sql.connect(f"{Path(db_filepath).resolve().as_uri()}?mode={mode}", uri=True)
+    streaming = False
+    try:
+        conn.execute(f"PRAGMA busy_timeout = {int((sqlite_conf.get('pragmas') or {}).get('busy_timeout', 5000))}")
+        # Tables that still need migrating or aggregating are left to the full code path
+        if not common.schema.db_table_exists(conn, db_table) or not common.schema.db_table_is_current(
+            conn, db_table, "Date"
+        ):
+            return None
+        for granularity in common.schema.AGGREGATE_SUFFIXES:
+            if not common.schema.db_table_exists(conn, common.schema.aggregate_table(db_table, granularity)):
+                return None
+        if cached:
+            result = common.schema.db_cached_top_n(conn, db_table, max_entries=cache_entries, **query)
+            if result is None:
+                return None
+            logger.debug(f"Read top {len(result[1])} rows from {db_table} without pandas")
+            return result[0], iter(result[1])
+        built = common.schema.db_top_n_query(conn, db_table, **query)
+        if built is None:
+            return None
+        cursor = conn.execute(*built)
+        first = cursor.fetchone()
+        columns = [description[0] for description in cursor.description]
+        if first is None:
+            return columns, iter(())
+        streaming = True
+    finally:
+        if not streaming:
+            conn.close()
+    logger.debug(f"Streaming top rows of {db_table} without pandas")
+    return columns, _stream_rows(conn, cursor, first)
+
+
+def _stream_rows(conn: sql.Connection, cursor: sql.Cursor, first: tuple):
+    """
+    Rows of a cursor whose first row was already fetched, closing the connection after
+    the last one
+
+    :param conn: connection the cursor belongs to
+    :type conn: sql.Connection
+    :param cursor: cursor of the top N query
+    :type cursor: sql.Cursor
+    :param first: first row of the cursor
+    :type first: tuple
+    :return: rows as tuples
+    :rtype: Iterator[tuple]
+    """
+    try:
+        yield first
+        yield from cursor
+    finally:
+        conn.close()
+
+
+def decode_rows(columns: list, rows):
+    """
+    Rows with their day numbers decoded to dates, for common.output.write_rows
+
+    :param columns: column names
+    :type columns: list
+    :param rows: rows as tuples, as returned by query_top_n
+    :return: rows as tuples
+    :rtype: Iterator[tuple]
+    """
+    dates = [c == "Date" or c.endswith(common.schema.DATE_COLUMN_SUFFIX) for c in columns]
+    for row in rows:
+        yield tuple(
+            common.schema.EPOCH_DATE + timedelta(days=v) if is_date and v is not None else v
+            for is_date, v in zip(dates, row)
+        )
+
+
+def _format_cell(column: str, value, date_format: str) -> str:
+    """
+    Format a value as common.dataframe.pretty_print_df does
+
+    :param column: column name
+    :type column: str
+    :param value: stored value
+    :param date_format: strftime format of the Date column
+    :type date_format: str
+    :return: formatted value
+    :rtype: str
+    """
+    if column == "Date" or column.endswith(common.schema.DATE_COLUMN_SUFFIX):
+        if value is None:
+            return ""
+        day = common.schema.EPOCH_DATE + timedelta(days=value)
+        return day.strftime(date_format if column == "Date" else "%Y-%m-%d")
+    return "{:,.0f}".format(float("nan") if value is None else value)
+
+
+def print_top_n(columns: list, rows, date_format: str = "%Y-%m-%d") -> None:
+    """
+    Print query_top_n results in the same table as common.dataframe.pretty_print_df.
+    Column widths are found from each column's smallest and largest value in one pass
+    over the raw rows, then the rows are formatted and printed one line at a time.
+
+    :param columns: column names
+    :type columns: list
+    :param rows: rows as tuples
+    :param date_format: strftime format of the Date column
+    :type date_format: str
+    """
+    # Only the raw values are kept, never the formatted cells
+    rows = list(rows)
+    lows, highs, missing = [None] * len(columns), [None] * len(columns), [False] * len(columns)
+    for row in rows:
+        for i, value in enumerate(row):
+            if value is None or value != value:
+                missing[i] = True
+            elif lows[i] is None:
+                lows[i] = highs[i] = value
+            elif value < lows[i]:
+                lows[i] = value
+            elif value > highs[i]:
+                highs[i] = value
+    # Formatted numbers only get longer with their magnitude, so the extremes are the widest
+    # Like tabulate, headers get at least two spaces beside them
+    widths = [max(len(str(len(rows))), 2)]
+    for i, column in enumerate(columns):
+        extremes = [v for v in (lows[i], highs[i]) if v is not None] + ([None] if missing[i] else [])
+        widths.append(max([len(column) + 2, *(len(_format_cell(column, v, date_format)) for v in extremes)]))
+    cells = (
+        [str(position), *(_format_cell(c, v, date_format) for c, v in zip(columns, row))]
+        for position, row in enumerate(rows, start=1)
+    )
+    for line in common.table.render_table(["", *columns], cells, widths=widths):
+        print(line)
+
+
+if __name__ == "__main__":
+    print("This file cannot be run directly.")
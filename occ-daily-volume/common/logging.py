@@ -3,13 +3,15 @@ import logging.config
 from datetime import datetime
 
 
-def setup_logging(name_, log_level: str = "INFO"):
+def setup_logging(name_, log_level: str = "INFO", console_stream: str = "stdout"):
     """
     Setup simple console and file logging
 
     :param name_: name of app using logging, ideally should be __name__
     :param log_level: logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)
     :type log_level: str
+    :param console_stream: "stdout" or "stderr", stderr keeps machine-readable output on stdout clean
+    :type console_stream: str
     :return:
     """
     numeric_log_level = getattr(logging, log_level.upper(), logging.INFO)
@@ -29,7 +31,7 @@ def setup_logging(name_, log_level: str = "INFO"):
                 "level": numeric_log_level,
                 "class": "logging.StreamHandler",
                 "formatter": "syslog-standard",
-                "stream": "ext://sys.stdout",
+                "stream": f"ext://sys.{console_stream}",
             },
             "file_handler": {
                 "level": numeric_log_level,
@@ -2,31 +2,239 @@
 Functions for interacting with theocc.com
 """
 import io
+import itertools
 import logging
+import random
+import threading
+import time
 from datetime import date, datetime
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlencode, urljoin
 
 import pandas as pd
 import requests
 from dateutil.relativedelta import relativedelta
+from requests.adapters import HTTPAdapter
+
+import common.cache
+import common.ratelimit
 
 logger = logging.getLogger(__name__)
 
 # HTTP request timeout in seconds
 REQUEST_TIMEOUT = 30
+# Number of keep-alive connections kept in the session pool
+POOL_MAXSIZE = 10
+# HTTP statuses that mean the server is throttled or struggling and the request may be retried
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+# Title lines that start the contracts and futures tables, in old and new report formats
+CONTRACTS_MARKERS = ("Daily Volume by Exchange", "Daily OCC Contract Volume")
+FUTURES_MARKERS = ("Futures and Options on Futures", "Daily Futures Contract Volume")
+# Tables in each monthly report
+VOLUME_SECTIONS = ("contracts", "futures")
+
+_session = None
+_session_lock = threading.Lock()
+# Cache validators from earlier fetches, keyed by request url
+_validators = {}
+_validators_lock = threading.Lock()
+# Retry policy and shared rate limiter, see configure_retries and configure_rate_limit
+_retry_policy = {"retries": 0, "backoff_base": 1.0, "backoff_max": 60.0}
+_rate_limiter = None
+
+
+class ReportUnavailableError(ValueError):
+    """
+    OCC answered that the requested report does not exist or is not public
+    """
+
+
+def configure_session(pool_maxsize: int = POOL_MAXSIZE) -> requests.Session:
+    """
+    (Re)create the shared HTTP session used for all requests to theocc.com
+
+    :param pool_maxsize: number of keep-alive connections to pool, should be at least the number of fetch workers
+    :type pool_maxsize: int
+    :return: shared session
+    :rtype: requests.Session
+    """
+    global _session
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    with _session_lock:
+        old_session, _session = _session, session
+    if old_session is not None:
+        old_session.close()
+    logger.debug(f"Created HTTP session with a pool of {pool_maxsize} connections")
+    return session
+
+
+def configure_retries(
+    retries: int = 0, backoff_base: float = 1.0, backoff_max: float = 60.0
+) -> None:
+    """
+    Set how timed out, failed and throttled (429/5xx) requests are retried.
+    Waits use exponential backoff with full jitter, or the server's Retry-After if given.
+
+    :param retries: number of retries per request, 0 disables retrying
+    :type retries: int
+    :param backoff_base: wait before the first retry in seconds, doubled per retry
+    :type backoff_base: float
+    :param backoff_max: longest wait between retries in seconds
+    :type backoff_max: float
+    """
+    _retry_policy.update(
+        retries=max(int(retries), 0),
+        backoff_base=float(backoff_base),
+        backoff_max=float(backoff_max),
+    )
+
+
+def configure_rate_limit(rate: float = None, burst: int = 1) -> None:
+    """
+    Set the request rate limit shared by all fetch workers. The limit lowers itself
+    when theocc.com throttles and recovers as requests succeed.
+
+    :param rate: maximum requests per second, None disables rate limiting
+    :type rate: float
+    :param burst: number of requests that may be made back to back
+    :type burst: int
+    """
+    global _rate_limiter
+    _rate_limiter = (
+        common.ratelimit.AdaptiveRateLimiter(rate, burst=burst) if rate else None
+    )
+
+
+def get_session() -> requests.Session:
+    """
+    Get the shared HTTP session, creating it on first use
+
+    :return: shared session
+    :rtype: requests.Session
+    """
+    if _session is None:
+        return configure_session()
+    return _session
+
+
+def get_validators() -> dict:
+    """
+    Get a copy of the cache validators recorded from earlier fetches
+
+    :return: validators keyed by request url
+    :rtype: dict
+    """
+    with _validators_lock:
+        return {url: dict(v) for url, v in _validators.items()}
+
+
+def set_validators(validators: dict) -> None:
+    """
+    Replace the known cache validators, e.g. with ones persisted by an earlier run
+
+    :param validators: validators keyed by request url, as returned by get_validators
+    :type validators: dict
+    """
+    with _validators_lock:
+        _validators.clear()
+        _validators.update({url: dict(v) for url, v in validators.items()})
+
+
+def _retry_delay(attempt: int, response=None) -> float:
+    """
+    Seconds to wait before retrying a request
+
+    :param attempt: number of retries already made
+    :type attempt: int
+    :param response: throttled response, whose Retry-After header is honored if present
+    :return: seconds to wait
+    :rtype: float
+    """
+    backoff_max = _retry_policy["backoff_max"]
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), backoff_max)
+        except ValueError:
+            pass
+        try:
+            delay = (parsedate_to_datetime(retry_after) - datetime.now().astimezone()).total_seconds()
+            return min(max(delay, 0.0), backoff_max)
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(backoff_max, _retry_policy["backoff_base"] * 2**attempt))
+
+
+def _get_with_retries(full_url: str, headers: dict, baseurl: str) -> requests.Response:
+    """
+    GET a url through the shared session and rate limiter, retrying per the retry policy
+
+    :param full_url: url including query string
+    :type full_url: str
+    :param headers: request headers
+    :type headers: dict
+    :param baseurl: base url for error messages
+    :type baseurl: str
+    :return: response, which may still carry an error status once retries are exhausted
+    :rtype: requests.Response
+    """
+    retries = _retry_policy["retries"]
+    attempt = 0
+    while True:
+        if _rate_limiter is not None:
+            _rate_limiter.acquire()
+        try:
+            r = get_session().get(full_url, headers=headers, timeout=REQUEST_TIMEOUT)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            if attempt >= retries:
+                if isinstance(e, requests.exceptions.Timeout):
+                    raise TimeoutError(f"Request timed out after {REQUEST_TIMEOUT} seconds")
+                raise ConnectionError(f"Failed to fetch data from {baseurl}: {e}")
+            reason = str(e) or type(e).__name__
+            delay = _retry_delay(attempt)
+        except requests.exceptions.RequestException as e:
+            raise ConnectionError(f"Failed to fetch data from {baseurl}: {e}")
+        else:
+            if r.status_code not in RETRY_STATUS_CODES:
+                if _rate_limiter is not None:
+                    _rate_limiter.on_success()
+                return r
+            if _rate_limiter is not None:
+                _rate_limiter.on_throttle()
+            if attempt >= retries:
+                return r
+            reason = f"HTTP {r.status_code}"
+            delay = _retry_delay(attempt, r)
+        attempt += 1
+        logger.warning(
+            f"Request to {baseurl} failed ({reason}), retry {attempt} of {retries} in {delay:.1f}s"
+        )
+        time.sleep(delay)
 
 
-def volume_csv_month_get(req_url: str, req_date: date, req_format: str) -> str:
+def volume_csv_month_get(
+    req_url: str, req_date: date, req_format: str, conditional: bool = False
+):
     """
     Get volume data from theocc.com for the given month.
 
+    When conditional is set, validators from an earlier fetch of the same report are sent
+    (If-None-Match / If-Modified-Since) and None is returned if the report is unchanged.
+    Requests are retried and rate limited as set by configure_retries and configure_rate_limit.
+
     :param req_url: url for the request
     :type req_url: str
     :param req_date: date to request, must include year, month, and day
     :type req_date: date
     :param req_format: return format of data (only CSV is supported)
     :type req_format: str
-    :return: volume data
+    :param conditional: only return data if it changed since the last fetch
+    :type conditional: bool
+    :return: volume data, or None if unchanged
     :rtype: str
     """
     if not isinstance(req_date, date):
@@ -40,95 +248,164 @@ def volume_csv_month_get(req_url: str, req_date: date, req_format: str) -> str:
     logger.debug(
         f"Retrieving monthly volume report for {req_date.strftime('%B %Y')}" f" from {baseurl}"
     )
+    full_url = f"{req_url}?{urlencode(req_params)}"
+    headers = {}
+    if conditional:
+        with _validators_lock:
+            known = _validators.get(full_url, {})
+        if "ETag" in known:
+            headers["If-None-Match"] = known["ETag"]
+        if "Last-Modified" in known:
+            headers["If-Modified-Since"] = known["Last-Modified"]
+    r = _get_with_retries(full_url, headers, baseurl)
+    if r.status_code == 304:
+        logger.debug(f"Report for {req_date.strftime('%B %Y')} is unchanged")
+        return None
     try:
-        r = requests.get(f"{req_url}?{urlencode(req_params)}", timeout=REQUEST_TIMEOUT)
         r.raise_for_status()
-    except requests.exceptions.Timeout:
-        raise TimeoutError(f"Request timed out after {REQUEST_TIMEOUT} seconds")
     except requests.exceptions.RequestException as e:
         raise ConnectionError(f"Failed to fetch data from {baseurl}: {e}")
 
     if "Invalid report Date" in r.text:
-        raise ValueError("given req_date returned invalid response")
+        raise ReportUnavailableError("given req_date returned invalid response")
     if "Report is not available" in r.text:
-        raise ValueError("given req_date is not publically available")
+        raise ReportUnavailableError("given req_date is not publically available")
+    if r.status_code == 200:
+        received = {
+            k: r.headers[k] for k in ("ETag", "Last-Modified") if k in r.headers
+        }
+        if received:
+            with _validators_lock:
+                _validators[full_url] = received
     return r.text
 
 
-def volume_csv_month_clean_sep(csv_data: str) -> dict:
+def _iter_lines(csv_data):
+    """
+    Iterate over report lines without line endings or the trailing comma OCC adds to some rows.
+    Strings are sliced in place, so only the lines themselves are allocated.
+
+    :param csv_data: CSV output from OCC, as a string or text stream
+    :type csv_data: str | io.TextIOBase
+    :return: generator of lines
+    """
+    if not isinstance(csv_data, str):
+        for raw in csv_data:
+            line = raw.rstrip("\r\n")
+            yield line[:-1] if line.endswith(",") else line
+        return
+    pos, length = 0, len(csv_data)
+    while pos < length:
+        end = csv_data.find("\n", pos)
+        if end == -1:
+            end = length
+        stop = end
+        if stop > pos and csv_data[stop - 1] == "\r":
+            stop -= 1
+        if stop > pos and csv_data[stop - 1] == ",":
+            stop -= 1
+        yield csv_data[pos:stop]
+        pos = end + 1
+
+
+def _iter_table_rows(csv_lines):
+    """
+    Single-pass state machine over the lines of an OCC report, yielding the header and
+    data rows of each table and dropping titles, blank lines and summary rows.
+
+    :param csv_lines: iterable of report lines, without line endings
+    :return: generator of (section, line) tuples, section is "contracts" or "futures"
+    """
+    section = None
+    header_seen = False
+    for line in csv_lines:
+        # Leading empty cells are padding, data rows start with a date
+        first_cell = line.lstrip(",")
+        if header_seen and first_cell.lstrip('"')[:1].isdigit():
+            yield section, line
+            continue
+        if not first_cell.strip():
+            continue
+        if any(m in line for m in CONTRACTS_MARKERS):
+            section, header_seen = "contracts", False
+        elif any(m in line for m in FUTURES_MARKERS):
+            section, header_seen = "futures", False
+        # Anything else after the header is a summary row (totals, averages)
+        elif section is not None and not header_seen and "Report Date" not in line:
+            header_seen = True
+            yield section, line
+
+
+def _parse_report_date(first_line: str, second_line: str) -> date:
+    """
+    Parse the report month from the first two lines of an OCC report
+
+    :param first_line: first line of the report
+    :type first_line: str
+    :param second_line: second line of the report
+    :type second_line: str
+    :return: report date
+    :rtype: date
+    """
+    # Check for new format header
+    if "Daily OCC Contract Volume" in first_line:
+        date_str = first_line.split("-")[-1].strip()
+        return datetime.strptime(date_str, "%B %Y").date()
+    try:
+        return datetime.strptime(second_line.split(": ")[1].split(",")[0], "%m/%d/%Y").date()
+    except (IndexError, ValueError):
+        raise ValueError("Could not parse Report Date from CSV")
+
+
+def volume_csv_month_clean_sep(csv_data) -> dict:
     """
     Clean CSV data to be loaded into pandas, splitting out the headers and tables (since we actually get two CSVs from OCC)
 
-    :param csv_data: CSV output from OCC
-    :type csv_data: str
+    The report is read line by line in a single pass, so no intermediate copies of the whole response are made.
+
+    :param csv_data: CSV output from OCC, as a string or text stream
+    :type csv_data: str | io.TextIOBase
     :return: cleaned and sorted volume information
     :rtype: dict
     """
-    csv_clean = []
-    volume_dict = {}
-    bad_lines = ["YTD", "Avg"]
-    csv_data = csv_data.replace(",\r\n", "\r\n")
-    csv_list = csv_data.split("\r\n")
+    csv_lines = _iter_lines(csv_data)
+    first_lines = list(itertools.islice(csv_lines, 2))
+    first_lines += [""] * (2 - len(first_lines))
+    report_date = _parse_report_date(*first_lines)
 
-    # Check for new format header
-    if "Daily OCC Contract Volume" in csv_list[0]:
-        date_str = csv_list[0].split("-")[-1].strip()
-        report_date = datetime.strptime(date_str, "%B %Y").date()
-    else:
-        try:
-            report_date = datetime.strptime(csv_list[1].split(": ")[1].split(",")[0], "%m/%d/%Y").date()
-        except (IndexError, ValueError):
-            raise ValueError("Could not parse Report Date from CSV")
-
-    # Append the month short name to bad_lines
-    bad_lines.append(report_date.strftime("%b"))
-    # Filter out lines that are not part of the actual data tables or are summary rows
-    # Keep the main headers and data rows, remove empty lines and summary lines
-    filtered_lines = []
-    in_contracts_section = False
-    in_futures_section = False
-
-    for line in csv_list:
-        if "Daily Volume by Exchange" in line or "Daily OCC Contract Volume" in line:
-            in_contracts_section = True
-            in_futures_section = False
-            continue
-        if "Futures and Options on Futures" in line or "Daily Futures Contract Volume" in line:
-            in_contracts_section = False
-            in_futures_section = True
-            filtered_lines.append('') # Add a blank line to act as a separator for csv_split
-            continue
+    rows = {"contracts": [], "futures": []}
+    for section, line in _iter_table_rows(itertools.chain(first_lines, csv_lines)):
+        rows[section].append(line)
 
-        if in_contracts_section or in_futures_section:
-            if line.strip() == '' or line.strip() == ',,,' or line.strip() == ',': # Remove empty lines or lines with just commas
-                continue
-            if any(b in line for b in bad_lines): # Remove summary lines
-                continue
-            if "Report Date" in line: # Remove report date line
-                continue
-            filtered_lines.append(line)
-
-    csv_clean = filtered_lines
-    csv_split = "\n".join(csv_clean).split("\n\n")
     volume_dict = {
-        "contracts": csv_split[0],
-        "contracts_headers": csv_split[0].split("\n")[0].split(","),
-        "futures": csv_split[1],
-        "futures_headers": csv_split[1].split("\n")[1].split(","),
+        "contracts": "\n".join(rows["contracts"]),
+        "contracts_headers": rows["contracts"][0].split(",") if rows["contracts"] else [],
+        "futures": "\n".join(rows["futures"]),
+        "futures_headers": rows["futures"][0].split(",") if rows["futures"] else [],
     }
     logger.debug(f"Successfully cleaned data for {report_date.strftime('%B %Y')}")
     return volume_dict
 
 
-def volume_df_create(vol_dict: dict, merge_df: pd.DataFrame = None) -> pd.DataFrame:
+def volume_df_create(
+    vol_dict: dict, merge_df: pd.DataFrame = None, section: str = "contracts"
+) -> pd.DataFrame:
     """
     Create dataframe from cleaned CSV dict. Optionally merge the data into one dataframe.
 
     :param vol_dict: output from volume_csv_month_clean_sep
     :type vol_dict: dict
+    :param merge_df: dataframe to merge the new data into
+    :type merge_df: pd.DataFrame
+    :param section: table to load, "contracts" or "futures"
+    :type section: str
+    :return: volume data, or None if the report has no such table
+    :rtype: pd.DataFrame
     """
+    if not vol_dict.get(section):
+        return merge_df
     vol_df = pd.read_csv(
-        io.StringIO(vol_dict["contracts"]),
+        io.StringIO(vol_dict[section]),
         thousands=",",
         index_col="Date",
         parse_dates=["Date"],
@@ -138,9 +415,30 @@ def volume_df_create(vol_dict: dict, merge_df: pd.DataFrame = None) -> pd.DataFr
     return vol_df
 
 
-def get_volume_by_month_to_df(req_url: str, req_date: date, req_format: str):
+def volume_dfs_create(vol_dict: dict) -> dict:
     """
-    Helper function to get monthly volume into dataframe.
+    Create the contracts and futures dataframes from one cleaned CSV dict
+
+    :param vol_dict: output from volume_csv_month_clean_sep
+    :type vol_dict: dict
+    :return: dataframes keyed by "contracts" and "futures", futures is None if the report has none
+    :rtype: dict
+    """
+    volume_dfs = {section: volume_df_create(vol_dict, section=section) for section in VOLUME_SECTIONS}
+    if volume_dfs["contracts"] is None:
+        raise ValueError("Report has no contracts table")
+    return volume_dfs
+
+
+def get_volume_by_month_to_dfs(
+    req_url: str,
+    req_date: date,
+    req_format: str,
+    conditional: bool = False,
+    cache_dir: str = None,
+):
+    """
+    Helper function to get monthly contracts and futures volume into dataframes from one request.
 
     :param req_url: url for the request
     :type req_url: str
@@ -148,12 +446,75 @@ def get_volume_by_month_to_df(req_url: str, req_date: date, req_format: str):
     :type req_date: date
     :param req_format: return format of data (only CSV is supported)
     :type req_format: str
-    :return: volume data
-    :rtype: str
+    :param conditional: only return data if it changed since the last fetch
+    :type conditional: bool
+    :param cache_dir: directory to keep a copy of the raw response in, if set
+    :type cache_dir: str
+    :return: dataframes keyed by "contracts" and "futures", or None if unchanged
+    :rtype: dict
     """
     csv_raw = volume_csv_month_get(
-        req_url=req_url, req_date=req_date, req_format=req_format
+        req_url=req_url, req_date=req_date, req_format=req_format, conditional=conditional
     )
+    if csv_raw is None:
+        return None
+    if cache_dir:
+        common.cache.cache_put(cache_dir, req_date, req_format, csv_raw)
+    volume_dict = volume_csv_month_clean_sep(csv_raw)
+    return volume_dfs_create(volume_dict)
+
+
+def get_volume_by_month_to_df(
+    req_url: str,
+    req_date: date,
+    req_format: str,
+    conditional: bool = False,
+    cache_dir: str = None,
+):
+    """
+    Helper function to get monthly volume into dataframe.
+
+    :param req_url: url for the request
+    :type req_url: str
+    :param req_date: date to request, must include year, month, and day
+    :type req_date: date
+    :param req_format: return format of data (only CSV is supported)
+    :type req_format: str
+    :param conditional: only return data if it changed since the last fetch
+    :type conditional: bool
+    :param cache_dir: directory to keep a copy of the raw response in, if set
+    :type cache_dir: str
+    :return: volume data, or None if unchanged
+    :rtype: pd.DataFrame
+    """
+    volume_dfs = get_volume_by_month_to_dfs(
+        req_url=req_url,
+        req_date=req_date,
+        req_format=req_format,
+        conditional=conditional,
+        cache_dir=cache_dir,
+    )
+    if volume_dfs is None:
+        return None
+    return volume_dfs["contracts"]
+
+
+def get_volume_by_month_from_cache(cache_dir: str, req_date: date, req_format: str) -> dict:
+    """
+    Helper function to get monthly contracts and futures volume into dataframes from the
+    raw response cache, without touching the network.
+
+    :param cache_dir: raw response cache directory
+    :type cache_dir: str
+    :param req_date: month to read
+    :type req_date: date
+    :param req_format: format of the cached data (only CSV is supported)
+    :type req_format: str
+    :return: dataframes keyed by "contracts" and "futures"
+    :rtype: dict
+    """
+    csv_raw = common.cache.cache_get(cache_dir, req_date, req_format)
+    if csv_raw is None:
+        raise ValueError(f"{req_date.strftime('%B %Y')} is not in the cache")
     volume_dict = volume_csv_month_clean_sep(csv_raw)
-    volume_df = volume_df_create(volume_dict)
-    return volume_df
+    return volume_dfs_create(volume_dict)
@@ -0,0 +1,70 @@
+"""
+Machine-readable output of query results, using only the standard library
+
+Rows are written one at a time as they are read, so a result coming straight from a
+database cursor is never held in memory in full. Dates are written as ISO 8601 strings
+and missing or non-finite values as empty CSV fields or JSON nulls.
+"""
+import csv
+import json
+import math
+import sys
+from datetime import date
+
+# Values of the CLI's --format option; arrow needs pyarrow, see common.dataframe.write_arrow
+OUTPUT_FORMATS = ("table", "csv", "json", "ndjson", "arrow")
+
+
+def _json_value(value):
+    """
+    Value as written to JSON and CSV
+
+    :param value: stored value
+    :return: ISO 8601 string for dates, None for missing values and infinities, which JSON
+        cannot hold, else the value
+    """
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def write_rows(columns: list, rows, output_format: str, out=None) -> int:
+    """
+    Write rows as CSV with a header line, written even without rows, a JSON array of
+    objects or one JSON object per line
+
+    :param columns: column names
+    :type columns: list
+    :param rows: rows as sequences of values, e.g. a database cursor
+    :param output_format: "csv", "json" or "ndjson"
+    :type output_format: str
+    :param out: text stream to write to, stdout by default
+    :return: number of rows written
+    :rtype: int
+    :raises ValueError: if output_format is not a text format
+    """
+    out = out or sys.stdout
+    count = 0
+    if output_format == "csv":
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(columns)
+        for count, row in enumerate(rows, start=1):
+            writer.writerow(["" if v is None else v for v in map(_json_value, row)])
+    elif output_format in ("json", "ndjson"):
+        separator, opening, closing = (",\n", "[", "]\n") if output_format == "json" else ("\n", "", "\n")
+        out.write(opening)
+        for count, row in enumerate(rows, start=1):
+            if count > 1:
+                out.write(separator)
+            out.write(json.dumps(dict(zip(columns, map(_json_value, row)))))
+        if count or output_format == "json":
+            out.write(closing)
+    else:
+        raise ValueError(f"Unknown text format '{output_format}', expected csv, json or ndjson")
+    return count
+
+
+if __name__ == "__main__":
+    print("This file cannot be run directly.")
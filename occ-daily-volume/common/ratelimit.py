@@ -0,0 +1,80 @@
+"""
+Adaptive token-bucket rate limiter shared by fetch workers
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket whose refill rate adapts to the server: it is halved whenever the
+    server throttles (429/5xx) and recovers additively on every success, never going
+    above the configured rate. Safe to share between threads.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, min_rate: float = 0.1):
+        """
+        :param rate: maximum requests per second
+        :type rate: float
+        :param burst: number of requests that may be made back to back
+        :type burst: int
+        :param min_rate: lowest rate to back off to, in requests per second
+        :type min_rate: float
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.max_rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.rate = self.max_rate
+        self.burst = max(int(burst), 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        """
+        Add the tokens earned since the last refill, must be called with the lock held
+
+        :param now: current monotonic time
+        :type now: float
+        """
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> None:
+        """
+        Block until a request may be made
+        """
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_throttle(self) -> None:
+        """
+        Halve the request rate after the server throttled or failed a request
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate / 2)
+        logger.debug(f"Server throttled, rate limit lowered to {self.rate:.2f} req/s")
+
+    def on_success(self) -> None:
+        """
+        Raise the request rate by a tenth of the maximum after a successful request
+        """
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+
+if __name__ == "__main__":
+    print("This file cannot be run directly.")
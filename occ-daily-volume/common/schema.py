@@ -0,0 +1,478 @@
+"""
+Layout of the volume tables and the SQL that reads them, using only the standard library
+
+common.sqlite builds on these helpers, and the CLI's read-only fast path uses them
+directly so a plain top N query never has to import pandas or numpy.
+"""
+import json
+import logging
+import re
+import sqlite3 as sql
+import time
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+# Aggregate tables maintained for each volume table, named <table><suffix>
+AGGREGATE_SUFFIXES = {"month": "Monthly", "year": "Yearly"}
+# Statistics kept for every volume column in the aggregate tables
+AGGREGATE_STATS = ("Sum", "Mean", "Max", "Max Date")
+# Columns other than the key that hold dates, e.g. "OCC Total Max Date"
+DATE_COLUMN_SUFFIX = " Date"
+# Group of a day-number date for grouped top N, ordered chronologically (weekday from Monday)
+GROUP_BY_SQL = {
+    "year": """strftime('%Y', "Date" * 86400, 'unixepoch')""",
+    "month": """strftime('%Y-%m', "Date" * 86400, 'unixepoch')""",
+    "weekday": '("Date" + 3) % 7',
+}
+# Day 0 of the INTEGER dates the tables are keyed on
+EPOCH_DATE = date(1970, 1, 1)
+# Single-row table counting changes to volume data, see common.sqlite.db_read_version
+VERSION_TABLE = "dbVersion"
+# Table of recent top N results, emptied whenever the version changes
+QUERY_CACHE_TABLE = "queryCache"
+# Default number of results kept in the query cache, oldest evicted first
+QUERY_CACHE_ENTRIES = 256
+# Bytes of JSON rows the query cache holds at most, so it stays small next to the volume
+# tables; larger results are not cached
+QUERY_CACHE_BYTES = 64 * 1024
+# Ways to score a day against its history, see common.analytics; kept here so the CLI
+# can offer them without importing numpy
+SPIKE_METRICS = ("zscore", "ratio", "percentile")
+# Trading days in the trailing window of the zscore and ratio metrics
+DEFAULT_WINDOW = 20
+
+
+def validate_table_name(table_name: str) -> None:
+    """
+    Validate SQL table name to prevent SQL injection.
+
+    :param table_name: table name to validate
+    :type table_name: str
+    :raises ValueError: if table name contains invalid characters
+    """
+    if not re.match(r'^[a-zA-Z0-9_]+$', table_name):
+        raise ValueError(
+            f"Invalid table name '{table_name}'. Only alphanumeric characters and underscores are allowed."
+        )
+
+
+def quote_identifier(name: str) -> str:
+    """
+    Quote a column name for use in SQL
+
+    :param name: column name
+    :type name: str
+    :return: quoted column name
+    :rtype: str
+    """
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def aggregate_table(db_table: str, granularity: str) -> str:
+    """
+    Name of the aggregate table kept for a volume table
+
+    :param db_table: volume table
+    :type db_table: str
+    :param granularity: "month" or "year"
+    :type granularity: str
+    :return: aggregate table name
+    :rtype: str
+    """
+    return f"{db_table}{AGGREGATE_SUFFIXES[granularity]}"
+
+
+def aggregate_columns(column: str) -> list:
+    """
+    Aggregate table columns reported for one volume column
+
+    :param column: volume column, e.g. "OCC Total"
+    :type column: str
+    :return: its statistics columns followed by "Trading Days"
+    :rtype: list
+    """
+    return [f"{column} {stat}" for stat in AGGREGATE_STATS] + ["Trading Days"]
+
+
+def encode_day(value: date) -> int:
+    """
+    Day number a date is stored as
+
+    :param value: date or datetime
+    :type value: date
+    :return: days since 1970-01-01
+    :rtype: int
+    """
+    if hasattr(value, "date"):
+        value = value.date()
+    return (value - EPOCH_DATE).days
+
+
+def _period_start(value: date, granularity: str) -> date:
+    """
+    First day of the month or year holding a date
+
+    :param value: date
+    :type value: date
+    :param granularity: "day", "month" or "year"
+    :type granularity: str
+    :return: first day of the period, the date itself for days
+    :rtype: date
+    """
+    if granularity == "month":
+        return date(value.year, value.month, 1)
+    if granularity == "year":
+        return date(value.year, 1, 1)
+    return value
+
+
+def db_table_exists(conn: sql.Connection, db_table: str) -> bool:
+    """
+    Check whether a table exists in the open database
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: database table to check
+    :type db_table: str
+    :return: True if the table exists
+    :rtype: bool
+    """
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (db_table,)
+    ).fetchone()
+    return row is not None
+
+
+def db_table_columns(conn: sql.Connection, db_table: str) -> list:
+    """
+    Column names of a table, in table order
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: database table
+    :type db_table: str
+    :return: column names
+    :rtype: list
+    """
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({db_table})")]
+
+
+def db_table_key(conn: sql.Connection, db_table: str):
+    """
+    Name of the table's primary key column
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: database table
+    :type db_table: str
+    :return: primary key column, or None if the table has no single-column primary key
+    :rtype: str
+    """
+    keys = [row[1] for row in conn.execute(f"PRAGMA table_info({db_table})") if row[5]]
+    return keys[0] if len(keys) == 1 else None
+
+
+def db_table_is_current(conn: sql.Connection, db_table: str, key: str) -> bool:
+    """
+    Check whether a table already has the compact schema: clustered on key, without rowid
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: database table
+    :type db_table: str
+    :param key: expected primary key column
+    :type key: str
+    :return: True if the table needs no migration
+    :rtype: bool
+    """
+    if db_table_key(conn, db_table) != key:
+        return False
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (db_table,)
+    ).fetchone()
+    return "WITHOUT ROWID" in row[0].upper()
+
+
+def db_day_filter(start_day: int = None, end_day: int = None) -> tuple:
+    """
+    WHERE clause selecting rows between two day numbers, inclusive
+
+    :param start_day: first day, None for no lower bound
+    :type start_day: int
+    :param end_day: last day, None for no upper bound
+    :type end_day: int
+    :return: (SQL clause, possibly empty, and its parameters)
+    :rtype: tuple
+    """
+    clauses, params = [], []
+    if start_day is not None:
+        clauses.append('"Date" >= ?')
+        params.append(start_day)
+    if end_day is not None:
+        clauses.append('"Date" <= ?')
+        params.append(end_day)
+    return (f" WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+
+def db_top_n_query(
+    conn: sql.Connection,
+    db_table: str,
+    number: int,
+    column: str = "OCC Total",
+    granularity: str = "day",
+    by: str = None,
+    start: date = None,
+    end: date = None,
+    last: int = None,
+):
+    """
+    Build the top N query of common.sqlite.db_query_top_n. The date window is a range
+    on the primary key, so only rows inside it are ranked; months and years are
+    included if they overlap it.
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: volume table
+    :type db_table: str
+    :param number: number of rows to return, per group with by
+    :type number: int
+    :param column: column to rank by
+    :type column: str
+    :param granularity: "day", "month" or "year"
+    :type granularity: str
+    :param by: "year", "month" or "weekday" to rank within each group, None to rank overall
+    :type by: str
+    :param start: first date of the window, None for the oldest
+    :type start: date
+    :param end: last date of the window, None for the newest
+    :type end: date
+    :param last: only rank the latest rows of the window, None for all of them
+    :type last: int
+    :return: (query, parameters), or None if the table to read does not exist
+    :rtype: tuple
+    :raises ValueError: if an argument is not one the tables can answer
+    """
+    validate_table_name(db_table)
+    if last is not None and last < 1:
+        raise ValueError(f"last must be a positive number of rows, not {last}")
+    if granularity != "day" and granularity not in AGGREGATE_SUFFIXES:
+        raise ValueError(f"Unknown granularity '{granularity}', expected day, {', '.join(AGGREGATE_SUFFIXES)}")
+    if by is not None and by not in GROUP_BY_SQL:
+        raise ValueError(f"Unknown grouping '{by}', expected one of: {', '.join(GROUP_BY_SQL)}")
+    table = db_table if granularity == "day" else aggregate_table(db_table, granularity)
+    if not db_table_exists(conn, table):
+        return None
+    columns = db_table_columns(conn, table)
+    if granularity == "day":
+        selected, rank_column = columns, column
+        volume_columns = columns[1:]
+    else:
+        selected = ["Date", *aggregate_columns(column)]
+        rank_column = selected[1]
+        volume_columns = [c[: -len(" Sum")] for c in columns if c.endswith(" Sum")]
+    if rank_column not in columns:
+        raise ValueError(
+            f"Unknown column '{column}', expected one of: {', '.join(volume_columns)}"
+        )
+    where, params = db_day_filter(
+        None if start is None else encode_day(_period_start(start, granularity)),
+        None if end is None else encode_day(end),
+    )
+    if last is not None:
+        # Walks back from the newest date in the window along the primary key
+        first = conn.execute(
+            f'SELECT "Date" FROM {table}{where} ORDER BY "Date" DESC LIMIT 1 OFFSET ?',
+            (*params, last - 1),
+        ).fetchone()
+        if first is not None:
+            where += f'{" AND" if where else " WHERE"} "Date" >= ?'
+            params.append(first[0])
+    select = ", ".join(map(quote_identifier, selected))
+    rank = f"{quote_identifier(rank_column)} DESC"
+    if by is None:
+        query = f"SELECT {select} FROM {table}{where} ORDER BY {rank} LIMIT ?"
+    else:
+        query = (
+            f"SELECT {select} FROM (SELECT *, {GROUP_BY_SQL[by]} AS _group, "
+            f"ROW_NUMBER() OVER (PARTITION BY {GROUP_BY_SQL[by]} ORDER BY {rank}) AS _rank "
+            f"FROM {table}{where}) WHERE _rank <= ? ORDER BY _group, _rank"
+        )
+    return query, (*params, number)
+
+
+def db_version(conn: sql.Connection):
+    """
+    Version token of the open database, see common.sqlite.db_read_version
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :return: version token, or None if nothing was written yet
+    :rtype: str
+    """
+    if not db_table_exists(conn, VERSION_TABLE):
+        return None
+    generation, version = conn.execute(f"SELECT generation, version FROM {VERSION_TABLE}").fetchone()
+    return f"{generation}-{version}"
+
+
+def _db_cache_put(conn: sql.Connection, key: str, version: str, columns: list, rows: list, max_entries: int) -> None:
+    """
+    Store a query result, removing results of other versions and evicting the oldest
+    beyond max_entries or QUERY_CACHE_BYTES. Results larger than QUERY_CACHE_BYTES are
+    not stored. Results are not marked when read, so a cache hit never writes. Failures,
+    e.g. on a read-only or busy database, only skip caching.
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param key: query key
+    :type key: str
+    :param version: version token the result was read at
+    :type version: str
+    :param columns: column names
+    :type columns: list
+    :param rows: rows as tuples of stored values
+    :type rows: list
+    :param max_entries: number of results to keep
+    :type max_entries: int
+    """
+    rows_json = json.dumps(rows)
+    if len(rows_json) > QUERY_CACHE_BYTES:
+        logger.debug(f"Not caching a query result of {len(rows_json):,} bytes")
+        return
+    try:
+        with conn:
+            if db_table_exists(conn, QUERY_CACHE_TABLE) and "stored_at" not in db_table_columns(
+                conn, QUERY_CACHE_TABLE
+            ):
+                # Cache of an earlier layout, nothing in it needs keeping
+                conn.execute(f"DROP TABLE {QUERY_CACHE_TABLE}")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {QUERY_CACHE_TABLE} (key TEXT PRIMARY KEY, "
+                "version TEXT NOT NULL, columns TEXT NOT NULL, rows TEXT NOT NULL, stored_at INTEGER NOT NULL)"
+            )
+            conn.execute(f"DELETE FROM {QUERY_CACHE_TABLE} WHERE version != ?", (version,))
+            conn.execute(
+                f"INSERT OR REPLACE INTO {QUERY_CACHE_TABLE} VALUES (?, ?, ?, ?, ?)",
+                (key, version, json.dumps(columns), rows_json, time.time_ns()),
+            )
+            conn.execute(
+                f"DELETE FROM {QUERY_CACHE_TABLE} WHERE key IN (SELECT key FROM ("
+                "SELECT key, ROW_NUMBER() OVER newest AS position, SUM(length(rows)) OVER newest AS size "
+                f"FROM {QUERY_CACHE_TABLE} WINDOW newest AS (ORDER BY stored_at DESC, key)"
+                ") WHERE position > ? OR size > ?)",
+                (max_entries, QUERY_CACHE_BYTES),
+            )
+    except sql.OperationalError as e:
+        logger.debug(f"Not caching query result: {e}")
+
+
+def _db_cache_get(conn: sql.Connection, key: str, version: str):
+    """
+    Cached result of a query at the current version, read without writing
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param key: query key
+    :type key: str
+    :param version: current version token
+    :type version: str
+    :return: (column names, rows as tuples), or None if not cached
+    :rtype: tuple
+    """
+    if not db_table_exists(conn, QUERY_CACHE_TABLE):
+        return None
+    row = conn.execute(
+        f"SELECT columns, rows FROM {QUERY_CACHE_TABLE} WHERE key = ? AND version = ?", (key, version)
+    ).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0]), [tuple(r) for r in json.loads(row[1])]
+
+
+def query_is_cached(by: str, max_entries: int) -> bool:
+    """
+    Whether a top N query goes through the query cache. Only queries with by are cached:
+    they rank every row of the window with a window function, while the others read a
+    few rows down a rank index faster than the cache can be looked up.
+
+    :param by: "year", "month" or "weekday" to rank within each group, None to rank overall
+    :type by: str
+    :param max_entries: number of results to keep, 0 to not cache
+    :type max_entries: int
+    :return: True if the result is looked up in and stored to the cache
+    :rtype: bool
+    """
+    return bool(max_entries) and by is not None
+
+
+def db_cached_top_n(
+    conn: sql.Connection,
+    db_table: str,
+    number: int,
+    column: str = "OCC Total",
+    granularity: str = "day",
+    by: str = None,
+    start: date = None,
+    end: date = None,
+    last: int = None,
+    max_entries: int = QUERY_CACHE_ENTRIES,
+):
+    """
+    Run the top N query of db_top_n_query, through the query cache if
+    query_is_cached. Results are keyed by the query and the database version, so any
+    committed write makes them miss.
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: volume table
+    :type db_table: str
+    :param number: number of rows to return, per group with by
+    :type number: int
+    :param column: column to rank by
+    :type column: str
+    :param granularity: "day", "month" or "year"
+    :type granularity: str
+    :param by: "year", "month" or "weekday" to rank within each group, None to rank overall
+    :type by: str
+    :param start: first date of the window, None for the oldest
+    :type start: date
+    :param end: last date of the window, None for the newest
+    :type end: date
+    :param last: only rank the latest rows of the window, None for all of them
+    :type last: int
+    :param max_entries: number of results to keep, 0 to not cache
+    :type max_entries: int
+    :return: (column names, rows as tuples), or None if the table to read does not exist
+    :rtype: tuple
+    :raises ValueError: if an argument is not one the tables can answer
+    """
+    query = dict(number=number, column=column, granularity=granularity, by=by, start=start, end=end, last=last)
+    version = db_version(conn) if query_is_cached(by, max_entries) else None
+    if version is not None:
+        key = json.dumps(
+            {
+                "table": db_table,
+                **query,
+                "start": None if start is None else encode_day(start),
+                "end": None if end is None else encode_day(end),
+            },
+            sort_keys=True,
+        )
+        cached = _db_cache_get(conn, key, version)
+        if cached is not None:
+            logger.debug(f"Answered top {number} of {db_table} from the query cache")
+            return cached
+    built = db_top_n_query(conn, db_table, **query)
+    if built is None:
+        return None
+    cursor = conn.execute(*built)
+    rows = cursor.fetchall()
+    columns = [description[0] for description in cursor.description]
+    if version is not None:
+        _db_cache_put(conn, key, version, columns, rows, max_entries)
+    return columns, rows
+
+
+if __name__ == "__main__":
+    print("This file cannot be run directly.")
@@ -0,0 +1,324 @@
+"""
+Long-running local query service answering from volume history held in memory
+
+Every table is read from storage once into a common.snapshot.MemorySnapshot and queried
+over a small JSON API on a threaded HTTP server. A background thread watches the storage
+version. When a single batch was committed since the last load, only the months whose
+fetch journal entries it changed are read again; anything else reloads the whole table.
+
+    GET /top?number=10&column=OCC%20Total&granularity=day&by=year&start=2020-01-01&end=...&last=...
+    GET /top?spike=zscore&window=20&...
+    GET /range?start=2024-01-01&end=2024-01-31
+    GET /status
+
+Every query takes dataset=contracts|futures. Results are JSON arrays of row objects, as
+written by --format json, and errors are {"error": message} with status 400 or 404.
+"""
+import io
+import json
+import logging
+import threading
+from calendar import monthrange
+from datetime import date, datetime
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+import common.analytics
+import common.dataframe
+import common.output
+import common.schema
+import common.snapshot
+
+logger = logging.getLogger(__name__)
+
+# Address served by default, local connections only, as volume-top-n.py --serve
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8064
+# Seconds between checks of the storage version
+RELOAD_SECONDS = 5.0
+
+
+class VolumeService:
+    """
+    The tables of a storage held in memory. Queries read whichever snapshot is current
+    when they start, and a reload swaps in new snapshots without blocking them.
+    """
+
+    def __init__(self, storage):
+        """
+        :param storage: storage to serve
+        :type storage: common.storage.Storage
+        """
+        self.storage = storage
+        self.version = None
+        self.loaded_at = None
+        self._journal = {}
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self.reload()
+
+    def _changed_months(self, version: str, journal: dict) -> list:
+        """
+        Months written since the last load, if a single batch was committed since then.
+        The updater journals every month in the batch that writes its rows, and every
+        journal write counts an attempt, so the batch's months are exactly those whose
+        entries differ from the ones seen at the last load.
+
+        :param version: storage version now
+        :type version: str
+        :param journal: fetch journal now, see common.storage.Storage.read_journal
+        :type journal: dict
+        :return: months, oldest first, empty if the changes are not all journaled
+        :rtype: list
+        """
+        if self.version is None or version is None:
+            return []
+        generation, _, count = version.rpartition("-")
+        last_generation, _, last_count = self.version.rpartition("-")
+        if generation != last_generation or int(count) != int(last_count) + 1:
+            return []
+        return sorted(month for month, entry in journal.items() if self._journal.get(month) != entry)
+
+    def reload(self) -> bool:
+        """
+        Load the tables again if the storage version has changed since the last load
+
+        :return: True if anything was reloaded
+        :rtype: bool
+        """
+        with self._lock:
+            # Read the version before the journal and the journal before the data, so a
+            # write committed during the load is read again on the next one
+            version = self.storage.read_version()
+            if version is not None and version == self.version:
+                return False
+            journal = self.storage.read_journal()
+            months = self._changed_months(version, journal)
+            snapshots = {}
+            for table in self.storage.tables():
+                current = self._snapshots.get(table)
+                snapshot = None
+                if current is not None and months:
+                    start = months[0]
+                    end = date(months[-1].year, months[-1].month, monthrange(months[-1].year, months[-1].month)[1])
+                    snapshot = current.replace_range(
+                        self.storage.read_table(table, start=start, end=end), start, end, version
+                    )
+                if snapshot is None:
+                    table_df = self.storage.read_table(table)
+                    snapshot = None if table_df.empty else common.snapshot.MemorySnapshot(table_df, version)
+                snapshots[table] = snapshot
+            self._snapshots = snapshots
+            self.version, self._journal, self.loaded_at = version, journal, datetime.now()
+        if months:
+            logger.info(f"Reloaded {len(months)} changed months at version {version}")
+        else:
+            logger.info(f"Loaded {', '.join(snapshots)} at version {version}")
+        return True
+
+    def snapshot(self, dataset: str = "contracts"):
+        """
+        :param dataset: "contracts" or "futures"
+        :type dataset: str
+        :return: current snapshot of the dataset's table, None if it has no data
+        :rtype: common.snapshot.MemorySnapshot
+        :raises ValueError: if the dataset is not stored
+        """
+        db_table = self.storage.dataset_table(dataset) if dataset in ("contracts", "futures") else None
+        if not db_table:
+            raise ValueError(f"Dataset '{dataset}' is not stored, expected contracts or futures")
+        return self._snapshots.get(db_table)
+
+    def top_n(
+        self,
+        number: int = 10,
+        column: str = "OCC Total",
+        dataset: str = "contracts",
+        granularity: str = "day",
+        by: str = None,
+        spike: str = None,
+        window: int = common.schema.DEFAULT_WINDOW,
+        start=None,
+        end=None,
+        last: int = None,
+    ) -> pd.DataFrame:
+        """
+        Answer a top N query as the CLI does, see volume-top-n.py
+
+        :return: top rows, largest first
+        :rtype: pd.DataFrame
+        :raises ValueError: if the arguments are not a query the CLI accepts
+        """
+        if (spike or by == "weekday") and granularity != "day":
+            raise ValueError("spike and by=weekday require granularity=day")
+        if last is not None and last < 1:
+            raise ValueError(f"last must be a positive number of rows, not {last}")
+        snapshot = self.snapshot(dataset)
+        if snapshot is None:
+            return pd.DataFrame()
+        window_args = dict(by=by, start=start, end=end, last=last)
+        if spike:
+            return common.analytics.query_spikes(
+                self.storage, number, column, snapshot=snapshot, metric=spike, window=window, **window_args
+            )
+        if granularity == "day":
+            return snapshot.top_n(number, column, **window_args)
+        return snapshot.top_n_periods(number, column, granularity, **window_args)
+
+    def date_range(self, dataset: str = "contracts", start=None, end=None) -> pd.DataFrame:
+        """
+        :return: rows between two dates, inclusive, oldest first
+        :rtype: pd.DataFrame
+        """
+        snapshot = self.snapshot(dataset)
+        return pd.DataFrame() if snapshot is None else snapshot.date_range(start, end)
+
+    def status(self) -> dict:
+        """
+        :return: version, load time and the rows and date range of each table
+        :rtype: dict
+        """
+        snapshots = self._snapshots
+        return {
+            "version": self.version,
+            "loaded_at": self.loaded_at and self.loaded_at.isoformat(),
+            "tables": {
+                table: snapshot and {
+                    "rows": len(snapshot),
+                    "first": str(snapshot.dates[0]),
+                    "last": str(snapshot.dates[-1]),
+                }
+                for table, snapshot in snapshots.items()
+            },
+        }
+
+
+# Query string arguments of each endpoint and how they are parsed
+_ARGUMENTS = {
+    "/top": {
+        "number": int,
+        "column": str,
+        "dataset": str,
+        "granularity": str,
+        "by": str,
+        "spike": str,
+        "window": int,
+        "start": date.fromisoformat,
+        "end": date.fromisoformat,
+        "last": int,
+    },
+    "/range": {"dataset": str, "start": date.fromisoformat, "end": date.fromisoformat},
+}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """
+    Handler of the JSON API, answering from the server's VolumeService
+    """
+
+    def _send_json(self, status: HTTPStatus, body: str) -> None:
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        service = self.server.service
+        if url.path == "/status":
+            return self._send_json(HTTPStatus.OK, json.dumps(service.status()))
+        if url.path not in _ARGUMENTS:
+            return self._send_json(HTTPStatus.NOT_FOUND, json.dumps({"error": f"Unknown endpoint {url.path}"}))
+        try:
+            arguments = {}
+            for name, values in parse_qs(url.query).items():
+                if name not in _ARGUMENTS[url.path]:
+                    raise ValueError(f"Unknown argument '{name}'")
+                arguments[name] = _ARGUMENTS[url.path][name](values[-1])
+            if url.path == "/top":
+                result_df = service.top_n(**arguments)
+            else:
+                result_df = service.date_range(**arguments)
+        except ValueError as e:
+            return self._send_json(HTTPStatus.BAD_REQUEST, json.dumps({"error": str(e)}))
+        body = io.StringIO()
+        if result_df.empty:
+            body.write("[]\n")
+        else:
+            common.output.write_rows(*common.dataframe.df_rows(result_df), "json", out=body)
+        self._send_json(HTTPStatus.OK, body.getvalue())
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class VolumeServer(ThreadingHTTPServer):
+    """
+    HTTP server answering each request in its own thread from a shared VolumeService
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple, service: VolumeService):
+        """
+        :param address: (host, port) to listen on, port 0 for any free port
+        :type address: tuple
+        :param service: service answering the queries
+        :type service: VolumeService
+        """
+        self.service = service
+        super().__init__(address, _RequestHandler)
+
+
+def _watch(service: VolumeService, stop: threading.Event, reload_seconds: float) -> None:
+    """
+    Reload the service whenever the storage version changes, until stop is set
+
+    :param service: service to keep up to date
+    :type service: VolumeService
+    :param stop: event ending the watch
+    :type stop: threading.Event
+    :param reload_seconds: seconds between version checks
+    :type reload_seconds: float
+    """
+    while not stop.wait(reload_seconds):
+        try:
+            service.reload()
+        except Exception:
+            logger.exception("Reload failed, still serving the previous data")
+
+
+def serve(storage, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, reload_seconds: float = RELOAD_SECONDS):
+    """
+    Load the storage's tables and answer queries until interrupted
+
+    :param storage: storage to serve
+    :type storage: common.storage.Storage
+    :param host: address to listen on
+    :type host: str
+    :param port: port to listen on
+    :type port: int
+    :param reload_seconds: seconds between checks of the storage version
+    :type reload_seconds: float
+    """
+    service = VolumeService(storage)
+    server = VolumeServer((host, port), service)
+    stop = threading.Event()
+    threading.Thread(target=_watch, args=(service, stop, reload_seconds), daemon=True).start()
+    print(f"Serving volume queries on http://{host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    print("This file cannot be run directly.")
@@ -0,0 +1,330 @@
+"""
+Memory-mapped NumPy snapshot of a volume table for fast repeated reads
+
+A snapshot is one .npy file of dates plus one per volume column and one of its rolling
+prefix sums, written to a directory named after the storage version it was built from.
+A small CURRENT file points at the live directory, so a snapshot is swapped in
+atomically and readers can tell it is stale by comparing its version with the storage's.
+"""
+import hashlib
+import json
+import logging
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import common.analytics
+import common.cache
+import common.dataframe
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot:
+    """
+    Read-only view of a snapshot. Arrays are memory-mapped, so opening a snapshot reads
+    no data and queries only touch the pages they need.
+    """
+
+    def __init__(self, snapshot_path: Path):
+        """
+        :param snapshot_path: directory of one snapshot version
+        :type snapshot_path: Path
+        """
+        meta = json.loads((snapshot_path / "meta.json").read_text())
+        self.path = snapshot_path
+        self.version = meta["version"]
+        self.dates = np.load(snapshot_path / "dates.npy", mmap_mode="r")
+        self.columns = {
+            name: np.load(snapshot_path / f"col{i}.npy", mmap_mode="r")
+            for i, name in enumerate(meta["columns"])
+        }
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def _to_df(self, rows) -> pd.DataFrame:
+        """
+        Build a dataframe from the given rows
+
+        :param rows: slice or integer positions of the rows to return
+        :return: rows indexed by Date
+        :rtype: pd.DataFrame
+        """
+        index = pd.DatetimeIndex(self.dates[rows].astype("datetime64[ns]"), name="Date")
+        return pd.DataFrame({name: values[rows] for name, values in self.columns.items()}, index=index)
+
+    def _check_column(self, column: str) -> None:
+        """
+        :param column: column a query asks for
+        :type column: str
+        :raises ValueError: if the snapshot has no such column
+        """
+        if column not in self.columns:
+            raise ValueError(
+                f"Unknown column '{column}', expected one of: {', '.join(self.columns)}"
+            )
+
+    def rolling_state(self, column: str) -> np.ndarray:
+        """
+        Prefix sums of a column for rolling statistics, see common.analytics. They are
+        written with the snapshot, so they are replaced along with it when the data
+        changes; a snapshot written without them computes them in memory instead.
+
+        :param column: volume column
+        :type column: str
+        :return: memory-mapped prefix count, sum and sum of squares
+        :rtype: np.ndarray
+        """
+        self._check_column(column)
+        try:
+            return np.load(self.path / f"rolling{list(self.columns).index(column)}.npy", mmap_mode="r")
+        except FileNotFoundError:
+            return common.analytics.rolling_state(self.columns[column])
+
+    def top_n(
+        self, number: int, column: str = "OCC Total", by: str = None, start=None, end=None, last: int = None
+    ) -> pd.DataFrame:
+        """
+        Rows with the largest values in a column, selected with a partial sort so only
+        the winning rows are copied out of the snapshot. A date window is found by binary
+        search and only its rows are ranked.
+
+        :param number: number of rows to return, per group with by
+        :type number: int
+        :param column: column to rank by
+        :type column: str
+        :param by: "year", "month" or "weekday" to rank within each group, None to rank overall
+        :type by: str
+        :param start: first date of the window, None for the oldest
+        :param end: last date of the window, None for the newest
+        :param last: only rank the latest rows of the window, None for all of them
+        :type last: int
+        :return: top rows, largest first
+        :rtype: pd.DataFrame
+        """
+        self._check_column(column)
+        lo, hi = common.dataframe.date_bounds(self.dates, start, end, last)
+        if by is not None:
+            keys = common.dataframe.date_group_keys(self.dates[lo:hi], by)
+            return self._to_df(lo + common.dataframe.top_n_positions(self.columns[column][lo:hi], number, keys))
+        values = self.columns[column][lo:hi]
+        if np.issubdtype(values.dtype, np.floating):
+            # Missing values rank last, as NULLs do in SQLite
+            values = np.where(np.isnan(values), -np.inf, values)
+        number = min(max(number, 0), len(values))
+        if number == 0:
+            return self._to_df(slice(0, 0))
+        top = np.argpartition(values, len(values) - number)[-number:]
+        top = top[np.argsort(-values[top], kind="stable")]
+        return self._to_df(lo + top)
+
+    def date_range(self, start=None, end=None) -> pd.DataFrame:
+        """
+        Rows between two dates, inclusive, found by binary search on the sorted dates
+
+        :param start: first date, None for the oldest
+        :param end: last date, None for the newest
+        :return: rows indexed by Date, oldest first
+        :rtype: pd.DataFrame
+        """
+        return self._to_df(slice(*common.dataframe.date_bounds(self.dates, start, end)))
+
+
+class MemorySnapshot(Snapshot):
+    """
+    Snapshot held in process memory for a long-running service. Rolling state and
+    month and year aggregates are computed on first use and kept with it.
+    """
+
+    def __init__(self, table_df: pd.DataFrame, version: str):
+        """
+        :param table_df: all rows of a table, indexed by Date
+        :type table_df: pd.DataFrame
+        :param version: storage version the rows were read at
+        :type version: str
+        """
+        table_df = table_df.sort_index()
+        self.path = None
+        self.version = version
+        self.dates = table_df.index.to_numpy(dtype="datetime64[D]")
+        self.columns = {name: table_df[name].to_numpy() for name in table_df.columns}
+        self._rolling = {}
+        self._aggregates = {}
+
+    def rolling_state(self, column: str) -> np.ndarray:
+        self._check_column(column)
+        if column not in self._rolling:
+            self._rolling[column] = common.analytics.rolling_state(self.columns[column])
+        return self._rolling[column]
+
+    def replace_range(self, range_df: pd.DataFrame, start, end, version: str) -> "MemorySnapshot":
+        """
+        New snapshot with the rows between two dates replaced, e.g. by the months an
+        update rewrote
+
+        :param range_df: all rows between start and end, indexed by Date
+        :type range_df: pd.DataFrame
+        :param start: first date replaced
+        :param end: last date replaced
+        :param version: storage version the rows were read at
+        :type version: str
+        :return: updated snapshot, or None if range_df has other columns
+        :rtype: MemorySnapshot
+        """
+        if list(range_df.columns) != list(self.columns):
+            return None
+        lo, hi = common.dataframe.date_bounds(self.dates, start, end)
+        kept = np.r_[0:lo, hi:len(self.dates)]
+        return MemorySnapshot(pd.concat([self._to_df(kept), range_df]), version)
+
+    def top_n_periods(
+        self,
+        number: int,
+        column: str = "OCC Total",
+        granularity: str = "month",
+        by: str = None,
+        start=None,
+        end=None,
+        last: int = None,
+    ) -> pd.DataFrame:
+        """
+        Months or years with the largest total of a column, with the statistics of the
+        SQLite aggregate tables. Periods are included if they overlap the date window.
+
+        :param number: number of periods to return, per group with by
+        :type number: int
+        :param column: column to rank by
+        :type column: str
+        :param granularity: "month" or "year"
+        :type granularity: str
+        :param by: "year" or "month" to rank within each group, None to rank overall
+        :type by: str
+        :param start: first date of the window, None for the oldest
+        :param end: last date of the window, None for the newest
+        :param last: only rank the latest periods of the window, None for all of them
+        :type last: int
+        :return: top periods, largest first
+        :rtype: pd.DataFrame
+        """
+        self._check_column(column)
+        if granularity not in common.dataframe.GRANULARITY_PERIODS:
+            raise ValueError(f"Unknown granularity '{granularity}', expected day, month or year")
+        if (granularity, column) not in self._aggregates:
+            column_df = pd.DataFrame(
+                {column: self.columns[column]},
+                index=pd.DatetimeIndex(self.dates.astype("datetime64[ns]"), name="Date"),
+            )
+            self._aggregates[granularity, column] = common.dataframe.volume_aggregate_df(column_df, granularity)
+        aggregate_df = self._aggregates[granularity, column]
+        if start is not None:
+            start = pd.Timestamp(start).to_period(common.dataframe.GRANULARITY_PERIODS[granularity]).start_time
+        lo, hi = common.dataframe.date_bounds(aggregate_df.index.to_numpy(dtype="datetime64[D]"), start, end, last)
+        aggregate_df = aggregate_df.iloc[lo:hi]
+        keys = None if by is None else common.dataframe.date_group_keys(aggregate_df.index, by)
+        return aggregate_df.iloc[common.dataframe.top_n_positions(aggregate_df[f"{column} Sum"], number, keys)]
+
+
+def _table_dir(snapshot_dir: str, db_table: str) -> Path:
+    """
+    Directory holding a table's snapshots
+
+    :param snapshot_dir: snapshot directory
+    :type snapshot_dir: str
+    :param db_table: table
+    :type db_table: str
+    :return: table snapshot directory
+    :rtype: Path
+    """
+    return Path(snapshot_dir) / db_table
+
+
+def snapshot_write(snapshot_dir: str, db_table: str, table_df: pd.DataFrame, version: str) -> None:
+    """
+    Write a snapshot of a table and make it the current one, removing older snapshots
+
+    :param snapshot_dir: snapshot directory
+    :type snapshot_dir: str
+    :param db_table: table the snapshot is of
+    :type db_table: str
+    :param table_df: all rows of the table, indexed by Date
+    :type table_df: pd.DataFrame
+    :param version: storage version the rows were read at
+    :type version: str
+    """
+    table_dir = _table_dir(snapshot_dir, db_table)
+    name = hashlib.sha256(version.encode()).hexdigest()[:16]
+    snapshot_path = table_dir / name
+    table_df = table_df.sort_index()
+    shutil.rmtree(snapshot_path, ignore_errors=True)
+    snapshot_path.mkdir(parents=True)
+    np.save(snapshot_path / "dates.npy", table_df.index.to_numpy(dtype="datetime64[D]"))
+    for i, column in enumerate(table_df.columns):
+        np.save(snapshot_path / f"col{i}.npy", table_df[column].to_numpy())
+        np.save(snapshot_path / f"rolling{i}.npy", common.analytics.rolling_state(table_df[column].to_numpy()))
+    (snapshot_path / "meta.json").write_text(
+        json.dumps({"version": version, "columns": list(table_df.columns), "rows": len(table_df)})
+    )
+    common.cache._atomic_write(table_dir / "CURRENT", name.encode("ascii"))
+    for old_path in table_dir.iterdir():
+        if old_path.is_dir() and old_path.name != name:
+            shutil.rmtree(old_path, ignore_errors=True)
+    logger.debug(f"Wrote snapshot of {len(table_df):,} rows of {db_table} at version {version}")
+
+
+def snapshot_open(snapshot_dir: str, db_table: str, version: str = None):
+    """
+    Open the current snapshot of a table
+
+    :param snapshot_dir: snapshot directory
+    :type snapshot_dir: str
+    :param db_table: table
+    :type db_table: str
+    :param version: storage version the snapshot must match, None to accept any
+    :type version: str
+    :return: snapshot, or None if there is none or it is stale
+    :rtype: Snapshot
+    """
+    table_dir = _table_dir(snapshot_dir, db_table)
+    try:
+        snapshot = Snapshot(table_dir / (table_dir / "CURRENT").read_text().strip())
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+    if version is not None and snapshot.version != version:
+        logger.debug(f"Snapshot of {db_table} is stale ({snapshot.version} != {version})")
+        return None
+    return snapshot
+
+
+def snapshot_load(storage, snapshot_dir: str, db_table: str = None):
+    """
+    Open an up to date snapshot of a table, rebuilding it from storage if it is missing or stale
+
+    :param storage: storage the table is kept in
+    :type storage: common.storage.Storage
+    :param snapshot_dir: snapshot directory
+    :type snapshot_dir: str
+    :param db_table: table, defaults to the contracts table
+    :type db_table: str
+    :return: snapshot, or None if the table has no data
+    :rtype: Snapshot
+    """
+    db_table = db_table or storage.db_table
+    version = storage.read_version()
+    if version is None:
+        return None
+    snapshot = snapshot_open(snapshot_dir, db_table, version)
+    if snapshot is not None:
+        return snapshot
+    table_df = storage.read_table(db_table)
+    if table_df.empty:
+        return None
+    logger.info(f"Rebuilding snapshot of {db_table} in {snapshot_dir}")
+    snapshot_write(snapshot_dir, db_table, table_df, version)
+    return snapshot_open(snapshot_dir, db_table, version)
+
+
+if __name__ == "__main__":
+    print("This file cannot be run directly.")
@@ -1,30 +1,761 @@
+import atexit
 import logging
+import os
 import re
 import sqlite3 as sql
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+import common.dataframe
+from common.schema import (
+    AGGREGATE_SUFFIXES,
+    DATE_COLUMN_SUFFIX,
+    GROUP_BY_SQL,
+    QUERY_CACHE_ENTRIES,
+    QUERY_CACHE_TABLE,
+    VERSION_TABLE,
+    aggregate_table,
+    db_cached_top_n,
+    db_day_filter,
+    db_table_columns,
+    db_table_exists,
+    db_table_is_current,
+    db_table_key,
+    db_version,
+    quote_identifier,
+    validate_table_name,
+)
+
 logger = logging.getLogger(__name__)
 
+# Table holding HTTP cache validators for OCC reports
+VALIDATORS_TABLE = "occValidators"
+# Table recording per-month fetch status for resumable backfills
+JOURNAL_TABLE = "fetchJournal"
+# Default number of month frames committed per transaction by DbBatchWriter
+WRITE_BATCH_SIZE = 12
+# Julian day of 1970-01-01, dates are stored as INTEGER days since then
+UNIX_EPOCH_JULIAN_DAY = 2440587.5
+# Pragmas applied to every connection, see configure_connections. WAL lets readers
+# run alongside a writer, busy_timeout makes writers wait for each other instead of failing
+DEFAULT_PRAGMAS = {
+    "journal_mode": "wal",
+    "busy_timeout": 5000,
+    "cache_size": -16000,
+    "mmap_size": 268435456,
+    "synchronous": "normal",
+}
+
+# Shared connections keyed by absolute database path, as (connection, lock, inode)
+_connections = {}
+_connections_lock = threading.Lock()
+_pragmas = dict(DEFAULT_PRAGMAS)
+# Number of top N results kept in each database's query cache, see configure_query_cache
+_query_cache_entries = QUERY_CACHE_ENTRIES
 
-def _validate_table_name(table_name: str) -> None:
+
+def configure_connections(**pragmas) -> None:
     """
-    Validate SQL table name to prevent SQL injection.
+    Set the pragmas applied to shared connections, closing any already open so the next
+    call reopens them with the new settings. Unset pragmas keep their defaults.
 
-    :param table_name: table name to validate
-    :type table_name: str
-    :raises ValueError: if table name contains invalid characters
+    :param pragmas: pragma values by name, any of DEFAULT_PRAGMAS
+    :raises ValueError: if a pragma is unknown or its value is not a plain word or number
     """
-    if not re.match(r'^[a-zA-Z0-9_]+$', table_name):
-        raise ValueError(
-            f"Invalid table name '{table_name}'. Only alphanumeric characters and underscores are allowed."
+    for name, value in pragmas.items():
+        if name not in DEFAULT_PRAGMAS:
+            raise ValueError(
+                f"Unknown pragma '{name}', expected one of: {', '.join(DEFAULT_PRAGMAS)}"
+            )
+        if not re.match(r'^-?[a-zA-Z0-9_]+$', str(value)):
+            raise ValueError(f"Invalid value '{value}' for pragma {name}")
+    close_connections()
+    _pragmas.clear()
+    _pragmas.update(DEFAULT_PRAGMAS, **pragmas)
+
+
+def configure_query_cache(max_entries: int = QUERY_CACHE_ENTRIES) -> None:
+    """
+    Set how many top N results db_query_top_n keeps in each database's query cache
+
+    :param max_entries: number of results to keep, 0 to not cache
+    :type max_entries: int
+    :raises ValueError: if max_entries is negative
+    """
+    global _query_cache_entries
+    if max_entries < 0:
+        raise ValueError(f"Query cache size must be 0 or more entries, not {max_entries}")
+    _query_cache_entries = int(max_entries)
+
+
+def _open_connection(db_filepath: str) -> sql.Connection:
+    """
+    Open a connection that may be shared between threads and apply the configured pragmas
+
+    :param db_filepath: absolute database filepath
+    :type db_filepath: str
+    :return: open database connection
+    :rtype: sql.Connection
+    """
+    conn = sql.connect(db_filepath, check_same_thread=False)
+    for name, value in _pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    logger.debug(
+        f"Opened {db_filepath} with "
+        + ", ".join(f"{n}={conn.execute(f'PRAGMA {n}').fetchone()[0]}" for n in _pragmas)
+    )
+    return conn
+
+
+def _get_connection(db_filepath: str) -> tuple:
+    """
+    Shared connection for a database file, opened on first use. A connection whose file
+    was deleted or replaced since it was opened is reopened.
+
+    :param db_filepath: database filepath
+    :type db_filepath: str
+    :return: (connection, lock serializing its use)
+    :rtype: tuple
+    """
+    path = os.path.abspath(db_filepath)
+    with _connections_lock:
+        entry = _connections.get(path)
+        try:
+            inode = os.stat(path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if entry is not None and entry[2] == inode:
+            return entry[0], entry[1]
+        if entry is not None:
+            entry[0].close()
+        conn = _open_connection(path)
+        lock = threading.RLock()
+        _connections[path] = (conn, lock, os.stat(path).st_ino)
+        return conn, lock
+
+
+@contextmanager
+def db_connection(db_filepath: str):
+    """
+    Use the process's shared connection to a database file. Calls from other threads
+    wait their turn; a transaction the block starts is committed on a clean exit and
+    rolled back if an exception escapes, while one already open when it was entered is
+    left to its owner. The connection stays open for the next call.
+
+    :param db_filepath: database filepath
+    :type db_filepath: str
+    :return: open database connection
+    :rtype: sql.Connection
+    """
+    conn, lock = _get_connection(db_filepath)
+    with lock:
+        owns_transaction = not conn.in_transaction
+        try:
+            yield conn
+        except BaseException:
+            if owns_transaction and conn.in_transaction:
+                conn.rollback()
+            raise
+        if owns_transaction and conn.in_transaction:
+            conn.commit()
+
+
+def close_connections() -> None:
+    """
+    Close all shared connections, checkpointing their write-ahead logs
+    """
+    with _connections_lock:
+        entries = list(_connections.values())
+        _connections.clear()
+    for conn, lock, _ in entries:
+        with lock:
+            conn.close()
+
+
+atexit.register(close_connections)
+
+
+def _sql_type(dtype) -> str:
+    """
+    SQLite column type for a pandas dtype
+
+    :param dtype: pandas dtype
+    :return: SQLite column type
+    :rtype: str
+    """
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    return "TEXT"
+
+
+def _encode_values(values) -> list:
+    """
+    Values of an index or column as SQLite parameters, with dates as days since the epoch
+
+    :param values: index or column to encode
+    :type values: pd.Index | pd.Series
+    :return: SQLite parameter values
+    :rtype: list
+    """
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        days = values.to_numpy(dtype="datetime64[D]")
+        encoded = days.astype("int64").tolist()
+        if np.isnat(days).any():
+            encoded = [None if missing else day for day, missing in zip(encoded, np.isnat(days))]
+        return encoded
+    return values.tolist()
+
+
+def _decode_dates(out_df: pd.DataFrame, key: str = "Date") -> pd.DataFrame:
+    """
+    Turn the stored day numbers of the key column into a datetime64 index, and those of
+    other date columns into datetime64 columns, without parsing strings. Tables not yet
+    migrated from text dates are parsed as before.
+
+    :param out_df: dataframe read from the database
+    :type out_df: pd.DataFrame
+    :param key: date column to decode
+    :type key: str
+    :return: dataframe indexed by date
+    :rtype: pd.DataFrame
+    """
+    days = out_df.pop(key)
+    if pd.api.types.is_integer_dtype(days.dtype):
+        out_df.index = pd.DatetimeIndex(pd.to_datetime(days, unit="D"), name=key)
+    else:
+        out_df.index = pd.DatetimeIndex(pd.to_datetime(days), name=key)
+    for column in out_df.columns:
+        if str(column).endswith(DATE_COLUMN_SUFFIX) and pd.api.types.is_numeric_dtype(out_df[column].dtype):
+            out_df[column] = pd.to_datetime(out_df[column], unit="D")
+    return out_df
+
+
+def _db_create_table(conn: sql.Connection, db_table: str, columns: dict) -> None:
+    """
+    Create a table clustered on its first column
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: database table to create
+    :type db_table: str
+    :param columns: column names mapped to SQLite types, key column first
+    :type columns: dict
+    """
+    key, *_ = columns
+    column_defs = ", ".join(
+        f"{quote_identifier(c)} {t}" + (" PRIMARY KEY" if c == key else "")
+        for c, t in columns.items()
+    )
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {db_table} ({column_defs}) WITHOUT ROWID")
+    logger.debug(f"Created table {db_table} keyed on {key}")
+
+
+def _db_create_rank_indexes(conn: sql.Connection, db_table: str) -> None:
+    """
+    Index the columns top N queries rank by, so ORDER BY ... DESC LIMIT can walk an index
+    instead of sorting the whole table: every volume column of a day table, and only the
+    <column> Sum columns of an aggregate table. Indexes of other columns, left by earlier
+    versions, are dropped so writes do not maintain them.
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: database table to index
+    :type db_table: str
+    """
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({db_table})").fetchall() if not row[5]]
+    ranked = [c for c in columns if c.endswith(" Sum")] or columns
+    wanted = {f"ix_{db_table}_{re.sub(r'[^a-zA-Z0-9_]', '_', column)}": column for column in ranked}
+    for row in conn.execute(f"PRAGMA index_list({db_table})").fetchall():
+        index_name = row[1]
+        if index_name.startswith(f"ix_{db_table}_") and index_name not in wanted:
+            conn.execute(f"DROP INDEX {index_name}")
+    for index_name, column in wanted.items():
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {index_name} ON {db_table} ({quote_identifier(column)})"
+        )
+
+
+def _db_migrate_table(conn: sql.Connection, db_table: str, key: str) -> int:
+    """
+    Rebuild a table written by DataFrame.to_sql or an earlier schema into the compact
+    schema clustered on key, keeping the most recently written row for each duplicated key.
+    A text date key is converted to INTEGER days since the epoch. Runs as a single savepoint.
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: database table to migrate
+    :type db_table: str
+    :param key: column to use as primary key
+    :type key: str
+    :return: number of duplicate rows removed
+    :rtype: int
+    """
+    columns = {row[1]: row[2] for row in conn.execute(f"PRAGMA table_info({db_table})")}
+    if key not in columns:
+        raise ValueError(f"Table {db_table} has no {key} column to migrate to a primary key")
+    key_expr = quote_identifier(key)
+    if columns[key].upper() != "INTEGER":
+        key_expr = f"CAST(julianday(substr({key_expr}, 1, 10)) - {UNIX_EPOCH_JULIAN_DAY} AS INTEGER)"
+    columns = {key: "INTEGER", **{c: t for c, t in columns.items() if c != key}}
+    column_list = ", ".join(map(quote_identifier, columns))
+    select_list = ", ".join([key_expr, *map(quote_identifier, list(columns)[1:])])
+    before = conn.execute(f"SELECT COUNT(*) FROM {db_table}").fetchone()[0]
+    conn.execute("SAVEPOINT migrate_table")
+    try:
+        conn.execute(f"DROP TABLE IF EXISTS {db_table}_migrate")
+        _db_create_table(conn, f"{db_table}_migrate", columns)
+        conn.execute(
+            f"INSERT INTO {db_table}_migrate ({column_list}) "
+            f"SELECT {select_list} FROM {db_table} WHERE rowid IN "
+            f"(SELECT MAX(rowid) FROM {db_table} GROUP BY {key_expr})"
+        )
+        conn.execute(f"DROP TABLE {db_table}")
+        conn.execute(f"ALTER TABLE {db_table}_migrate RENAME TO {db_table}")
+        _db_create_rank_indexes(conn, db_table)
+    except BaseException:
+        conn.execute("ROLLBACK TO migrate_table")
+        conn.execute("RELEASE migrate_table")
+        raise
+    conn.execute("RELEASE migrate_table")
+    after = conn.execute(f"SELECT COUNT(*) FROM {db_table}").fetchone()[0]
+    logger.info(
+        f"Migrated {db_table} to a compact {key}-keyed schema, removed {before - after:,} duplicate rows"
+    )
+    return before - after
+
+
+def _db_bump_version(conn: sql.Connection) -> None:
+    """
+    Count a change to volume data and empty the query cache, in the caller's transaction
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    """
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} "
+        "(id INTEGER PRIMARY KEY CHECK (id = 0), generation TEXT NOT NULL, version INTEGER NOT NULL)"
+    )
+    conn.execute(
+        f"INSERT INTO {VERSION_TABLE} VALUES (0, ?, 1) "
+        "ON CONFLICT (id) DO UPDATE SET version = version + 1",
+        (uuid.uuid4().hex,),
+    )
+    if db_table_exists(conn, QUERY_CACHE_TABLE):
+        conn.execute(f"DELETE FROM {QUERY_CACHE_TABLE}")
+
+
+def db_read_version(db_filepath: str):
+    """
+    Read the token identifying the current state of the volume data. It changes with
+    every committed write, drop or migration, and differs between database files.
+
+    :param db_filepath: database filepath
+    :type db_filepath: str
+    :return: version token, or None if nothing was written yet
+    :rtype: str
+    """
+    if not Path(db_filepath).is_file():
+        return None
+    with db_connection(db_filepath) as conn:
+        return db_version(conn)
+
+
+def db_migrate_table(db_filepath: str, db_table: str, key: str = "Date") -> int:
+    """
+    One-time migration of a table created by DataFrame.to_sql (no primary key) or keyed
+    on text dates to the compact schema: INTEGER day-number dates, clustered on key
+    WITHOUT ROWID, de-duplicating existing rows, then vacuumed to reclaim the space.
+    Tables that are already current only get any missing column indexes and aggregate
+    tables; missing tables are left alone.
+
+    :param db_filepath: database filepath
+    :type db_filepath: str
+    :param db_table: database table to migrate
+    :type db_table: str
+    :param key: column to use as primary key
+    :type key: str
+    :return: number of duplicate rows removed
+    :rtype: int
+    """
+    validate_table_name(db_table)
+    if not Path(db_filepath).is_file():
+        return 0
+    with db_connection(db_filepath) as conn:
+        if not db_table_exists(conn, db_table):
+            return 0
+        if db_table_is_current(conn, db_table, key):
+            for table in (db_table, *(aggregate_table(db_table, g) for g in AGGREGATE_SUFFIXES)):
+                if db_table_exists(conn, table):
+                    _db_create_rank_indexes(conn, table)
+            if not all(db_table_exists(conn, aggregate_table(db_table, g)) for g in AGGREGATE_SUFFIXES):
+                _db_rebuild_aggregates(conn, db_table)
+                _db_bump_version(conn)
+            return 0
+        removed = _db_migrate_table(conn, db_table, key)
+        _db_rebuild_aggregates(conn, db_table)
+        _db_bump_version(conn)
+        conn.commit()
+        size_before = Path(db_filepath).stat().st_size
+        conn.execute("VACUUM")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        logger.info(
+            f"Vacuumed {db_filepath} from {size_before:,} to {Path(db_filepath).stat().st_size:,} bytes"
+        )
+        return removed
+
+
+def _db_create_journal(conn: sql.Connection) -> None:
+    """
+    Create the fetch journal table if it does not exist yet, adding the sections column
+    to journals written before it existed
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    """
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {JOURNAL_TABLE} ("
+        "month TEXT PRIMARY KEY, status TEXT NOT NULL, attempts INTEGER NOT NULL, "
+        "last_error TEXT, updated_at TEXT NOT NULL, sections TEXT)"
+    )
+    if "sections" not in db_table_columns(conn, JOURNAL_TABLE):
+        conn.execute(f"ALTER TABLE {JOURNAL_TABLE} ADD COLUMN sections TEXT")
+
+
+def db_read_journal(db_filepath: str) -> dict:
+    """
+    Read the fetch journal written by DbBatchWriter.record_fetch
+
+    :param db_filepath: database filepath
+    :type db_filepath: str
+    :return: journal entries keyed by month, each a dict of status, attempts, last_error,
+        updated_at and sections (report sections found, None if not recorded)
+    :rtype: dict
+    """
+    if not Path(db_filepath).is_file():
+        return {}
+    with db_connection(db_filepath) as conn:
+        if not db_table_exists(conn, JOURNAL_TABLE):
+            return {}
+        has_sections = "sections" in db_table_columns(conn, JOURNAL_TABLE)
+        rows = conn.execute(
+            f"SELECT month, status, attempts, last_error, updated_at, "
+            f"{'sections' if has_sections else 'NULL'} FROM {JOURNAL_TABLE}"
+        ).fetchall()
+    return {
+        datetime.strptime(month, "%Y-%m").date(): {
+            "status": status,
+            "attempts": attempts,
+            "last_error": last_error,
+            "updated_at": datetime.fromisoformat(updated_at),
+            "sections": None if sections is None else sections.split(","),
+        }
+        for month, status, attempts, last_error, updated_at, sections in rows
+    }
+
+
+def _db_prepare_table(
+    conn: sql.Connection, db_table: str, df_to_write: pd.DataFrame, known: set = None
+) -> set:
+    """
+    Create the table from the dataframe's index and columns if it does not exist yet,
+    migrate a table created without a primary key, and add any new columns
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: database table to prepare
+    :type db_table: str
+    :param df_to_write: dataframe whose index and columns define the table
+    :type df_to_write: pd.DataFrame
+    :param known: columns already known to exist, None if the table was not checked yet
+    :type known: set
+    :return: columns of the table
+    :rtype: set
+    """
+    key = df_to_write.index.name or "index"
+    if known is None:
+        if not db_table_exists(conn, db_table):
+            columns = {key: _sql_type(df_to_write.index.dtype)}
+            columns.update({c: _sql_type(t) for c, t in df_to_write.dtypes.items()})
+            _db_create_table(conn, db_table, columns)
+            _db_create_rank_indexes(conn, db_table)
+        elif not db_table_is_current(conn, db_table, key):
+            _db_migrate_table(conn, db_table, key)
+        known = set(db_table_columns(conn, db_table))
+    new_columns = [c for c in df_to_write.columns if c not in known]
+    for column in new_columns:
+        conn.execute(
+            f"ALTER TABLE {db_table} ADD COLUMN {quote_identifier(column)} "
+            f"{_sql_type(df_to_write[column].dtype)}"
+        )
+        known.add(column)
+        logger.info(f"Added column {column} to {db_table}")
+    if new_columns:
+        _db_create_rank_indexes(conn, db_table)
+    return known
+
+
+def _db_upsert(conn: sql.Connection, db_table: str, df_to_write: pd.DataFrame) -> None:
+    """
+    Insert the dataframe's rows, updating rows whose key is already stored
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: database table to write
+    :type db_table: str
+    :param df_to_write: rows keyed by the dataframe's index
+    :type df_to_write: pd.DataFrame
+    """
+    key = df_to_write.index.name or "index"
+    columns = [key, *df_to_write.columns]
+    placeholders = ", ".join("?" * len(columns))
+    updates = ", ".join(
+        f"{quote_identifier(c)} = excluded.{quote_identifier(c)}"
+        for c in df_to_write.columns
+    )
+    conn.executemany(
+        f"INSERT INTO {db_table} ({', '.join(map(quote_identifier, columns))}) "
+        f"VALUES ({placeholders}) "
+        f"ON CONFLICT ({quote_identifier(key)}) DO UPDATE SET {updates}",
+        zip(
+            _encode_values(df_to_write.index),
+            *(_encode_values(df_to_write[c]) for c in df_to_write.columns),
+        ),
+    )
+
+
+def _db_update_aggregates(
+    conn: sql.Connection, db_table: str, dates: pd.DatetimeIndex, known: dict
+) -> None:
+    """
+    Recompute the monthly and yearly aggregate rows for the periods holding the given
+    dates from the stored daily rows, so revised days are reflected too. Only the
+    affected years are read.
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: volume table the dates were written to
+    :type db_table: str
+    :param dates: dates just written
+    :type dates: pd.DatetimeIndex
+    :param known: known columns by table, updated for the aggregate tables
+    :type known: dict
+    """
+    daily_df = _decode_dates(
+        pd.read_sql_query(
+            f'SELECT * FROM {db_table} WHERE "Date" BETWEEN ? AND ?',
+            conn,
+            params=(
+                _encode_date(f"{dates.year.min()}-01-01"),
+                _encode_date(f"{dates.year.max()}-12-31"),
+            ),
+        )
+    )
+    months = daily_df.index.to_period("M").isin(set(dates.to_period("M")))
+    for granularity, period_df in (("month", daily_df[months]), ("year", daily_df)):
+        aggregate_df = common.dataframe.volume_aggregate_df(period_df, granularity)
+        table = aggregate_table(db_table, granularity)
+        known[table] = _db_prepare_table(conn, table, aggregate_df, known.get(table))
+        _db_upsert(conn, table, aggregate_df)
+
+
+def _db_rebuild_aggregates(conn: sql.Connection, db_table: str) -> None:
+    """
+    Build the aggregate tables of a volume table from all of its daily rows
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: volume table
+    :type db_table: str
+    """
+    daily_df = _decode_dates(pd.read_sql_query(f"SELECT * FROM {db_table}", conn))
+    for granularity in AGGREGATE_SUFFIXES:
+        table = aggregate_table(db_table, granularity)
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+        if daily_df.empty:
+            continue
+        aggregate_df = common.dataframe.volume_aggregate_df(daily_df, granularity)
+        _db_prepare_table(conn, table, aggregate_df)
+        _db_upsert(conn, table, aggregate_df)
+    logger.info(f"Built monthly and yearly aggregates of {db_table}")
+
+
+class DbBatchWriter:
+    """
+    Write many dataframes to SQLite tables over a single connection.
+
+    Rows are upserted with executemany and committed every batch_size frames written to
+    db_table; frames for other tables (e.g. futures) join the current batch, so a crash
+    loses at most one uncommitted batch. The connection is only opened on the first write.
+    Use as a context manager; the final partial batch is committed on a clean exit and
+    rolled back if an exception escapes. The writer has a connection of its own, so
+    db_connection callers, in any thread, only ever see committed batches and can never
+    commit or roll back the writer's.
+    """
+
+    def __init__(
+        self, db_filepath: str, db_table: str, batch_size: int = WRITE_BATCH_SIZE
+    ):
+        """
+        :param db_filepath: database filepath
+        :type db_filepath: str
+        :param db_table: database table to write
+        :type db_table: str
+        :param batch_size: number of frames to write per transaction
+        :type batch_size: int
+        """
+        validate_table_name(db_table)
+        self.db_filepath = db_filepath
+        self.db_table = db_table
+        self.batch_size = max(batch_size, 1)
+        self.conn = None
+        self._table_columns = {}
+        self._journal_ready = False
+        self._pending_frames = 0
+        self._pending_rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.conn is None:
+            return
+        if exc_type is None:
+            self.flush()
+        else:
+            logger.warning(
+                f"Rolling back {self._pending_frames} unwritten frames to {self.db_filepath}"
+            )
+            self.conn.rollback()
+        self.conn.close()
+        self.conn = None
+
+    def _connect(self) -> sql.Connection:
+        """
+        Open the writer's connection on first use
+
+        :return: open database connection
+        :rtype: sql.Connection
+        """
+        if self.conn is None:
+            self.conn = _open_connection(os.path.abspath(self.db_filepath))
+        return self.conn
+
+    def write(self, df_to_write: pd.DataFrame, db_table: str = None) -> None:
+        """
+        Queue a dataframe for writing, committing once a full batch is pending.
+        Rows whose date is already stored are updated in place, and the table's monthly
+        and yearly aggregates are updated in the same transaction.
+
+        :param df_to_write: dataframe to write
+        :type df_to_write: pd.DataFrame
+        :param db_table: database table to write, defaults to the writer's table
+        :type db_table: str
+        """
+        if df_to_write is None or len(df_to_write) == 0:
+            return
+        db_table = db_table or self.db_table
+        validate_table_name(db_table)
+        self._connect()
+        self._table_columns[db_table] = _db_prepare_table(
+            self.conn, db_table, df_to_write, self._table_columns.get(db_table)
+        )
+        _db_upsert(self.conn, db_table, df_to_write)
+        if isinstance(df_to_write.index, pd.DatetimeIndex):
+            _db_update_aggregates(self.conn, db_table, df_to_write.index, self._table_columns)
+        self._pending_rows += len(df_to_write)
+        if db_table != self.db_table:
+            return
+        self._pending_frames += 1
+        if self._pending_frames >= self.batch_size:
+            self.flush()
+
+    def record_fetch(self, month: date, status: str, error: str = None, sections: list = None) -> None:
+        """
+        Record the outcome of fetching a month in the journal table, committed together
+        with the next batch of frames
+
+        :param month: fetched month
+        :type month: date
+        :param status: "ok", "failed" (transient, retry later) or "unavailable" (permanent)
+        :type status: str
+        :param error: error message for failed or unavailable months
+        :type error: str
+        :param sections: sections found in the month's report, e.g. ["contracts", "futures"],
+            None to keep those recorded before
+        :type sections: list
+        """
+        self._connect()
+        if not self._journal_ready:
+            _db_create_journal(self.conn)
+            self._journal_ready = True
+        self.conn.execute(
+            f"INSERT INTO {JOURNAL_TABLE} (month, status, attempts, last_error, updated_at, sections) "
+            "VALUES (?, ?, 1, ?, ?, ?) "
+            "ON CONFLICT (month) DO UPDATE SET status = excluded.status, "
+            "attempts = attempts + 1, last_error = excluded.last_error, "
+            "updated_at = excluded.updated_at, sections = COALESCE(excluded.sections, sections)",
+            (
+                month.strftime("%Y-%m"),
+                status,
+                error,
+                datetime.now().isoformat(timespec="seconds"),
+                None if sections is None else ",".join(sections),
+            ),
+        )
+
+    def flush(self) -> None:
+        """
+        Commit all pending frames and journal entries
+        """
+        if self.conn is None or not self.conn.in_transaction:
+            return
+        if self._pending_rows:
+            _db_bump_version(self.conn)
+        self.conn.commit()
+        logger.debug(
+            f"Committed {self._pending_rows:,} rows from {self._pending_frames} frames to {self.db_filepath}"
         )
+        self._pending_frames = 0
+        self._pending_rows = 0
+
+
+def db_write_dfs_to_sql(
+    db_filepath: str,
+    db_table: str,
+    dfs_to_write,
+    batch_size: int = WRITE_BATCH_SIZE,
+) -> None:
+    """
+    Write many dataframes (e.g. one per month) to SQLite DB file in batched transactions
+
+    :param db_filepath: database filepath
+    :type db_filepath: str
+    :param db_table: database table to write
+    :type db_table: str
+    :param dfs_to_write: iterable of dataframes to write
+    :param batch_size: number of frames to write per transaction
+    :type batch_size: int
+    :return: None
+    """
+    with DbBatchWriter(db_filepath, db_table, batch_size=batch_size) as writer:
+        for df_to_write in dfs_to_write:
+            writer.write(df_to_write)
+    logger.debug(f"Successfully wrote to DB {db_filepath}")
 
 
 def db_write_df_to_sql(db_filepath: str, db_table: str, df_to_write: pd.DataFrame) -> None:
     """
-    Write given dataframe to SQLite DB file
+    Write given dataframe to SQLite DB file, replacing rows already stored for the same dates
 
     :param db_filepath: database filepath
     :type db_filepath: str
@@ -34,47 +765,347 @@ def db_write_df_to_sql(db_filepath: str, db_table: str, df_to_write: pd.DataFram
     :type df_to_write: pd.DataFrame
     :return: None
     """
-    _validate_table_name(db_table)
-    df_len = len(df_to_write)
-    logger.debug(f"Starting write of {df_len:,} rows to {db_filepath}")
+    logger.debug(f"Starting write of {len(df_to_write):,} rows to {db_filepath}")
+    db_write_dfs_to_sql(db_filepath, db_table, [df_to_write])
 
-    with sql.connect(db_filepath) as conn:
-        df_to_write.to_sql(name=db_table, con=conn, if_exists="append")
 
-    logger.debug(f"Successfully wrote to DB {db_filepath}")
+def _encode_date(value) -> int:
+    """
+    Day number a date is stored as
+
+    :param value: date, datetime, Timestamp or ISO date string
+    :return: days since 1970-01-01
+    :rtype: int
+    """
+    return int(pd.Timestamp(value).to_datetime64().astype("datetime64[D]").astype("int64"))
+
+
+def _db_date_filter(start=None, end=None) -> tuple:
+    """
+    WHERE clause selecting rows between two dates, inclusive
+
+    :param start: first date, None for no lower bound
+    :param end: last date, None for no upper bound
+    :return: (SQL clause, possibly empty, and its parameters)
+    :rtype: tuple
+    """
+    return db_day_filter(
+        None if start is None else _encode_date(start),
+        None if end is None else _encode_date(end),
+    )
+
+
+def _db_column_dtypes(conn: sql.Connection, db_table: str, columns: list, downcast: bool = False) -> dict:
+    """
+    Dtypes to read columns as, decided once for the whole table so every chunk agrees.
+    INTEGER columns are int64 unless they hold NULLs (float64); with downcast they use
+    the smallest integer type that fits the stored minimum and maximum. The checks use
+    the rank indexes, so they do not scan the table.
+
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :param db_table: database table
+    :type db_table: str
+    :param columns: columns to type
+    :type columns: list
+    :param downcast: use the smallest safe integer types
+    :type downcast: bool
+    :return: dtypes by column
+    :rtype: dict
+    """
+    declared = {row[1]: row[2].upper() for row in conn.execute(f"PRAGMA table_info({db_table})")}
+    dtypes = {}
+    for column in columns:
+        quoted = quote_identifier(column)
+        if declared[column] == "REAL":
+            dtypes[column] = "float64"
+            continue
+        if declared[column] != "INTEGER":
+            continue
+        has_nulls = conn.execute(
+            f"SELECT EXISTS (SELECT 1 FROM {db_table} WHERE {quoted} IS NULL)"
+        ).fetchone()[0]
+        if has_nulls:
+            dtypes[column] = "float64"
+            continue
+        dtypes[column] = "int64"
+        if downcast:
+            low, high = conn.execute(f"SELECT MIN({quoted}), MAX({quoted}) FROM {db_table}").fetchone()
+            for candidate in ("int8", "int16", "int32"):
+                info = np.iinfo(candidate)
+                if low is not None and info.min <= low and high <= info.max:
+                    dtypes[column] = candidate
+                    break
+    return dtypes
 
 
-def db_read_sql_to_df(db_filepath: str, db_table: str) -> pd.DataFrame:
+def db_read_sql_to_df(
+    db_filepath: str,
+    db_table: str,
+    columns: list = None,
+    start=None,
+    end=None,
+    chunksize: int = None,
+    dtype: dict = None,
+    downcast: bool = False,
+):
     """
-    Read given DB file into dataframe
+    Read given DB file into dataframe, decoding stored day numbers into a date index.
+    Only the requested columns and dates are read, and with chunksize the rows arrive
+    as an iterator of dataframes so the whole table is never held at once.
 
     :param db_filepath: database filepath
     :type db_filepath: str
     :param db_table: database table to read
     :type db_table: str
-    :return: dataframe containing database contents
+    :param columns: columns to read besides Date, None for all
+    :type columns: list
+    :param start: first date to read, None for the oldest
+    :param end: last date to read, None for the newest
+    :param chunksize: number of rows per dataframe, None to read everything at once
+    :type chunksize: int
+    :param dtype: dtypes by column, overriding the ones derived from the table schema
+    :type dtype: dict
+    :param downcast: read integer columns as the smallest integer type that fits them
+    :type downcast: bool
+    :return: dataframe containing database contents, or an iterator of dataframes with chunksize
     :rtype: pd.DataFrame
     """
-    _validate_table_name(db_table)
+    validate_table_name(db_table)
+    if not Path(db_filepath).is_file():
+        logger.warning(f"Unable to find {db_filepath}, returning empty dataframe")
+        return iter([]) if chunksize else pd.DataFrame()
+    logger.debug(f"Attemping to read DB {db_table} from file {db_filepath}")
+    if not chunksize:
+        with db_connection(db_filepath) as conn:
+            built = _db_read_query(conn, db_table, columns, start, end, dtype, downcast)
+            if built is None:
+                return pd.DataFrame()
+            query, params, dtypes = built
+            out_df = _decode_dates(pd.read_sql_query(query, conn, params=params, dtype=dtypes))
+        logger.debug(f"Successfully read {len(out_df)} rows")
+        return out_df
+    # Chunks are read on a connection of their own, so the shared one is not held
+    # while the caller works on each chunk
+    conn = _open_connection(os.path.abspath(db_filepath))
+    try:
+        built = _db_read_query(conn, db_table, columns, start, end, dtype, downcast)
+    except BaseException:
+        conn.close()
+        raise
+    if built is None:
+        conn.close()
+        return iter([])
+    return _db_read_chunks(conn, *built, chunksize)
 
-    if Path(db_filepath).is_file():
-        logger.debug(f"Attemping to read DB {db_table} from file {db_filepath}")
 
-        with sql.connect(db_filepath) as conn:
-            out_df = pd.read_sql_query(
-                f"SELECT * from {db_table}",
-                conn,
-                index_col="Date",
-                parse_dates=["Date"],
-            )
+def _db_read_query(conn: sql.Connection, db_table: str, columns, start, end, dtype, downcast):
+    """
+    Build the query of db_read_sql_to_df, checking the requested columns
 
-        logger.debug(f"Successfully read {len(out_df)} rows")
-    else:
+    :param conn: open database connection
+    :type conn: sql.Connection
+    :return: (query, parameters, dtypes by column), or None if the table does not exist
+    :rtype: tuple
+    :raises ValueError: if a requested column is not in the table
+    """
+    if not db_table_exists(conn, db_table):
+        logger.warning(f"Unable to find table {db_table}, returning empty dataframe")
+        return None
+    table_columns = db_table_columns(conn, db_table)[1:]
+    if columns is None:
+        columns = table_columns
+    unknown = [c for c in columns if c not in table_columns]
+    if unknown:
+        raise ValueError(
+            f"Unknown column '{unknown[0]}', expected one of: {', '.join(table_columns)}"
+        )
+    dtypes = {**_db_column_dtypes(conn, db_table, columns, downcast), **(dtype or {})}
+    where, params = _db_date_filter(start, end)
+    query = (
+        f"SELECT {', '.join(map(quote_identifier, ['Date', *columns]))} "
+        f"FROM {db_table}{where} ORDER BY \"Date\""
+    )
+    return query, params, dtypes
+
+
+def _db_read_chunks(conn: sql.Connection, query: str, params: list, dtypes: dict, chunksize: int):
+    """
+    Dataframes of a query read chunksize rows at a time, from one consistent read of the
+    database, closing the connection after the last one
+
+    :param conn: connection to read on, owned by the generator
+    :type conn: sql.Connection
+    :return: dataframes indexed by Date
+    :rtype: Iterator[pd.DataFrame]
+    """
+    try:
+        for chunk in pd.read_sql_query(query, conn, params=params, chunksize=chunksize, dtype=dtypes):
+            yield _decode_dates(chunk)
+    finally:
+        conn.close()
+
+
+def db_read_months(db_filepath: str, db_table: str) -> set:
+    """
+    Read which months have at least one row, with a single aggregate query
+
+    :param db_filepath: database filepath
+    :type db_filepath: str
+    :param db_table: database table to read
+    :type db_table: str
+    :return: first day of each stored month
+    :rtype: set
+    """
+    validate_table_name(db_table)
+    if not Path(db_filepath).is_file():
+        return set()
+    with db_connection(db_filepath) as conn:
+        if not db_table_exists(conn, db_table):
+            return set()
+        rows = conn.execute(
+            f"SELECT strftime('%Y-%m', \"Date\" * 86400, 'unixepoch') FROM {db_table} GROUP BY 1"
+        ).fetchall()
+    return {datetime.strptime(row[0], "%Y-%m").date() for row in rows}
+
+
+def db_query_top_n(
+    db_filepath: str,
+    db_table: str,
+    number: int,
+    column: str = "OCC Total",
+    granularity: str = "day",
+    by: str = None,
+    start=None,
+    end=None,
+    last: int = None,
+) -> pd.DataFrame:
+    """
+    Read the rows with the largest values in a column, ranked by SQLite using the column's
+    index so only the requested rows are loaded. Months and years are ranked by their
+    total from the aggregate tables, returning the column's statistics and trading days.
+    With by, the top rows of each year, month or weekday are selected in one pass with
+    a window function and returned group by group.
+
+    A date window is searched on the primary key, so only rows inside it are ranked.
+    Months and years are included if they overlap the window.
+
+    Results are kept in the database's query cache, see configure_query_cache, until the
+    next write changes the version token.
+
+    :param db_filepath: database filepath
+    :type db_filepath: str
+    :param db_table: database table to read
+    :type db_table: str
+    :param number: number of rows to return, per group with by
+    :type number: int
+    :param column: column to rank by
+    :type column: str
+    :param granularity: "day", "month" or "year"
+    :type granularity: str
+    :param by: "year", "month" or "weekday" to rank within each group, None to rank overall
+    :type by: str
+    :param start: first date of the window, None for the oldest
+    :param end: last date of the window, None for the newest
+    :param last: only rank the latest rows of the window, None for all of them
+    :type last: int
+    :return: top rows, largest first
+    :rtype: pd.DataFrame
+    """
+    if not Path(db_filepath).is_file():
+        validate_table_name(db_table)
         logger.warning(f"Unable to find {db_filepath}, returning empty dataframe")
-        out_df = pd.DataFrame()
+        return pd.DataFrame()
 
+    with db_connection(db_filepath) as conn:
+        result = db_cached_top_n(
+            conn,
+            db_table,
+            number,
+            column=column,
+            granularity=granularity,
+            by=by,
+            start=None if start is None else pd.Timestamp(start),
+            end=None if end is None else pd.Timestamp(end),
+            last=last,
+            max_entries=_query_cache_entries,
+        )
+    if result is None:
+        table = db_table if granularity == "day" else aggregate_table(db_table, granularity)
+        logger.warning(f"Unable to find table {table}, returning empty dataframe")
+        return pd.DataFrame()
+    columns, rows = result
+    out_df = _decode_dates(pd.DataFrame.from_records(rows, columns=columns))
+    logger.debug(f"Read top {len(out_df)} rows by {column} from {db_table}" + (f" per {by}" if by else ""))
     return out_df
 
 
+def db_drop_table(db_filepath: str, db_table: str) -> None:
+    """
+    Drop the given table and its aggregate tables from the SQLite DB file, if they exist
+
+    :param db_filepath: database filepath
+    :type db_filepath: str
+    :param db_table: database table to drop
+    :type db_table: str
+    """
+    validate_table_name(db_table)
+    with db_connection(db_filepath) as conn:
+        conn.execute(f"DROP TABLE IF EXISTS {db_table}")
+        for granularity in AGGREGATE_SUFFIXES:
+            conn.execute(f"DROP TABLE IF EXISTS {aggregate_table(db_table, granularity)}")
+        _db_bump_version(conn)
+    logger.debug(f"Dropped table {db_table} from {db_filepath}")
+
+
+def db_read_validators(db_filepath: str) -> dict:
+    """
+    Read HTTP cache validators saved by an earlier run
+
+    :param db_filepath: database filepath
+    :type db_filepath: str
+    :return: validators keyed by request url
+    :rtype: dict
+    """
+    if not Path(db_filepath).is_file():
+        return {}
+    with db_connection(db_filepath) as conn:
+        if not db_table_exists(conn, VALIDATORS_TABLE):
+            return {}
+        rows = conn.execute(
+            f'SELECT url, etag, last_modified FROM {VALIDATORS_TABLE}'
+        ).fetchall()
+    validators = {}
+    for url, etag, last_modified in rows:
+        validators[url] = {
+            k: v for k, v in (("ETag", etag), ("Last-Modified", last_modified)) if v
+        }
+    logger.debug(f"Read {len(validators)} cache validators from {db_filepath}")
+    return validators
+
+
+def db_write_validators(db_filepath: str, validators: dict) -> None:
+    """
+    Save HTTP cache validators so later runs can send conditional requests
+
+    :param db_filepath: database filepath
+    :type db_filepath: str
+    :param validators: validators keyed by request url
+    :type validators: dict
+    """
+    rows = [
+        (url, v.get("ETag"), v.get("Last-Modified")) for url, v in validators.items()
+    ]
+    with db_connection(db_filepath) as conn:
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {VALIDATORS_TABLE} "
+            "(url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)"
+        )
+        conn.executemany(
+            f"INSERT OR REPLACE INTO {VALIDATORS_TABLE} VALUES (?, ?, ?)", rows
+        )
+    logger.debug(f"Saved {len(rows)} cache validators to {db_filepath}")
+
+
 if __name__ == "__main__":
     print("This file cannot be run directly.")
@@ -0,0 +1,667 @@
+"""
+Storage backends for the volume history
+
+The updater and the CLI only talk to a Storage. SqliteStorage keeps everything in one
+SQLite file through common.sqlite; ParquetStorage keeps each table as year-partitioned
+Parquet files, so analytical reads only touch the columns and years they need.
+"""
+import json
+import logging
+import os
+import shutil
+import uuid
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+from pathlib import Path
+
+import pandas as pd
+
+import common.cache
+import common.dataframe
+import common.schema
+import common.sqlite
+
+logger = logging.getLogger(__name__)
+
+# Storage backends selectable with database.backend in the config file
+BACKENDS = ("sqlite", "parquet")
+
+
+class Storage(ABC):
+    """
+    Interface shared by the storage backends.
+
+    A backend stores the contracts table (db_table) and optionally the futures table
+    (futures_table), plus the fetch journal and HTTP cache validators used by the updater.
+    """
+
+    db_table = None
+    futures_table = None
+
+    def tables(self) -> list:
+        """
+        Volume tables kept by this storage
+
+        :return: table names, contracts table first
+        :rtype: list
+        """
+        return [t for t in (self.db_table, self.futures_table) if t]
+
+    def dataset_table(self, dataset: str) -> str:
+        """
+        Table holding a dataset
+
+        :param dataset: "contracts" or "futures"
+        :type dataset: str
+        :return: table name, None if the dataset is not stored
+        :rtype: str
+        """
+        return self.futures_table if dataset == "futures" else self.db_table
+
+    def migrate(self) -> None:
+        """
+        Bring stored tables up to the current schema
+        """
+
+    @abstractmethod
+    def writer(self, batch_size: int = None):
+        """
+        Open a batch writer, a context manager with write(df, db_table=None) and
+        record_fetch(month, status, error=None, sections=None) like common.sqlite.DbBatchWriter
+
+        :param batch_size: months written per batch, None for the configured write_batch_size
+        :type batch_size: int
+        """
+
+    @abstractmethod
+    def read_months(self, db_table: str = None) -> set:
+        """
+        :param db_table: table to read, defaults to the contracts table
+        :type db_table: str
+        :return: first day of each month stored in the table
+        :rtype: set
+        """
+
+    @abstractmethod
+    def read_table(self, db_table: str = None, columns: list = None, start=None, end=None) -> pd.DataFrame:
+        """
+        :param db_table: table to read, defaults to the contracts table
+        :type db_table: str
+        :param columns: columns to read besides Date, None for all
+        :type columns: list
+        :param start: first date to read, None for the oldest
+        :param end: last date to read, None for the newest
+        :return: rows indexed by Date, oldest first
+        :rtype: pd.DataFrame
+        """
+
+    @abstractmethod
+    def read_version(self):
+        """
+        :return: token that changes whenever stored volume data changes, None if nothing is stored
+        :rtype: str
+        """
+
+    @abstractmethod
+    def read_journal(self) -> dict:
+        """
+        :return: fetch journal entries keyed by month, see common.sqlite.db_read_journal
+        :rtype: dict
+        """
+
+    @abstractmethod
+    def read_validators(self) -> dict:
+        """
+        :return: HTTP cache validators keyed by request url
+        :rtype: dict
+        """
+
+    @abstractmethod
+    def write_validators(self, validators: dict) -> None:
+        """
+        :param validators: HTTP cache validators keyed by request url
+        :type validators: dict
+        """
+
+    @abstractmethod
+    def query_top_n(
+        self,
+        number: int,
+        column: str = "OCC Total",
+        db_table: str = None,
+        granularity: str = "day",
+        by: str = None,
+        start=None,
+        end=None,
+        last: int = None,
+    ) -> pd.DataFrame:
+        """
+        :param number: number of rows to return, per group with by
+        :type number: int
+        :param column: column to rank by
+        :type column: str
+        :param db_table: table to read, defaults to the contracts table
+        :type db_table: str
+        :param granularity: "day", or "month" or "year" to rank periods by their total
+        :type granularity: str
+        :param by: "year", "month" or "weekday" to rank within each group, None to rank overall
+        :type by: str
+        :param start: first date of the window, None for the oldest
+        :param end: last date of the window, None for the newest
+        :param last: only rank the latest rows of the window, None for all of them
+        :type last: int
+        :return: top rows, largest first
+        :rtype: pd.DataFrame
+        """
+
+    @abstractmethod
+    def drop(self, db_table: str) -> None:
+        """
+        :param db_table: table to remove with all its rows
+        :type db_table: str
+        """
+
+
+class SqliteStorage(Storage):
+    """
+    Storage in a single SQLite file, see common.sqlite
+    """
+
+    def __init__(
+        self,
+        db_filepath: str,
+        db_table: str,
+        futures_table: str = None,
+        write_batch_size: int = common.sqlite.WRITE_BATCH_SIZE,
+    ):
+        """
+        :param db_filepath: database filepath
+        :type db_filepath: str
+        :param db_table: contracts table
+        :type db_table: str
+        :param futures_table: futures table, None to not store futures
+        :type futures_table: str
+        :param write_batch_size: number of months committed per transaction
+        :type write_batch_size: int
+        """
+        self.db_filepath = db_filepath
+        self.db_table = db_table
+        self.futures_table = futures_table
+        self.write_batch_size = write_batch_size
+
+    def migrate(self) -> None:
+        for table in self.tables():
+            common.sqlite.db_migrate_table(db_filepath=self.db_filepath, db_table=table)
+
+    def writer(self, batch_size: int = None) -> common.sqlite.DbBatchWriter:
+        return common.sqlite.DbBatchWriter(
+            self.db_filepath, self.db_table, batch_size=batch_size or self.write_batch_size
+        )
+
+    def read_months(self, db_table: str = None) -> set:
+        return common.sqlite.db_read_months(db_filepath=self.db_filepath, db_table=db_table or self.db_table)
+
+    def read_table(self, db_table: str = None, columns: list = None, start=None, end=None) -> pd.DataFrame:
+        return common.sqlite.db_read_sql_to_df(
+            db_filepath=self.db_filepath,
+            db_table=db_table or self.db_table,
+            columns=columns,
+            start=start,
+            end=end,
+        )
+
+    def read_version(self):
+        return common.sqlite.db_read_version(self.db_filepath)
+
+    def read_journal(self) -> dict:
+        return common.sqlite.db_read_journal(db_filepath=self.db_filepath)
+
+    def read_validators(self) -> dict:
+        return common.sqlite.db_read_validators(self.db_filepath)
+
+    def write_validators(self, validators: dict) -> None:
+        common.sqlite.db_write_validators(self.db_filepath, validators)
+
+    def query_top_n(
+        self,
+        number: int,
+        column: str = "OCC Total",
+        db_table: str = None,
+        granularity: str = "day",
+        by: str = None,
+        start=None,
+        end=None,
+        last: int = None,
+    ) -> pd.DataFrame:
+        return common.sqlite.db_query_top_n(
+            db_filepath=self.db_filepath,
+            db_table=db_table or self.db_table,
+            number=number,
+            column=column,
+            granularity=granularity,
+            by=by,
+            start=start,
+            end=end,
+            last=last,
+        )
+
+    def drop(self, db_table: str) -> None:
+        common.sqlite.db_drop_table(db_filepath=self.db_filepath, db_table=db_table)
+
+
+def _import_pyarrow():
+    """
+    Import pyarrow, which is only needed by the Parquet backend
+
+    :return: pyarrow.dataset module
+    :raises ImportError: if pyarrow is not installed
+    """
+    try:
+        import pyarrow.dataset
+    except ImportError as e:
+        raise ImportError("The parquet storage backend requires pyarrow: pip install pyarrow") from e
+    return pyarrow.dataset
+
+
+def _pa_scalar(value, pa_type):
+    """
+    Date as a pyarrow scalar of the stored Date type, for filter expressions
+
+    :param value: date, datetime, Timestamp or ISO date string
+    :param pa_type: pyarrow type of the Date column
+    :return: pyarrow scalar
+    """
+    import pyarrow
+    return pyarrow.scalar(pd.Timestamp(value).to_pydatetime(), type=pa_type)
+
+
+class ParquetBatchWriter:
+    """
+    Batch writer for ParquetStorage with the same interface as common.sqlite.DbBatchWriter.
+
+    Frames are buffered and merged into their year partitions every batch_size frames
+    written to the contracts table, replacing each partition file atomically. Rows whose
+    date is already stored are replaced. Buffered frames are discarded if an exception escapes.
+    """
+
+    def __init__(self, storage, batch_size: int = common.sqlite.WRITE_BATCH_SIZE):
+        """
+        :param storage: storage to write to
+        :type storage: ParquetStorage
+        :param batch_size: number of frames to buffer before writing
+        :type batch_size: int
+        """
+        self.storage = storage
+        self.batch_size = max(batch_size, 1)
+        self._pending = {}
+        self._pending_frames = 0
+        self._journal = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        elif self._pending_frames:
+            logger.warning(
+                f"Discarding {self._pending_frames} unwritten frames to {self.storage.data_dir}"
+            )
+
+    def write(self, df_to_write: pd.DataFrame, db_table: str = None) -> None:
+        """
+        Queue a dataframe for writing, writing once a full batch is pending
+
+        :param df_to_write: dataframe indexed by Date
+        :type df_to_write: pd.DataFrame
+        :param db_table: table to write, defaults to the contracts table
+        :type db_table: str
+        """
+        if df_to_write is None or len(df_to_write) == 0:
+            return
+        db_table = db_table or self.storage.db_table
+        common.schema.validate_table_name(db_table)
+        self._pending.setdefault(db_table, []).append(df_to_write)
+        if db_table != self.storage.db_table:
+            return
+        self._pending_frames += 1
+        if self._pending_frames >= self.batch_size:
+            self.flush()
+
+    def record_fetch(self, month: date, status: str, error: str = None, sections: list = None) -> None:
+        """
+        Record the outcome of fetching a month, written together with the next batch
+
+        :param month: fetched month
+        :type month: date
+        :param status: "ok", "failed" (transient, retry later) or "unavailable" (permanent)
+        :type status: str
+        :param error: error message for failed or unavailable months
+        :type error: str
+        :param sections: sections found in the month's report, e.g. ["contracts", "futures"],
+            None to keep those recorded before
+        :type sections: list
+        """
+        if self._journal is None:
+            self._journal = self.storage._read_journal_raw()
+        key = month.strftime("%Y-%m")
+        previous = self._journal.get(key, {})
+        attempts = previous.get("attempts", 0) + 1
+        self._journal[key] = {
+            "status": status,
+            "attempts": attempts,
+            "last_error": error,
+            "updated_at": datetime.now().isoformat(timespec="seconds"),
+            "sections": previous.get("sections") if sections is None else sections,
+        }
+
+    def flush(self) -> None:
+        """
+        Merge all pending frames into their partitions, then save the journal
+        """
+        for db_table, frames in self._pending.items():
+            self.storage._merge(db_table, pd.concat(frames))
+        if self._journal is not None:
+            common.cache._atomic_write(
+                self.storage._journal_path(), json.dumps(self._journal, indent=1).encode()
+            )
+        logger.debug(
+            f"Wrote {sum(len(f) for fs in self._pending.values() for f in fs):,} rows "
+            f"from {self._pending_frames} frames to {self.storage.data_dir}"
+        )
+        if self._pending:
+            self.storage._bump_version()
+        self._pending = {}
+        self._pending_frames = 0
+
+
+class ParquetStorage(Storage):
+    """
+    Storage as year-partitioned Parquet files, one directory per table:
+    <data_dir>/<table>/year=YYYY/part-0.parquet. The fetch journal and cache
+    validators are small JSON files in data_dir. Requires pyarrow.
+    """
+
+    def __init__(
+        self,
+        data_dir: str,
+        db_table: str,
+        futures_table: str = None,
+        write_batch_size: int = common.sqlite.WRITE_BATCH_SIZE,
+    ):
+        """
+        :param data_dir: directory holding the tables
+        :type data_dir: str
+        :param db_table: contracts table
+        :type db_table: str
+        :param futures_table: futures table, None to not store futures
+        :type futures_table: str
+        :param write_batch_size: number of months buffered per write
+        :type write_batch_size: int
+        """
+        for table in (db_table, futures_table):
+            if table:
+                common.schema.validate_table_name(table)
+        self.data_dir = Path(data_dir)
+        self.db_table = db_table
+        self.futures_table = futures_table
+        self.write_batch_size = write_batch_size
+
+    def _table_dir(self, db_table: str) -> Path:
+        """
+        Directory holding a table's partitions
+        """
+        return self.data_dir / db_table
+
+    def _partition_path(self, db_table: str, year: int) -> Path:
+        """
+        File holding one year of a table
+        """
+        return self._table_dir(db_table) / f"year={year}" / "part-0.parquet"
+
+    def _journal_path(self) -> Path:
+        """
+        File holding the fetch journal
+        """
+        return self.data_dir / f"{common.sqlite.JOURNAL_TABLE}.json"
+
+    def _validators_path(self) -> Path:
+        """
+        File holding the HTTP cache validators
+        """
+        return self.data_dir / f"{common.sqlite.VALIDATORS_TABLE}.json"
+
+    def _dataset(self, db_table: str):
+        """
+        Open a table as a pyarrow dataset
+
+        :param db_table: table to open
+        :type db_table: str
+        :return: dataset, or None if the table has no files
+        """
+        pa_dataset = _import_pyarrow()
+        table_dir = self._table_dir(db_table)
+        if not any(table_dir.glob("year=*/*.parquet")):
+            return None
+        return pa_dataset.dataset(table_dir, format="parquet", partitioning="hive")
+
+    def _read(
+        self, db_table: str, columns: list = None, years: list = None, start=None, end=None
+    ) -> pd.DataFrame:
+        """
+        Read a table, loading only the given columns, year partitions and dates
+
+        :param db_table: table to read
+        :type db_table: str
+        :param columns: columns to load besides Date, None for all
+        :type columns: list
+        :param years: year partitions to load, None for all
+        :type years: list
+        :param start: first date to load, None for the oldest
+        :param end: last date to load, None for the newest
+        :return: rows indexed by Date, ordered by date
+        :rtype: pd.DataFrame
+        """
+        dataset = self._dataset(db_table)
+        if dataset is None:
+            return pd.DataFrame()
+        table_columns = [c for c in dataset.schema.names if c not in ("Date", "year")]
+        if columns is None:
+            columns = table_columns
+        unknown = [c for c in columns if c not in table_columns]
+        if unknown:
+            raise ValueError(
+                f"Unknown column '{unknown[0]}', expected one of: {', '.join(table_columns)}"
+            )
+        pa_dataset = _import_pyarrow()
+        date_type = dataset.schema.field("Date").type
+        conditions = []
+        if years is not None:
+            conditions.append(pa_dataset.field("year").isin(years))
+        if start is not None:
+            # The year partition lets pyarrow skip whole files before reading any rows
+            conditions.append(pa_dataset.field("year") >= pd.Timestamp(start).year)
+            conditions.append(pa_dataset.field("Date") >= _pa_scalar(start, date_type))
+        if end is not None:
+            conditions.append(pa_dataset.field("year") <= pd.Timestamp(end).year)
+            conditions.append(pa_dataset.field("Date") <= _pa_scalar(end, date_type))
+        row_filter = None
+        for condition in conditions:
+            row_filter = condition if row_filter is None else row_filter & condition
+        out_df = dataset.to_table(columns=["Date", *columns], filter=row_filter).to_pandas()
+        return out_df.set_index("Date").sort_index()
+
+    def _merge(self, db_table: str, new_df: pd.DataFrame) -> None:
+        """
+        Upsert rows into their year partitions, replacing rows with the same date
+
+        :param db_table: table to write
+        :type db_table: str
+        :param new_df: rows indexed by Date
+        :type new_df: pd.DataFrame
+        """
+        _import_pyarrow()
+        new_df = new_df[~new_df.index.duplicated(keep="last")]
+        for year, year_df in new_df.groupby(new_df.index.year):
+            path = self._partition_path(db_table, year)
+            if path.is_file():
+                stored_df = pd.read_parquet(path).set_index("Date")
+                year_df = pd.concat([stored_df[~stored_df.index.isin(year_df.index)], year_df])
+            year_df = year_df.sort_index().rename_axis("Date").reset_index()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f".tmp-{path.name}")
+            year_df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+
+    def _version_path(self) -> Path:
+        """
+        File holding the data version, see read_version
+        """
+        return self.data_dir / "version.json"
+
+    def _bump_version(self) -> None:
+        """
+        Count a change to volume data
+        """
+        path = self._version_path()
+        state = json.loads(path.read_text()) if path.is_file() else {"generation": uuid.uuid4().hex, "version": 0}
+        state["version"] += 1
+        common.cache._atomic_write(path, json.dumps(state).encode())
+
+    def _read_journal_raw(self) -> dict:
+        """
+        Fetch journal as stored, keyed by YYYY-MM
+        """
+        path = self._journal_path()
+        return json.loads(path.read_text()) if path.is_file() else {}
+
+    def writer(self, batch_size: int = None) -> ParquetBatchWriter:
+        return ParquetBatchWriter(self, batch_size=batch_size or self.write_batch_size)
+
+    def read_months(self, db_table: str = None) -> set:
+        dates = self._read(db_table or self.db_table, columns=[]).index
+        return {date(y, m, 1) for y, m in set(zip(dates.year, dates.month))}
+
+    def read_table(self, db_table: str = None, columns: list = None, start=None, end=None) -> pd.DataFrame:
+        return self._read(db_table or self.db_table, columns=columns, start=start, end=end)
+
+    def read_version(self):
+        path = self._version_path()
+        if not path.is_file():
+            return None
+        state = json.loads(path.read_text())
+        return f"{state['generation']}-{state['version']}"
+
+    def read_journal(self) -> dict:
+        return {
+            datetime.strptime(month, "%Y-%m").date(): {
+                **entry,
+                "updated_at": datetime.fromisoformat(entry["updated_at"]),
+                "sections": entry.get("sections"),
+            }
+            for month, entry in self._read_journal_raw().items()
+        }
+
+    def read_validators(self) -> dict:
+        path = self._validators_path()
+        return json.loads(path.read_text()) if path.is_file() else {}
+
+    def write_validators(self, validators: dict) -> None:
+        common.cache._atomic_write(self._validators_path(), json.dumps(validators, indent=1).encode())
+
+    def query_top_n(
+        self,
+        number: int,
+        column: str = "OCC Total",
+        db_table: str = None,
+        granularity: str = "day",
+        by: str = None,
+        start=None,
+        end=None,
+        last: int = None,
+    ) -> pd.DataFrame:
+        """
+        Rank by reading only the date and ranked column within the window, then load full
+        rows from the year partitions holding the winners. Months and years are aggregated
+        from the ranked column alone, as Parquet files keep no aggregate tables.
+        """
+        if last is not None and last < 1:
+            raise ValueError(f"last must be a positive number of rows, not {last}")
+        db_table = db_table or self.db_table
+        dataset = self._dataset(db_table)
+        if dataset is None:
+            logger.warning(f"Unable to find table {db_table}, returning empty dataframe")
+            return pd.DataFrame()
+        columns = [c for c in dataset.schema.names if c not in ("Date", "year")]
+        if column not in columns:
+            raise ValueError(f"Unknown column '{column}', expected one of: {', '.join(columns)}")
+        if granularity != "day":
+            if granularity not in common.dataframe.GRANULARITY_PERIODS:
+                raise ValueError(f"Unknown granularity '{granularity}', expected day, month or year")
+            period = common.dataframe.GRANULARITY_PERIODS[granularity]
+            # Whole periods overlapping the window, as in the SQLite aggregate tables
+            if start is not None:
+                start = pd.Timestamp(start).to_period(period).start_time
+            if end is not None:
+                end = pd.Timestamp(end).to_period(period).end_time.normalize()
+        ranked = self._read(db_table, columns=[column], start=start, end=end)[column]
+        if granularity != "day":
+            aggregate_df = common.dataframe.volume_aggregate_df(ranked.to_frame(), granularity)
+            if last is not None:
+                aggregate_df = aggregate_df.iloc[-last:]
+            keys = None if by is None else common.dataframe.date_group_keys(aggregate_df.index, by)
+            return aggregate_df.iloc[
+                common.dataframe.top_n_positions(aggregate_df[f"{column} Sum"], number, keys)
+            ]
+        if last is not None:
+            ranked = ranked.iloc[-last:]
+        keys = None if by is None else common.dataframe.date_group_keys(ranked.index, by)
+        top_dates = ranked.index[common.dataframe.top_n_positions(ranked, number, keys)]
+        out_df = self._read(db_table, years=sorted(set(top_dates.year.tolist())))
+        out_df = out_df.loc[top_dates]
+        logger.debug(f"Read top {len(out_df)} rows by {column} from {db_table}")
+        return out_df
+
+    def drop(self, db_table: str) -> None:
+        shutil.rmtree(self._table_dir(db_table), ignore_errors=True)
+        self._bump_version()
+        logger.debug(f"Dropped table {db_table} from {self.data_dir}")
+
+
+def storage_from_config(database_conf: dict, base_dir: str, location: str = None) -> Storage:
+    """
+    Create the storage selected in the database section of the config file
+
+    :param database_conf: database section of the config file
+    :type database_conf: dict
+    :param base_dir: directory relative paths are resolved against
+    :type base_dir: str
+    :param location: database file or directory overriding the config file
+    :type location: str
+    :return: configured storage
+    :rtype: Storage
+    """
+    backend = database_conf.get("backend", "sqlite")
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown storage backend '{backend}', expected one of: {', '.join(BACKENDS)}")
+    backend_conf = database_conf[backend]
+    # Table names and the batch size live in the sqlite section for both backends
+    sqlite_conf = database_conf.get("sqlite") or {}
+    table_conf = {**sqlite_conf, **backend_conf}
+    path = location or backend_conf["db_filepath" if backend == "sqlite" else "dir"]
+    if not os.path.isabs(path):
+        path = os.path.join(base_dir, path)
+    kwargs = dict(
+        db_table=table_conf["db_table"],
+        futures_table=table_conf.get("db_table_futures"),
+        write_batch_size=table_conf.get("write_batch_size", common.sqlite.WRITE_BATCH_SIZE),
+    )
+    if backend == "parquet":
+        return ParquetStorage(path, **kwargs)
+    common.sqlite.configure_connections(**(sqlite_conf.get("pragmas") or {}))
+    common.sqlite.configure_query_cache(sqlite_conf.get("query_cache_entries", common.sqlite.QUERY_CACHE_ENTRIES))
+    return SqliteStorage(path, **kwargs)
+
+
+if __name__ == "__main__":
+    print("This file cannot be run directly.")
@@ -0,0 +1,37 @@
+"""
+Right-aligned plain-text tables in the layout of the psql format of the tabulate package,
+using only the standard library
+"""
+
+
+def render_table(headers: list, rows, widths: list = None):
+    """
+    Lines of a table whose cells are already formatted as strings. Rows are rendered one
+    at a time, so with widths given they can be any iterable and are never held in full.
+
+    :param headers: column headers
+    :type headers: list
+    :param rows: rows of cell strings
+    :param widths: width of each column, None to size columns to the rows
+    :type widths: list
+    :return: lines of the table, without line endings
+    :rtype: Iterator[str]
+    """
+    if widths is None:
+        rows = list(rows)
+        # Like tabulate, headers get at least two spaces beside them
+        widths = [len(str(header)) + 2 for header in headers]
+        for row in rows:
+            for i, cell in enumerate(row):
+                widths[i] = max(widths[i], len(cell))
+    rule = "+".join("-" * (width + 2) for width in widths)
+    yield f"+{rule}+"
+    yield "| " + " | ".join(str(h).rjust(w) for h, w in zip(headers, widths)) + " |"
+    yield f"|{rule}|"
+    for row in rows:
+        yield "| " + " | ".join(cell.rjust(w) for cell, w in zip(row, widths)) + " |"
+    yield f"+{rule}+"
+
+
+if __name__ == "__main__":
+    print("This file cannot be run directly.")
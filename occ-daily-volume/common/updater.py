@@ -2,120 +2,341 @@
 Functions for updating the local database
 """
 import logging
-from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 
 from dateutil.relativedelta import relativedelta
 
+import common.cache
 import common.occ
-import common.sqlite
+import common.storage
 
 logger = logging.getLogger(__name__)
 
+# Oldest month the updater tries to backfill
+BACKFILL_START_DATE = date(2008, 1, 1)
+# Wait before retrying a month that failed, doubled per attempt up to the maximum
+RETRY_BACKOFF = timedelta(hours=1)
+RETRY_BACKOFF_MAX = timedelta(days=7)
 
-def backfill_db_to_previous_month(
-    req_url: str, req_format: str, db_filepath: str, db_table: str
+
+def _previous_month() -> date:
+    """
+    First day of the previous month, the newest month OCC has a complete report for
+
+    :return: previous month
+    :rtype: date
+    """
+    return date.today() + relativedelta(day=1) - relativedelta(months=1)
+
+
+def _retry_due(journal_entry: dict, now: datetime) -> bool:
+    """
+    Check whether a month that failed before is due for another attempt
+
+    :param journal_entry: journal entry for the month, from sqlite.db_read_journal
+    :type journal_entry: dict
+    :param now: current time
+    :type now: datetime
+    :return: True if the backoff since the last attempt has passed
+    :rtype: bool
+    """
+    backoff = min(
+        RETRY_BACKOFF * 2 ** max(journal_entry["attempts"] - 1, 0), RETRY_BACKOFF_MAX
+    )
+    return now >= journal_entry["updated_at"] + backoff
+
+
+def _fetch_month(
+    req_url: str,
+    req_format: str,
+    req_date: date,
+    conditional: bool = False,
+    cache_dir: str = None,
 ):
     """
-    Fill and backfill database file to include all publically available data.
+    Fetch and parse a single month, logging and swallowing per-month errors.
+
+    Months OCC reports as unavailable are permanent failures, except for the previous
+    month which may simply not be published yet.
 
     :param req_url: url for the request
     :type req_url: str
     :param req_format: return format of data (only CSV is supported)
     :type req_format: str
-    :param db_filepath: database filepath
-    :type db_filepath: str
-    :param db_table: database table to read
-    :type db_table: str
-    """
-    backfill_end_date = date(2008, 1, 1)
-    prev_month = date.today() + relativedelta(day=1) - relativedelta(months=1)
-    logger.debug("Reading DB to find known range")
-    db_df = common.sqlite.db_read_sql_to_df(db_filepath=db_filepath, db_table=db_table)
-    if len(db_df) == 0:
-        db_df_max_date = None
-        db_df_min_date = prev_month
-    else:
-        db_df_max_date = db_df.index.max().date()
-        db_df_min_date = db_df.index.min().date()
-    # Fill database moving backward in time
-    if db_df_min_date > backfill_end_date:
-        if db_df_min_date == prev_month:
-            logger.debug(
-                f"DB {db_filepath} appears to be empty, fetching {prev_month.strftime('%B %Y')}"
-            )
-            month_df = common.occ.get_volume_by_month_to_df(
-                req_url=req_url, req_date=prev_month, req_format=req_format
+    :param req_date: month to fetch
+    :type req_date: date
+    :param conditional: only return data if it changed since the last fetch
+    :type conditional: bool
+    :param cache_dir: raw response cache directory, if any
+    :type cache_dir: str
+    :return: requested month, its dataframes by section (None if skipped or unchanged), journal status and error
+    :rtype: tuple
+    """
+    try:
+        month_dfs = common.occ.get_volume_by_month_to_dfs(
+            req_url=req_url,
+            req_date=req_date,
+            req_format=req_format,
+            conditional=conditional,
+            cache_dir=cache_dir,
+        )
+    except common.occ.ReportUnavailableError as e:
+        logger.warning(
+            f"Data unavailable for {req_date.strftime('%B %Y')}, skipping: {e}"
+        )
+        status = "unavailable" if req_date < _previous_month() else "failed"
+        return req_date, None, status, str(e)
+    except ValueError as e:
+        logger.warning(
+            f"Data unavailable for {req_date.strftime('%B %Y')}, skipping: {e}"
+        )
+        return req_date, None, "failed", str(e)
+    except (TimeoutError, ConnectionError) as e:
+        logger.error(
+            f"Network error for {req_date.strftime('%B %Y')}, skipping: {e}"
+        )
+        return req_date, None, "failed", str(e)
+    return req_date, month_dfs, "ok", None
+
+
+def fill_months(
+    req_url: str,
+    req_format: str,
+    storage: common.storage.Storage,
+    months: list,
+    fetch_workers: int = 1,
+    conditional: bool = False,
+    cache_dir: str = None,
+):
+    """
+    Fetch the given months and write them to storage.
+
+    Months are downloaded and parsed by up to fetch_workers threads, while all
+    writes happen on the calling thread in the order months were given, in batches of
+    the storage's write_batch_size months. Each month's futures table is written to the
+    storage's futures table in the same batch as its contracts, if it keeps one.
+    Conditional fetches replace the stored rows of months that changed and skip unchanged ones.
+
+    :param req_url: url for the request
+    :type req_url: str
+    :param req_format: return format of data (only CSV is supported)
+    :type req_format: str
+    :param storage: storage to write to
+    :type storage: common.storage.Storage
+    :param months: months to fetch
+    :type months: list
+    :param fetch_workers: number of concurrent fetch threads
+    :type fetch_workers: int
+    :param conditional: only write months that changed since the last fetch
+    :type conditional: bool
+    :param cache_dir: raw response cache directory, if any
+    :type cache_dir: str
+    """
+    futures_table = storage.futures_table
+    with storage.writer() as writer:
+        if fetch_workers <= 1:
+            results = (
+                _fetch_month(req_url, req_format, m, conditional, cache_dir)
+                for m in months
             )
-            common.sqlite.db_write_df_to_sql(
-                db_filepath=db_filepath, db_table=db_table, df_to_write=month_df
+            _write_fetched_months(writer, results, futures_table)
+            return
+        logger.debug(f"Fetching {len(months)} months with {fetch_workers} workers")
+        with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+            results = executor.map(
+                lambda m: _fetch_month(req_url, req_format, m, conditional, cache_dir),
+                months,
             )
-        logger.debug(
-            f"DB has data back to {db_df_min_date.strftime('%B %Y')}, backfill end date is {backfill_end_date.strftime('%B %Y')}"
+            _write_fetched_months(writer, results, futures_table)
+
+
+def _write_fetched_months(writer, results, futures_table: str = None) -> None:
+    """
+    Single writer for fetched months, skipping months that failed to fetch and
+    journaling the outcome of every month. A month is journaled before its rows are
+    written, so its entry is committed in the same batch as them.
+
+    :param writer: open batch writer from Storage.writer
+    :param results: iterable of (month, dataframes, status, error) tuples from _fetch_month
+    :param futures_table: table to write futures volume to, None to skip it
+    :type futures_table: str
+    """
+    for month, month_dfs, status, error in results:
+        sections = None if month_dfs is None else [section for section, df in month_dfs.items() if df is not None]
+        writer.record_fetch(month, status, error, sections)
+        if month_dfs is not None:
+            _write_month_dfs(writer, month_dfs, futures_table)
+
+
+def _write_month_dfs(writer, month_dfs: dict, futures_table: str = None) -> None:
+    """
+    Write one month's futures table if it has one, then its contracts table, which
+    counts towards the batch and may commit it
+
+    :param writer: open batch writer from Storage.writer
+    :param month_dfs: dataframes by section, from occ.volume_dfs_create
+    :type month_dfs: dict
+    :param futures_table: table to write futures volume to, None to skip it
+    :type futures_table: str
+    """
+    if futures_table and month_dfs.get("futures") is not None:
+        writer.write(month_dfs["futures"], db_table=futures_table)
+    writer.write(month_dfs["contracts"])
+
+
+def plan_update(storage: common.storage.Storage, refresh_months: int = 0) -> tuple:
+    """
+    Plan which months an update needs to fetch.
+
+    Every month from BACKFILL_START_DATE to the previous month that has no rows in
+    storage is missing, including gaps left by earlier failed fetches. The fetch journal
+    settles the rest: months OCC marked unavailable are never requested again, and failed
+    months wait out an exponential backoff. The newest refresh_months stored months are
+    planned for a conditional re-check.
+
+    With a futures table, stored months without futures rows are missing too, unless
+    the journal shows their report had no futures section. This backfills the futures
+    table of a database filled before futures were stored.
+
+    :param storage: storage to plan for
+    :type storage: common.storage.Storage
+    :param refresh_months: number of stored months to re-check for revisions
+    :type refresh_months: int
+    :return: (missing months, months to refresh), both newest first
+    :rtype: tuple
+    """
+    logger.debug("Reading storage to find stored months")
+    present = storage.read_months()
+    futures_present = storage.read_months(storage.futures_table) if storage.futures_table else None
+    journal = storage.read_journal()
+    now = datetime.now()
+    missing = []
+    unavailable = deferred = futures_only = 0
+    working_month = _previous_month()
+    while working_month >= BACKFILL_START_DATE:
+        entry = journal.get(working_month)
+        needs_futures = (
+            futures_present is not None
+            and working_month not in futures_present
+            and not (entry and entry.get("sections") is not None and "futures" not in entry["sections"])
         )
-        backfill_min_end_date_delta = relativedelta(db_df_min_date, backfill_end_date)
-        backfill_months_difference = (
-            (backfill_min_end_date_delta.years * 12)
-            + backfill_min_end_date_delta.months
+        if working_month in present and not needs_futures:
+            pass
+        elif entry and entry["status"] == "unavailable":
+            unavailable += 1
+        elif entry and entry["status"] == "failed" and not _retry_due(entry, now):
+            deferred += 1
+        else:
+            missing.append(working_month)
+            futures_only += working_month in present
+        working_month -= relativedelta(months=1)
+    refresh = sorted(present, reverse=True)[: max(refresh_months, 0)]
+    logger.debug(
+        f"DB has {len(present)} months, {len(missing)} to fetch since {BACKFILL_START_DATE.strftime('%B %Y')}, "
+        f"{unavailable} permanently unavailable, {deferred} waiting to retry, "
+        f"{futures_only} stored without futures"
+    )
+    return missing, refresh
+
+
+def backfill_db_to_previous_month(
+    req_url: str,
+    req_format: str,
+    storage: common.storage.Storage,
+    fetch_workers: int = 1,
+    refresh_months: int = 0,
+    cache_dir: str = None,
+):
+    """
+    Fill and backfill storage to include all publically available data.
+
+    Only months missing from storage are fetched, see plan_update, and the outcome
+    of every fetch is recorded in the fetch journal so an interrupted run can resume. The most recent
+    refresh_months months already stored are re-requested conditionally, so
+    they are only downloaded and rewritten if OCC revised them.
+
+    :param req_url: url for the request
+    :type req_url: str
+    :param req_format: return format of data (only CSV is supported)
+    :type req_format: str
+    :param storage: storage to fill
+    :type storage: common.storage.Storage
+    :param fetch_workers: number of concurrent fetch threads
+    :type fetch_workers: int
+    :param refresh_months: number of stored months to re-check for revisions
+    :type refresh_months: int
+    :param cache_dir: directory to keep raw responses in, if any
+    :type cache_dir: str
+    """
+    common.occ.configure_session(
+        pool_maxsize=max(fetch_workers, common.occ.POOL_MAXSIZE)
+    )
+    common.occ.set_validators(storage.read_validators())
+    missing, refresh = plan_update(storage=storage, refresh_months=refresh_months)
+    if missing:
+        logger.info(f"Filling {len(missing)} missing months")
+        fill_months(
+            req_url=req_url,
+            req_format=req_format,
+            storage=storage,
+            months=missing,
+            fetch_workers=fetch_workers,
+            cache_dir=cache_dir,
         )
-        logger.info(f"Backfilling {backfill_months_difference} months")
-        working_month = db_df_min_date - relativedelta(months=1)
-        working_month += relativedelta(day=1)
-        while working_month > backfill_end_date:
+    else:
+        logger.debug("DB is already current")
+    if refresh:
+        logger.info(f"Checking {len(refresh)} stored months for revisions")
+        fill_months(
+            req_url=req_url,
+            req_format=req_format,
+            storage=storage,
+            months=refresh,
+            fetch_workers=fetch_workers,
+            conditional=True,
+            cache_dir=cache_dir,
+        )
+    validators = common.occ.get_validators()
+    if validators:
+        storage.write_validators(validators)
+
+
+def rebuild_db_from_cache(
+    cache_dir: str,
+    req_format: str,
+    storage: common.storage.Storage,
+):
+    """
+    Rewrite every cached month in storage from the raw response cache, without touching
+    the network. Stored months missing from the cache, e.g. evicted or never fetched, are
+    kept as they are. All months are written in one batch, so a failure leaves storage
+    unchanged.
+
+    :param cache_dir: raw response cache directory
+    :type cache_dir: str
+    :param req_format: format of the cached data (only CSV is supported)
+    :type req_format: str
+    :param storage: storage to rebuild
+    :type storage: common.storage.Storage
+    """
+    cached_months = common.cache.cache_months(cache_dir, req_format)
+    if not cached_months:
+        logger.error(f"No cached reports found in {cache_dir}, leaving storage untouched")
+        return
+    logger.info(
+        f"Rewriting {len(cached_months)} cached months of {', '.join(storage.tables())} from {cache_dir}"
+    )
+    with storage.writer(batch_size=len(cached_months)) as writer:
+        for working_month in cached_months:
             try:
-                month_df = common.occ.get_volume_by_month_to_df(
-                    req_url=req_url, req_date=working_month, req_format=req_format
-                )
-                common.sqlite.db_write_df_to_sql(
-                    db_filepath=db_filepath, db_table=db_table, df_to_write=month_df
+                month_dfs = common.occ.get_volume_by_month_from_cache(
+                    cache_dir=cache_dir, req_date=working_month, req_format=req_format
                 )
             except ValueError as e:
                 logger.warning(
-                    f"Data unavailable for {working_month.strftime('%B %Y')}, skipping: {e}"
-                )
-            except (TimeoutError, ConnectionError) as e:
-                logger.error(
-                    f"Network error for {working_month.strftime('%B %Y')}, skipping: {e}"
+                    f"Cached data unusable for {working_month.strftime('%B %Y')}, skipping: {e}"
                 )
-            working_month -= relativedelta(months=1)
-        logger.debug(
-            f"DB backfilled successfully to {backfill_end_date.strftime('%B %Y')}"
-        )
-    else:
-        logger.debug("DB is already backfilled")
-    # Fill database moving forward in time
-    if db_df_max_date:
-        logger.debug(
-            f"DB has data upto {db_df_max_date.strftime('%B %Y')}, previous month is {prev_month.strftime('%B %Y')}"
-        )
-        if db_df_max_date <= prev_month:
-            fill_max_prev_date_delta = relativedelta(prev_month, db_df_max_date)
-            fill_months_difference = (
-                (fill_max_prev_date_delta.years * 12)
-                + fill_max_prev_date_delta.months
-                + 1
-            )
-            logger.info(f"Filling {fill_months_difference} months")
-            working_month = db_df_max_date + relativedelta(months=1)
-            working_month += relativedelta(day=1)
-            while working_month <= prev_month:
-                try:
-                    month_df = common.occ.get_volume_by_month_to_df(
-                        req_url=req_url, req_date=working_month, req_format=req_format
-                    )
-                    common.sqlite.db_write_df_to_sql(
-                        db_filepath=db_filepath, db_table=db_table, df_to_write=month_df
-                    )
-                except ValueError as e:
-                    logger.warning(
-                        f"Data unavailable for {working_month.strftime('%B %Y')}, skipping: {e}"
-                    )
-                except (TimeoutError, ConnectionError) as e:
-                    logger.error(
-                        f"Network error for {working_month.strftime('%B %Y')}, skipping: {e}"
-                    )
-                working_month += relativedelta(months=1)
-            logger.debug(f"DB filled up to {prev_month.strftime('%B %Y')}")
-        else:
-            logger.debug("DB is already current")
-    else:
-        logger.debug("DB was empty and successfully backfilled, not filling")
+                continue
+            _write_month_dfs(writer, month_dfs, storage.futures_table)
+    logger.debug(f"Storage rewritten from cache up to {cached_months[-1].strftime('%B %Y')}")
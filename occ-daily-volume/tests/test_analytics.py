@@ -0,0 +1,89 @@
+"""
+Tests for common/analytics.py
+"""
+import sys
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import analytics
+from common import snapshot
+from common.storage import SqliteStorage
+
+
+def _volume_series():
+    rng = np.random.default_rng(0)
+    values = rng.integers(1_000, 2_000, size=60).astype(float)
+    values[[30, 45]] = [9_000, 7_000]
+    values[10] = np.nan
+    return pd.Series(values, index=pd.bdate_range('2023-12-01', periods=60, name='Date'))
+
+
+def test_trailing_stats_match_pandas_rolling():
+    """Test that prefix-sum window statistics match pandas rolling over the previous days"""
+    series = _volume_series()
+    mean, std = analytics.trailing_stats(analytics.rolling_state(series), 5)
+    expected_mean = series.rolling(5, min_periods=2).mean().shift(1)
+    expected_std = series.rolling(5, min_periods=2).std().shift(1)
+    expected_mean.iloc[:5] = np.nan
+    np.testing.assert_allclose(mean, expected_mean, rtol=1e-9)
+    np.testing.assert_allclose(std, expected_std.where(expected_mean.notna()), rtol=1e-6)
+
+    mean, _ = analytics.trailing_stats(analytics.rolling_state(series), 5, lo=20, hi=25)
+    np.testing.assert_allclose(mean, expected_mean.iloc[20:25], rtol=1e-9)
+
+
+def test_spike_top_n_metrics():
+    """Test zscore, ratio and percentile rankings and the date window"""
+    series = _volume_series()
+    zscore_df = analytics.spike_top_n(series.index, series, 2, metric="zscore", window=10)
+    assert set(zscore_df.index) == {series.index[30], series.index[45]}
+    assert list(zscore_df.columns) == ['OCC Total', '10-Day Average', 'Z-Score']
+    expected = (series - series.rolling(10).mean().shift(1)) / series.rolling(10).std().shift(1)
+    assert list(zscore_df['Z-Score']) == pytest.approx(list(expected.loc[zscore_df.index]))
+
+    ratio_df = analytics.spike_top_n(series.index, series, 1, metric="ratio", window=10, start=series.index[40])
+    assert list(ratio_df.index) == [series.index[45]]
+    assert ratio_df['Ratio'].iloc[0] == pytest.approx(7_000 / series.iloc[35:45].mean())
+
+    percentile_df = analytics.spike_top_n(series.index, series, 1, metric="percentile", by="year")
+    assert list(percentile_df['Year Percentile']) == [100, 100]
+    assert list(percentile_df.columns) == ['OCC Total', 'Year Percentile']
+
+    # Days after a window without volume have no ratio rather than an infinite one
+    quiet = series.copy()
+    quiet.iloc[20:30] = 0
+    ratio_df = analytics.spike_top_n(quiet.index, quiet, 3, metric="ratio", window=10)
+    assert quiet.index[30] not in ratio_df.index
+    assert np.isfinite(ratio_df['Ratio']).all()
+
+    # Days without a full window of history are not ranked
+    assert analytics.spike_top_n(series.index, series, 5, window=10, last=3, end=series.index[8]).empty
+    with pytest.raises(ValueError, match="Unknown metric"):
+        analytics.spike_top_n(series.index, series, 1, metric="mad")
+
+
+def test_query_spikes_caches_rolling_state(mocker):
+    """Test that the snapshot's rolling state is written with it and matches reading from storage"""
+    series = _volume_series().dropna()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = SqliteStorage(os.path.join(tmpdir, "test.db"), "volHist")
+        with storage.writer() as writer:
+            writer.write(series.astype(int).to_frame('OCC Total'))
+        snap = snapshot.snapshot_load(storage, os.path.join(tmpdir, "snapshot"))
+        spy = mocker.spy(analytics, "rolling_state")
+
+        first_df = analytics.query_spikes(storage, 3, snapshot=snap, window=10)
+        second_df = analytics.query_spikes(storage, 3, snapshot=snap, window=15)
+        assert spy.call_count == 0
+        assert isinstance(snap.rolling_state('OCC Total'), np.memmap)
+
+        pd.testing.assert_frame_equal(first_df, analytics.query_spikes(storage, 3, window=10))
+        pd.testing.assert_frame_equal(second_df, analytics.query_spikes(storage, 3, window=15))
+        assert analytics.query_spikes(storage, 3, db_table="missing").empty
+        with pytest.raises(ValueError, match="Unknown column"):
+            analytics.query_spikes(storage, 3, column="Bogus", snapshot=snap)
@@ -0,0 +1,52 @@
+"""
+Tests for common/cache.py
+"""
+import sys
+import os
+import tempfile
+import time
+from datetime import date
+from pathlib import Path
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import cache
+
+
+def test_cache_put_get_round_trip():
+    """Test that cached reports are returned unchanged and keyed by month and format"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        raw = 'Daily OCC Contract Volume - December 2025\r\nDate,Equity\r\n'
+        cache.cache_put(tmpdir, date(2025, 12, 15), "CSV", raw)
+
+        assert cache.cache_get(tmpdir, date(2025, 12, 1), "csv") == raw
+        assert cache.cache_get(tmpdir, date(2025, 11, 1), "csv") is None
+        assert cache.cache_months(tmpdir, "csv") == [date(2025, 12, 1)]
+
+
+def test_cache_put_is_content_addressed():
+    """Test that identical bodies are stored once"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        digest_a = cache.cache_put(tmpdir, date(2025, 1, 1), "csv", "same body")
+        digest_b = cache.cache_put(tmpdir, date(2025, 2, 1), "csv", "same body")
+
+        assert digest_a == digest_b
+        assert len(list(Path(tmpdir, "objects").iterdir())) == 1
+
+
+def test_cache_evict_by_age_and_size():
+    """Test that old reports are evicted first and unreferenced objects are removed"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for month in range(1, 4):
+            cache.cache_put(tmpdir, date(2025, month, 1), "csv", f"report {month} " * 100)
+        old_ref = Path(tmpdir, "refs", "202501.csv")
+        old_time = time.time() - 10 * 86400
+        os.utime(old_ref, (old_time, old_time))
+
+        assert cache.cache_evict(tmpdir, max_age_days=5) == 1
+        assert cache.cache_months(tmpdir, "csv") == [date(2025, 2, 1), date(2025, 3, 1)]
+        assert len(list(Path(tmpdir, "objects").iterdir())) == 2
+
+        assert cache.cache_evict(tmpdir, max_bytes=0) == 2
+        assert cache.cache_months(tmpdir, "csv") == []
+        assert list(Path(tmpdir, "objects").iterdir()) == []
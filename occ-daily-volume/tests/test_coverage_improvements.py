@@ -13,6 +13,7 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 
 from common import occ
 from common import updater
+from common.storage import SqliteStorage
 from common import sqlite
 
 # --- common.occ tests ---
@@ -47,103 +48,73 @@ def test_volume_df_create_with_merge_df():
 
 # --- common.updater tests ---
 
+def _stored_months(start, end):
+    """Set of month starts from start to end inclusive"""
+    return {d.date() for d in pd.date_range(start=start, end=end, freq='MS')}
+
 def test_backfill_exceptions_in_loop():
-    """Test exceptions in the backfill loop explicitly"""
-    # We want to test ONLY the backfill loop exceptions.
-    # To avoid triggering forward fill, we need db_max_date >= prev_month.
-    # To trigger backfill loop, we need db_min_date > backfill_end_date.
-    
+    """Test exceptions while backfilling the oldest months"""
     today = date.today()
     prev_month = today + relativedelta(day=1) - relativedelta(months=1)
     
-    # DB range: 2008-04-01 to prev_month
-    dates = [date(2008, 4, 1), prev_month]
-    mock_db_df = pd.DataFrame(
-        {'Data': [1, 2]},
-        index=pd.DatetimeIndex(dates, name='Date')
-    )
+    # DB range: 2008-04-01 to prev_month, so 2008-03, 2008-02 and 2008-01 are missing
+    present = _stored_months(date(2008, 4, 1), prev_month)
     
-    with patch('common.sqlite.db_read_sql_to_df', return_value=mock_db_df), \
-         patch('common.sqlite.db_write_df_to_sql'), \
-         patch('common.occ.get_volume_by_month_to_df') as mock_get_vol:
+    with patch('common.sqlite.db_read_months', return_value=present), \
+         patch('common.sqlite.DbBatchWriter') as mock_writer, \
+         patch('common.occ.get_volume_by_month_to_dfs') as mock_get_vol:
              
-        # Backfill loop:
-        # min=2008-04-01.
-        # working starts at 2008-03-01.
-        # Loop continues while working > 2008-01-01.
-        # Iteration 1: 2008-03-01 -> Call 1 (ValueError)
-        # Iteration 2: 2008-02-01 -> Call 2 (ConnectionError)
-        # Iteration 3: 2008-01-01 -> Stop loop.
-        
-        # We need 2 side effects.
+        # Missing months are fetched newest first:
+        # 2008-03-01 -> ValueError, 2008-02-01 -> ConnectionError, 2008-01-01 -> TimeoutError
         mock_get_vol.side_effect = [
             ValueError("Unavailable"),
-            ConnectionError("Network fail")
+            ConnectionError("Network fail"),
+            TimeoutError("Timeout"),
         ]
         
-        updater.backfill_db_to_previous_month("url", "csv", "db", "table")
+        updater.backfill_db_to_previous_month("url", "csv", SqliteStorage("db", "table"))
         
-        # Should have attempted 2 calls
-        assert mock_get_vol.call_count == 2
+        # Should have attempted 3 calls and written nothing
+        assert mock_get_vol.call_count == 3
+        mock_writer.return_value.__enter__.return_value.write.assert_not_called()
 
 def test_forward_fill_logic():
     """Test forward filling logic and exceptions"""
-    # We want to test ONLY the forward fill loop exceptions.
-    # To avoid triggering backfill loop, we need db_min_date <= backfill_end_date (2008-01-01).
-    # To trigger forward fill, we need db_max_date < prev_month.
-    
     today = date.today()
     prev_month = today + relativedelta(day=1) - relativedelta(months=1)
     
     # DB max date is 3 months ago (so we need to fill 3 months)
     db_max_date = prev_month - relativedelta(months=3)
+    present = _stored_months(date(2008, 1, 1), db_max_date)
     
-    dates = [date(2008, 1, 1), db_max_date]
-    mock_db_df = pd.DataFrame(
-        {'Data': [1, 2]},
-        index=pd.DatetimeIndex(dates, name='Date')
-    )
-    
-    with patch('common.sqlite.db_read_sql_to_df', return_value=mock_db_df), \
-         patch('common.sqlite.db_write_df_to_sql'), \
-         patch('common.occ.get_volume_by_month_to_df') as mock_get_vol:
+    with patch('common.sqlite.db_read_months', return_value=present), \
+         patch('common.sqlite.DbBatchWriter') as mock_writer, \
+         patch('common.occ.get_volume_by_month_to_dfs') as mock_get_vol:
              
-        # Forward fill loop:
-        # max = 3 months ago.
-        # working starts at max + 1 month.
-        # Loop continues while working <= prev_month.
-        # Iteration 1: max+1 -> Call 1 (ValueError)
-        # Iteration 2: max+2 -> Call 2 (TimeoutError)
-        # Iteration 3: max+3 (prev_month) -> Call 3 (Success)
-        
+        # Iteration 1: prev_month -> ValueError
+        # Iteration 2: prev_month - 1 -> TimeoutError
+        # Iteration 3: prev_month - 2 -> Success
         mock_get_vol.side_effect = [
             ValueError("Unavailable"),
             TimeoutError("Timeout"),
-            pd.DataFrame()
+            {'contracts': pd.DataFrame(), 'futures': None}
         ]
         
-        updater.backfill_db_to_previous_month("url", "csv", "db", "table")
+        updater.backfill_db_to_previous_month("url", "csv", SqliteStorage("db", "table"))
         
         assert mock_get_vol.call_count == 3
+        assert mock_writer.return_value.__enter__.return_value.write.call_count == 1
 
 
 def test_db_already_current():
     """Test when DB is already up to date"""
-    # No backfill (min <= 2008-01-01)
-    # No forward fill (max > prev_month) -- Wait, max cannot be > prev_month usually, but max >= prev_month works.
-    
     today = date.today()
     prev_month = today + relativedelta(day=1) - relativedelta(months=1)
+    present = _stored_months(date(2008, 1, 1), prev_month)
     
-    dates = [date(2008, 1, 1), prev_month]
-    mock_db_df = pd.DataFrame(
-        {'Data': [1, 2]},
-        index=pd.DatetimeIndex(dates, name='Date')
-    )
-    
-    with patch('common.sqlite.db_read_sql_to_df', return_value=mock_db_df), \
-         patch('common.occ.get_volume_by_month_to_df') as mock_get_vol:
+    with patch('common.sqlite.db_read_months', return_value=present), \
+         patch('common.occ.get_volume_by_month_to_dfs') as mock_get_vol:
              
-        updater.backfill_db_to_previous_month("url", "csv", "db", "table")
+        updater.backfill_db_to_previous_month("url", "csv", SqliteStorage("db", "table"))
         
-        assert mock_get_vol.call_count == 0
\ No newline at end of file
+        assert mock_get_vol.call_count == 0
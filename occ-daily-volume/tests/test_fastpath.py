@@ -0,0 +1,135 @@
+"""
+Tests for common/fastpath.py
+"""
+import io
+import sys
+import os
+import tempfile
+from datetime import date
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import dataframe
+from common import fastpath
+from common import output
+from common import sqlite
+
+
+def _database_conf(db_path, backend="sqlite"):
+    return {
+        "backend": backend,
+        "sqlite": {"db_filepath": db_path, "db_table": "volHist", "db_table_futures": "volHistFutures"},
+        "parquet": {"dir": "parquet"},
+    }
+
+
+def _write_volume(db_path):
+    test_df = pd.DataFrame(
+        {'Equity': [5, 1, 4, 2], 'OCC Total': [1_000, 40_000, 30_000, 20]},
+        index=pd.DatetimeIndex(['2023-12-29', '2024-01-02', '2024-01-03', '2024-02-01'], name='Date'),
+    )
+    sqlite.db_write_df_to_sql(db_path, "volHist", test_df)
+
+
+def test_fastpath_matches_full_query(capsys):
+    """Test that the stdlib query and table match db_query_top_n and pretty_print_df"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        _write_volume(db_path)
+        queries = (
+            {'number': 3},
+            {'number': 2, 'column': 'Equity', 'start': date(2024, 1, 1)},
+            {'number': 1, 'by': 'month', 'last': 3},
+            {'number': 2, 'granularity': 'month', 'start': date(2024, 1, 15)},
+        )
+        for query in queries:
+            columns, rows = fastpath.query_top_n(_database_conf(db_path), tmpdir, **query)
+            rows = list(rows)
+            full_df = sqlite.db_query_top_n(db_path, "volHist", **query)
+            assert columns == ['Date', *full_df.columns]
+            assert len(rows) == len(full_df)
+
+            date_format = '%Y-%m' if query.get('granularity') == 'month' else '%Y-%m-%d'
+            fastpath.print_top_n(columns, rows, date_format=date_format)
+            fast_output = capsys.readouterr().out
+            dataframe.pretty_print_df(full_df, date_format=date_format)
+            assert fast_output == capsys.readouterr().out
+
+
+def test_print_top_n_widths(capsys):
+    """Test that widths found from each column's extremes match pretty_print_df"""
+    columns = ['Date', 'OCC Total', 'Debt']
+    rows = [(19724, 1_234_567, None), (19725, -98_765_432, float('inf')), (19726, 5, -3.0)]
+    fastpath.print_top_n(columns, iter(rows))
+    full_df = pd.DataFrame(
+        {'OCC Total': [1_234_567, -98_765_432, 5], 'Debt': [float('nan'), float('inf'), -3.0]},
+        index=pd.DatetimeIndex(['2024-01-02', '2024-01-03', '2024-01-04'], name='Date'),
+    )
+    fast_output = capsys.readouterr().out
+    dataframe.pretty_print_df(full_df)
+    assert fast_output == capsys.readouterr().out
+
+
+def test_fastpath_formats_match_full_query():
+    """Test that machine-readable output from the cursor matches output from the dataframe"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        _write_volume(db_path)
+        for query in ({'number': 3}, {'number': 2, 'granularity': 'month'}):
+            columns, rows = fastpath.query_top_n(_database_conf(db_path), tmpdir, **query)
+            full_df = sqlite.db_query_top_n(db_path, "volHist", **query)
+            fast_rows = list(fastpath.decode_rows(columns, rows))
+            full_columns, full_rows = dataframe.df_rows(full_df)
+            assert columns == full_columns
+            assert fast_rows == list(full_rows)
+            for output_format in ("csv", "json", "ndjson"):
+                fast_out, full_out = io.StringIO(), io.StringIO()
+                output.write_rows(columns, fast_rows, output_format, out=fast_out)
+                output.write_rows(*dataframe.df_rows(full_df), output_format, out=full_out)
+                assert fast_out.getvalue() == full_out.getvalue()
+
+
+def test_fastpath_query_cache(mocker):
+    """Test that the stdlib path shares the query cache, and streams from a read-only connection without it"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        _write_volume(db_path)
+        columns, rows = fastpath.query_top_n(_database_conf(db_path), tmpdir, number=2, by="year")
+        rows = list(rows)
+        build = mocker.spy(fastpath.common.schema, "db_top_n_query")
+        full_df = sqlite.db_query_top_n(db_path, "volHist", 2, by="year")
+        assert build.call_count == 0
+        assert len(full_df) == len(rows)
+
+        connect = mocker.spy(fastpath.sql, "connect")
+        database_conf = _database_conf(db_path)
+        database_conf["sqlite"]["query_cache_entries"] = 0
+        columns, uncached = fastpath.query_top_n(database_conf, tmpdir, number=2, by="year")
+        assert build.call_count == 1
+        assert list(uncached) == rows
+        fastpath.query_top_n(_database_conf(db_path), tmpdir, number=2)
+        assert build.call_count == 2
+        assert all(c.args[0].endswith("?mode=ro") for c in connect.call_args_list)
+
+
+def test_fastpath_falls_back():
+    """Test that queries the stdlib path cannot answer are left to the full code path"""
+    import sqlite3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        assert fastpath.query_top_n(_database_conf(db_path), tmpdir, number=1) is None
+        _write_volume(db_path)
+        assert fastpath.query_top_n(_database_conf(db_path, backend="parquet"), tmpdir, number=1) is None
+        assert fastpath.query_top_n(_database_conf(db_path), tmpdir, dataset="futures", number=1) is None
+        assert fastpath.query_top_n(_database_conf("test.db"), tmpdir, number=1) is not None
+        # Empty windows are answered here too, with their columns
+        columns, rows = fastpath.query_top_n(_database_conf(db_path), tmpdir, number=1, end=date(2000, 1, 1))
+        assert columns[0] == 'Date' and list(rows) == []
+        columns, rows = fastpath.query_top_n(_database_conf(db_path), tmpdir, number=1, by="year", end=date(2000, 1, 1))
+        assert columns[0] == 'Date' and list(rows) == []
+
+        # Missing aggregates need the migration the full path runs first
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("DROP TABLE volHistYearly")
+        assert fastpath.query_top_n(_database_conf(db_path), tmpdir, number=1) is None
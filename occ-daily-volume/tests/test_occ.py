@@ -91,3 +91,52 @@ def test_volume_csv_month_clean_sep_new_format():
     assert len(lines_futures) == 3 # Header + 2 data rows
     assert "12/31/2025" in lines_futures[1]
     assert "Dec Total" not in cleaned_data["futures"]
+
+
+def test_volume_csv_month_clean_sep_text_stream():
+    """
+    Test that the cleaner reads a text stream and returns the real futures header row
+    """
+    import io
+    csv_data = (
+        'Daily OCC Contract Volume - December 2025\r\n'
+        'Date,Equity,Index/Others,Debt,Futures,OCC Total\r\n'
+        '12/31/2025,"45,727,373","5,185,170","0","123,957","51,036,500",\r\n'
+        'Dec Total,"1,181,470,562","113,033,687","0","3,923,237","1,298,427,486",\r\n'
+        '\r\n'
+        'Daily Futures Contract Volume -December 2025\r\n'
+        'Date,Equity,Index/Others,OOF,OCC Total\r\n'
+        '12/31/2025,"0","123,957","0","123,957",\r\n'
+        'Dec Avg,"0","178,289","40","178,329",\r\n'
+    )
+    from_stream = occ.volume_csv_month_clean_sep(io.StringIO(csv_data, newline=""))
+    assert from_stream == occ.volume_csv_month_clean_sep(csv_data)
+    assert from_stream["contracts"] == (
+        'Date,Equity,Index/Others,Debt,Futures,OCC Total\n'
+        '12/31/2025,"45,727,373","5,185,170","0","123,957","51,036,500"'
+    )
+    assert from_stream["futures_headers"] == ['Date', 'Equity', 'Index/Others', 'OOF', 'OCC Total']
+
+
+def test_volume_dfs_create_futures():
+    """
+    Test that the futures table is parsed into its own dataframe with its own columns
+    """
+    csv_data = (
+        'Daily OCC Contract Volume - December 2025\r\n'
+        'Date,Equity,Index/Others,Debt,Futures,OCC Total\r\n'
+        '12/31/2025,"45,727,373","5,185,170","0","123,957","51,036,500",\r\n'
+        'Dec Total,"1,181,470,562","113,033,687","0","3,923,237","1,298,427,486",\r\n'
+        '\r\n'
+        'Daily Futures Contract Volume -December 2025\r\n'
+        'Date,Equity,Index/Others,OOF,OCC Total\r\n'
+        '12/31/2025,"0","123,957","0","123,957",\r\n'
+        'Dec Total,"0","3,922,362","875","3,923,237",\r\n'
+    )
+    volume_dfs = occ.volume_dfs_create(occ.volume_csv_month_clean_sep(csv_data))
+    assert list(volume_dfs["contracts"].columns) == ['Equity', 'Index/Others', 'Debt', 'Futures', 'OCC Total']
+    assert list(volume_dfs["futures"].columns) == ['Equity', 'Index/Others', 'OOF', 'OCC Total']
+    assert volume_dfs["futures"].loc['2025-12-31', 'OCC Total'] == 123957
+
+    contracts_only = occ.volume_csv_month_clean_sep(csv_data.split('\r\n\r\n')[0] + '\r\n')
+    assert occ.volume_dfs_create(contracts_only)["futures"] is None
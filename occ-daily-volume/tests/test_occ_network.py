@@ -17,7 +17,7 @@ def test_volume_csv_month_get_timeout():
     """Test that timeout exception is properly handled and re-raised"""
     test_date = date(2024, 1, 1)
 
-    with patch('common.occ.requests.get') as mock_get:
+    with patch('common.occ.requests.Session.get') as mock_get:
         mock_get.side_effect = requests.exceptions.Timeout()
 
         with pytest.raises(TimeoutError, match="Request timed out after 30 seconds"):
@@ -28,7 +28,7 @@ def test_volume_csv_month_get_connection_error():
     """Test that connection errors are properly handled and re-raised"""
     test_date = date(2024, 1, 1)
 
-    with patch('common.occ.requests.get') as mock_get:
+    with patch('common.occ.requests.Session.get') as mock_get:
         mock_get.side_effect = requests.exceptions.ConnectionError("Network unreachable")
 
         with pytest.raises(ConnectionError, match="Failed to fetch data from"):
@@ -39,7 +39,7 @@ def test_volume_csv_month_get_http_error():
     """Test that HTTP errors are properly handled"""
     test_date = date(2024, 1, 1)
 
-    with patch('common.occ.requests.get') as mock_get:
+    with patch('common.occ.requests.Session.get') as mock_get:
         mock_response = Mock()
         mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError("404 Not Found")
         mock_get.return_value = mock_response
@@ -52,7 +52,7 @@ def test_volume_csv_month_get_timeout_value():
     """Test that request timeout is set to 30 seconds"""
     test_date = date(2024, 1, 1)
 
-    with patch('common.occ.requests.get') as mock_get:
+    with patch('common.occ.requests.Session.get') as mock_get:
         mock_response = Mock()
         mock_response.raise_for_status.return_value = None
         mock_response.text = "Valid CSV data"
@@ -80,7 +80,7 @@ def test_volume_csv_month_get_invalid_report_date():
     """Test that ValueError is raised for invalid report date"""
     test_date = date(2024, 1, 1)
 
-    with patch('common.occ.requests.get') as mock_get:
+    with patch('common.occ.requests.Session.get') as mock_get:
         mock_response = Mock()
         mock_response.raise_for_status.return_value = None
         mock_response.text = "Invalid report Date"
@@ -94,7 +94,7 @@ def test_volume_csv_month_get_report_not_available():
     """Test that ValueError is raised when report is not available"""
     test_date = date(2024, 1, 1)
 
-    with patch('common.occ.requests.get') as mock_get:
+    with patch('common.occ.requests.Session.get') as mock_get:
         mock_response = Mock()
         mock_response.raise_for_status.return_value = None
         mock_response.text = "Report is not available"
@@ -109,7 +109,7 @@ def test_volume_csv_month_get_success():
     test_date = date(2024, 1, 1)
     expected_text = "Valid,CSV,Data\n1,2,3"
 
-    with patch('common.occ.requests.get') as mock_get:
+    with patch('common.occ.requests.Session.get') as mock_get:
         mock_response = Mock()
         mock_response.raise_for_status.return_value = None
         mock_response.text = expected_text
@@ -122,3 +122,76 @@ def test_volume_csv_month_get_success():
         # Verify timeout was passed
         call_kwargs = mock_get.call_args.kwargs
         assert call_kwargs['timeout'] == occ.REQUEST_TIMEOUT
+
+
+def test_volume_csv_month_get_reuses_session():
+    """Test that repeated requests go through the same pooled session"""
+    occ.configure_session(pool_maxsize=4)
+    assert occ.get_session() is occ.get_session()
+    adapter = occ.get_session().get_adapter("https://marketdata.theocc.com")
+    assert adapter._pool_maxsize == 4
+
+
+def test_volume_csv_month_get_conditional_not_modified():
+    """Test that validators from an earlier fetch are sent and a 304 returns None"""
+    test_date = date(2024, 1, 1)
+    occ.set_validators({})
+
+    with patch('common.occ.requests.Session.get') as mock_get:
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.headers = {"ETag": '"abc"', "Last-Modified": "Wed, 01 Jan 2025 00:00:00 GMT"}
+        mock_response.text = "Valid CSV data"
+        mock_get.return_value = mock_response
+
+        assert occ.volume_csv_month_get("http://test.com", test_date, "csv") == "Valid CSV data"
+        assert mock_get.call_args.kwargs['headers'] == {}
+
+        mock_response.status_code = 304
+        result = occ.volume_csv_month_get("http://test.com", test_date, "csv", conditional=True)
+
+        assert result is None
+        assert mock_get.call_args.kwargs['headers'] == {
+            "If-None-Match": '"abc"',
+            "If-Modified-Since": "Wed, 01 Jan 2025 00:00:00 GMT",
+        }
+        assert occ.get_volume_by_month_to_df("http://test.com", test_date, "csv", conditional=True) is None
+    occ.set_validators({})
+
+
+def test_volume_csv_month_get_retries_throttled_requests():
+    """Test that 503 responses are retried honoring Retry-After and slow the shared rate limiter"""
+    test_date = date(2024, 1, 1)
+    throttled = Mock(status_code=503, headers={"Retry-After": "7"})
+    ok = Mock(status_code=200, headers={}, text="Valid CSV data")
+    occ.configure_retries(retries=2, backoff_base=1.0, backoff_max=60.0)
+    occ.configure_rate_limit(rate=100, burst=10)
+    try:
+        with patch('common.occ.requests.Session.get', side_effect=[throttled, ok]) as mock_get, \
+             patch('common.occ.time.sleep') as mock_sleep:
+            assert occ.volume_csv_month_get("http://test.com", test_date, "csv") == "Valid CSV data"
+
+        assert mock_get.call_count == 2
+        mock_sleep.assert_called_once_with(7.0)
+        # Halved by the 503, then recovered by a tenth of the maximum on success
+        assert occ._rate_limiter.rate == 60
+    finally:
+        occ.configure_retries()
+        occ.configure_rate_limit()
+
+
+def test_volume_csv_month_get_retries_exhausted():
+    """Test that timeouts are retried with backoff and then raised as TimeoutError"""
+    test_date = date(2024, 1, 1)
+    occ.configure_retries(retries=2, backoff_base=1.0, backoff_max=3.0)
+    try:
+        with patch('common.occ.requests.Session.get', side_effect=requests.exceptions.Timeout()) as mock_get, \
+             patch('common.occ.time.sleep') as mock_sleep:
+            with pytest.raises(TimeoutError):
+                occ.volume_csv_month_get("http://test.com", test_date, "csv")
+
+        assert mock_get.call_count == 3
+        delays = [c.args[0] for c in mock_sleep.call_args_list]
+        assert 0 <= delays[0] <= 1.0 and 0 <= delays[1] <= 2.0
+    finally:
+        occ.configure_retries()
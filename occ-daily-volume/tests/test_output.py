@@ -0,0 +1,80 @@
+"""
+Tests for common/output.py and the dataframe writers
+"""
+import io
+import json
+import sys
+import os
+from datetime import date
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import dataframe
+from common import output
+
+
+COLUMNS = ['Date', 'OCC Total', 'OCC Total Max Date']
+ROWS = [
+    (date(2024, 1, 2), 40_000, date(2024, 1, 3)),
+    (date(2024, 2, 1), float('nan'), None),
+    (date(2024, 2, 2), float('inf'), None),
+]
+
+
+def test_write_rows_csv():
+    """Test CSV output writes ISO dates, empty fields for missing values and a header without rows"""
+    out = io.StringIO()
+    assert output.write_rows(COLUMNS, iter(ROWS), "csv", out=out) == 3
+    assert out.getvalue() == (
+        "Date,OCC Total,OCC Total Max Date\n"
+        "2024-01-02,40000,2024-01-03\n"
+        "2024-02-01,,\n"
+        "2024-02-02,,\n"
+    )
+    out = io.StringIO()
+    assert output.write_rows(*dataframe.df_rows(pd.DataFrame(index=pd.DatetimeIndex([], name='Date'))), "csv", out=out) == 0
+    assert out.getvalue() == "Date\n"
+
+
+def test_write_rows_json():
+    """Test JSON and NDJSON output hold the same records, with nulls for missing values and infinities"""
+    expected = [
+        {'Date': '2024-01-02', 'OCC Total': 40000, 'OCC Total Max Date': '2024-01-03'},
+        {'Date': '2024-02-01', 'OCC Total': None, 'OCC Total Max Date': None},
+        {'Date': '2024-02-02', 'OCC Total': None, 'OCC Total Max Date': None},
+    ]
+    out = io.StringIO()
+    output.write_rows(COLUMNS, iter(ROWS), "json", out=out)
+    assert 'Infinity' not in out.getvalue()
+    assert json.loads(out.getvalue()) == expected
+    out = io.StringIO()
+    output.write_rows(COLUMNS, iter(ROWS), "ndjson", out=out)
+    assert [json.loads(line) for line in out.getvalue().splitlines()] == expected
+
+    out = io.StringIO()
+    assert output.write_rows(COLUMNS, iter([]), "json", out=out) == 0
+    assert json.loads(out.getvalue()) == []
+    with pytest.raises(ValueError):
+        output.write_rows(COLUMNS, ROWS, "arrow", out=out)
+
+
+def test_write_arrow():
+    """Test the Arrow IPC stream reads back as the dataframe"""
+    pa = pytest.importorskip("pyarrow")
+    test_df = pd.DataFrame(
+        {
+            'OCC Total': [40_000, 20],
+            'OCC Total Mean': [1.5, float('nan')],
+            'OCC Total Max Date': pd.to_datetime(['2024-01-03', None]),
+        },
+        index=pd.DatetimeIndex(['2024-01-02', '2024-02-01'], name='Date'),
+    )
+    sink = io.BytesIO()
+    dataframe.write_arrow(test_df, sink)
+    table = pa.ipc.open_stream(sink.getvalue()).read_all()
+    assert table.column_names == ['Date', *test_df.columns]
+    assert table.column('OCC Total Mean').null_count == 1
+    pd.testing.assert_frame_equal(table.to_pandas().set_index('Date'), test_df, check_freq=False)
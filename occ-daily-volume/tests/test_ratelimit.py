@@ -0,0 +1,42 @@
+"""
+Tests for common/ratelimit.py
+"""
+import sys
+import os
+import pytest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import ratelimit
+
+
+def test_rate_limiter_waits_for_tokens():
+    """Test that requests beyond the burst wait for the bucket to refill"""
+    with patch('common.ratelimit.time.sleep') as mock_sleep, \
+         patch('common.ratelimit.time.monotonic', side_effect=[0.0, 0.0, 0.0, 0.0, 0.5]):
+        limiter = ratelimit.AdaptiveRateLimiter(rate=2, burst=2)
+        limiter.acquire()
+        limiter.acquire()
+        limiter.acquire()
+
+    mock_sleep.assert_called_once_with(0.5)
+
+
+def test_rate_limiter_adapts_to_throttling():
+    """Test that throttling halves the rate down to the minimum and successes recover it"""
+    limiter = ratelimit.AdaptiveRateLimiter(rate=4, min_rate=1)
+    limiter.on_throttle()
+    assert limiter.rate == 2
+    limiter.on_throttle()
+    limiter.on_throttle()
+    assert limiter.rate == 1
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.rate == 4
+
+
+def test_rate_limiter_rejects_invalid_rate():
+    """Test that a non-positive rate is rejected"""
+    with pytest.raises(ValueError):
+        ratelimit.AdaptiveRateLimiter(rate=0)
@@ -0,0 +1,135 @@
+"""
+Tests for common/server.py
+"""
+import json
+import sys
+import os
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import server
+from common.storage import SqliteStorage
+
+
+def _volume_df(dates, totals):
+    return pd.DataFrame(
+        {'Equity': [t // 2 for t in totals], 'OCC Total': totals},
+        index=pd.DatetimeIndex(dates, name='Date'),
+    )
+
+
+def _storage(tmpdir):
+    storage = SqliteStorage(os.path.join(tmpdir, "test.db"), "volHist")
+    with storage.writer() as writer:
+        writer.write(_volume_df(['2023-12-29', '2024-01-02', '2024-01-03', '2024-02-01'], [10, 40, 30, 20]))
+    return storage
+
+
+def test_service_matches_storage():
+    """Test that in-memory queries answer as the storage does"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = _storage(tmpdir)
+        service = server.VolumeService(storage)
+        queries = (
+            {'number': 2},
+            {'number': 1, 'by': 'year'},
+            {'number': 2, 'column': 'Equity', 'start': date(2024, 1, 3), 'last': 2},
+            {'number': 2, 'granularity': 'month', 'start': date(2024, 1, 15)},
+            {'number': 1, 'granularity': 'year', 'by': 'year'},
+        )
+        for query in queries:
+            pd.testing.assert_frame_equal(
+                service.top_n(**query), storage.query_top_n(**query), check_freq=False, check_dtype=False
+            )
+        assert list(service.date_range(start=date(2024, 1, 1))['OCC Total']) == [40, 30, 20]
+        assert list(service.top_n(1, spike='percentile')['Year Percentile']) == [100.0]
+        for dataset in ('futures', 'options'):
+            with pytest.raises(ValueError, match="not stored"):
+                service.top_n(1, dataset=dataset)
+        with pytest.raises(ValueError):
+            service.top_n(1, granularity='month', by='weekday')
+
+
+def test_service_reloads_changed_months(mocker):
+    """Test that only months the updater wrote since the last load are read again"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = _storage(tmpdir)
+        service = server.VolumeService(storage)
+        assert not service.reload()
+
+        read_table = mocker.spy(storage, "read_table")
+        with storage.writer() as writer:
+            writer.record_fetch(date(2024, 2, 1), "ok")
+            writer.record_fetch(date(2024, 3, 1), "ok")
+            writer.write(_volume_df(['2024-02-01', '2024-02-02', '2024-03-01'], [25, 90, 5]))
+        assert service.reload()
+        assert read_table.call_args.kwargs == {'start': date(2024, 2, 1), 'end': date(2024, 3, 31)}
+        pd.testing.assert_frame_equal(
+            service.date_range(), storage.read_table(), check_freq=False, check_dtype=False
+        )
+
+        # A month journaled before the last load but committed after it is still read,
+        # as in an update running in another process
+        read_table.reset_mock()
+        with storage.writer() as writer:
+            writer.record_fetch(date(2024, 4, 1), "ok")
+            writer.write(_volume_df(['2024-04-01'], [7]))
+            assert not service.reload()
+        assert service.reload()
+        assert read_table.call_args.kwargs == {'start': date(2024, 4, 1), 'end': date(2024, 4, 30)}
+        assert list(service.date_range(start=date(2024, 3, 1))['OCC Total']) == [5, 7]
+
+        # Writes the journal does not explain, or more than one batch, reload the whole table
+        for batches in ([[]], [[date(2024, 4, 1)], [date(2024, 5, 1)]]):
+            read_table.reset_mock()
+            for months in batches:
+                with storage.writer() as writer:
+                    for month in months:
+                        writer.record_fetch(month, "ok")
+                    writer.write(_volume_df(['2023-12-29'], [99]))
+            assert service.reload()
+            assert read_table.call_args.kwargs == {}
+            assert list(service.top_n(1)['OCC Total']) == [99]
+
+
+def test_server_json_api():
+    """Test the HTTP endpoints, answering concurrent requests"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = _storage(tmpdir)
+        http_server = server.VolumeServer(("127.0.0.1", 0), server.VolumeService(storage))
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{http_server.server_address[1]}"
+
+        def get(path):
+            with urllib.request.urlopen(base + path) as response:
+                return json.loads(response.read())
+
+        try:
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                results = list(pool.map(get, ["/top?number=2&start=2024-01-01"] * 8))
+            assert all(result == results[0] for result in results)
+            assert results[0] == [
+                {'Date': '2024-01-02', 'Equity': 20, 'OCC Total': 40},
+                {'Date': '2024-01-03', 'Equity': 15, 'OCC Total': 30},
+            ]
+            assert get("/top?number=1&granularity=year")[0]['OCC Total Max Date'] == '2024-01-02'
+            assert len(get("/range?end=2024-01-02")) == 2
+            assert get("/status")['tables']['volHist']['rows'] == 4
+
+            for path, status in (("/top?column=Nope", 400), ("/top?number=x", 400), ("/other", 404)):
+                with pytest.raises(urllib.error.HTTPError) as e:
+                    get(path)
+                assert e.value.code == status
+                assert 'error' in json.loads(e.value.read())
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
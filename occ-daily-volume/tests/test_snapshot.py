@@ -0,0 +1,69 @@
+"""
+Tests for common/snapshot.py
+"""
+import sys
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import snapshot
+from common.storage import SqliteStorage
+
+
+def _volume_df():
+    return pd.DataFrame(
+        {'Equity': [5, 1, 4, 2], 'OCC Total': [10, 40, 30, 20]},
+        index=pd.DatetimeIndex(['2024-01-01', '2024-01-02', '2024-01-03', '2024-01-04'], name='Date'),
+    )
+
+
+def test_snapshot_queries_match_storage():
+    """Test that snapshot top N and date ranges match the database without loading it"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = SqliteStorage(os.path.join(tmpdir, "test.db"), "volHist")
+        snapshot_dir = os.path.join(tmpdir, "snapshot")
+        assert snapshot.snapshot_load(storage, snapshot_dir) is None
+
+        with storage.writer() as writer:
+            writer.write(_volume_df())
+        snap = snapshot.snapshot_load(storage, snapshot_dir)
+        assert isinstance(snap.columns['OCC Total'], np.memmap)
+        assert len(snap) == 4
+
+        pd.testing.assert_frame_equal(snap.top_n(2), storage.query_top_n(2))
+        assert list(snap.top_n(1, column="Equity")['Equity']) == [5]
+        assert len(snap.top_n(10)) == 4
+        for by in ('year', 'month', 'weekday'):
+            pd.testing.assert_frame_equal(snap.top_n(1, by=by), storage.query_top_n(1, by=by))
+        for window in ({'start': '2024-01-03'}, {'end': '2024-01-02'}, {'last': 2}, {'start': '2024-01-02', 'last': 3}):
+            pd.testing.assert_frame_equal(snap.top_n(2, **window), storage.query_top_n(2, **window))
+            pd.testing.assert_frame_equal(snap.top_n(1, by='weekday', **window), storage.query_top_n(1, by='weekday', **window))
+        with pytest.raises(ValueError, match="Unknown column"):
+            snap.top_n(1, column="Bogus")
+
+        ranged = snap.date_range(start="2024-01-02", end="2024-01-03")
+        pd.testing.assert_frame_equal(ranged, _volume_df().iloc[1:3])
+        assert len(snap.date_range(end="2023-12-31")) == 0
+
+
+def test_snapshot_rebuilt_when_stale():
+    """Test that a write to the database makes the snapshot stale and the next load rebuilds it"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = SqliteStorage(os.path.join(tmpdir, "test.db"), "volHist")
+        snapshot_dir = os.path.join(tmpdir, "snapshot")
+        with storage.writer() as writer:
+            writer.write(_volume_df())
+        old_version = snapshot.snapshot_load(storage, snapshot_dir).version
+
+        with storage.writer() as writer:
+            writer.write(_volume_df().iloc[[0]] * 100)
+        assert snapshot.snapshot_open(snapshot_dir, "volHist", storage.read_version()) is None
+
+        snap = snapshot.snapshot_load(storage, snapshot_dir)
+        assert snap.version != old_version
+        assert list(snap.top_n(1)['OCC Total']) == [1000]
+        assert len(os.listdir(os.path.join(snapshot_dir, "volHist"))) == 2  # CURRENT and one snapshot
@@ -4,6 +4,7 @@ Tests for common/sqlite.py
 import sys
 import os
 import tempfile
+import threading
 from pathlib import Path
 import pytest
 import pandas as pd
@@ -16,37 +17,37 @@ from common import sqlite
 def test_validate_table_name_valid():
     """Test that valid table names pass validation"""
     # Should not raise exception
-    sqlite._validate_table_name("valid_table")
-    sqlite._validate_table_name("table123")
-    sqlite._validate_table_name("Table_Name_123")
-    sqlite._validate_table_name("volHist")
+    sqlite.validate_table_name("valid_table")
+    sqlite.validate_table_name("table123")
+    sqlite.validate_table_name("Table_Name_123")
+    sqlite.validate_table_name("volHist")
 
 
 def test_validate_table_name_invalid_sql_injection():
     """Test that SQL injection attempts are rejected"""
     with pytest.raises(ValueError, match="Invalid table name"):
-        sqlite._validate_table_name("table; DROP TABLE users;")
+        sqlite.validate_table_name("table; DROP TABLE users;")
 
     with pytest.raises(ValueError, match="Invalid table name"):
-        sqlite._validate_table_name("table' OR '1'='1")
+        sqlite.validate_table_name("table' OR '1'='1")
 
     with pytest.raises(ValueError, match="Invalid table name"):
-        sqlite._validate_table_name("table--")
+        sqlite.validate_table_name("table--")
 
 
 def test_validate_table_name_invalid_special_chars():
     """Test that special characters are rejected"""
     with pytest.raises(ValueError, match="Invalid table name"):
-        sqlite._validate_table_name("table-name")
+        sqlite.validate_table_name("table-name")
 
     with pytest.raises(ValueError, match="Invalid table name"):
-        sqlite._validate_table_name("table.name")
+        sqlite.validate_table_name("table.name")
 
     with pytest.raises(ValueError, match="Invalid table name"):
-        sqlite._validate_table_name("table name")
+        sqlite.validate_table_name("table name")
 
     with pytest.raises(ValueError, match="Invalid table name"):
-        sqlite._validate_table_name("table@name")
+        sqlite.validate_table_name("table@name")
 
 
 def test_db_write_df_to_sql_with_context_manager():
@@ -116,3 +117,558 @@ def test_db_read_sql_to_df_with_context_manager():
             result_df = sqlite.db_read_sql_to_df(db_path, "test_table")
             assert len(result_df) == 5
             assert list(result_df.columns) == ['A', 'B']
+
+
+def test_db_validators_round_trip():
+    """Test that HTTP cache validators persist in the database"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        assert sqlite.db_read_validators(db_path) == {}
+
+        validators = {
+            "http://test.com?reportDate=20240101": {"ETag": '"abc"'},
+            "http://test.com?reportDate=20240201": {"Last-Modified": "Thu, 01 Feb 2024 00:00:00 GMT"},
+        }
+        sqlite.db_write_validators(db_path, validators)
+
+        assert sqlite.db_read_validators(db_path) == validators
+
+
+def test_db_write_df_to_sql_upsert():
+    """Test that rewriting a date updates the stored row instead of appending a duplicate"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        test_df = pd.DataFrame(
+            {'Value': [100, 200]},
+            index=pd.DatetimeIndex(['2024-01-01', '2024-01-02'], name='Date'),
+        )
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df * 2)
+
+        result_df = sqlite.db_read_sql_to_df(db_path, "test_table")
+        assert len(result_df) == 2
+        assert list(result_df['Value']) == [200, 400]
+
+
+def test_db_batch_writer_commits_per_batch():
+    """Test that the batch writer commits full batches and rolls back the unfinished one on error"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        frames = [
+            pd.DataFrame(
+                {'Value': [month]},
+                index=pd.DatetimeIndex([f'2024-{month:02d}-01'], name='Date'),
+            )
+            for month in range(1, 6)
+        ]
+
+        with pytest.raises(RuntimeError):
+            with sqlite.DbBatchWriter(db_path, "test_table", batch_size=2) as writer:
+                for frame in frames:
+                    writer.write(frame)
+                raise RuntimeError("crash")
+
+        # Two full batches were committed, the fifth frame was lost
+        result_df = sqlite.db_read_sql_to_df(db_path, "test_table")
+        assert list(result_df['Value']) == [1, 2, 3, 4]
+
+        sqlite.db_write_dfs_to_sql(db_path, "test_table", iter(frames[4:]))
+        assert len(sqlite.db_read_sql_to_df(db_path, "test_table")) == 5
+
+
+def test_db_batch_writer_lazy_connect():
+    """Test that no database file is created when nothing is written"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        with sqlite.DbBatchWriter(db_path, "test_table") as writer:
+            writer.write(pd.DataFrame())
+        assert not Path(db_path).exists()
+
+
+def test_db_batch_writer_second_table_adds_columns():
+    """Test that the batch writer writes a second table in the same transaction and adds new columns"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        contracts = pd.DataFrame(
+            {'OCC Total': [10]}, index=pd.DatetimeIndex(['2024-01-02'], name='Date')
+        )
+        old_futures = pd.DataFrame(
+            {'Debt': [1], 'OCC Total': [2]}, index=pd.DatetimeIndex(['2024-01-02'], name='Date')
+        )
+        new_futures = pd.DataFrame(
+            {'OOF': [3], 'OCC Total': [4]}, index=pd.DatetimeIndex(['2024-02-01'], name='Date')
+        )
+
+        with pytest.raises(RuntimeError):
+            with sqlite.DbBatchWriter(db_path, "contracts") as writer:
+                writer.write(contracts)
+                writer.write(old_futures, db_table="futures")
+                raise RuntimeError("crash")
+        assert sqlite.db_read_sql_to_df(db_path, "contracts").empty
+
+        with sqlite.DbBatchWriter(db_path, "contracts") as writer:
+            writer.write(contracts)
+            writer.write(old_futures, db_table="futures")
+            writer.write(new_futures, db_table="futures")
+
+        futures_df = sqlite.db_read_sql_to_df(db_path, "futures")
+        assert list(futures_df.columns) == ['Debt', 'OCC Total', 'OOF']
+        assert list(futures_df['OCC Total']) == [2, 4]
+        top_df = sqlite.db_query_top_n(db_path, "futures", 1, column="OOF")
+        assert list(top_df['OOF']) == [3]
+
+
+def test_db_migrate_table_deduplicates():
+    """Test that a keyless table written by to_sql is migrated to a Date primary key without duplicates"""
+    import sqlite3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        test_df = pd.DataFrame(
+            {'Value': [100, 200]},
+            index=pd.DatetimeIndex(['2024-01-01', '2024-01-02'], name='Date'),
+        )
+        with sqlite3.connect(db_path) as conn:
+            test_df.to_sql("test_table", conn)
+            (test_df + 1).to_sql("test_table", conn, if_exists="append")
+
+        assert sqlite.db_migrate_table(db_path, "test_table") == 2
+        assert sqlite.db_migrate_table(db_path, "test_table") == 0
+
+        result_df = sqlite.db_read_sql_to_df(db_path, "test_table")
+        assert list(result_df['Value']) == [101, 201]
+        with sqlite3.connect(db_path) as conn:
+            pk = [row[1] for row in conn.execute("PRAGMA table_info(test_table)") if row[5]]
+        assert pk == ['Date']
+
+        # Writes after migration upsert instead of appending
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+        assert list(sqlite.db_read_sql_to_df(db_path, "test_table")['Value']) == [100, 200]
+
+
+def test_db_compact_schema_stores_day_numbers():
+    """Test that dates are stored as INTEGER days since the epoch in a WITHOUT ROWID table"""
+    import sqlite3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        test_df = pd.DataFrame(
+            {'Value': [100, 200]},
+            index=pd.DatetimeIndex(['1970-01-02', '2024-01-01'], name='Date'),
+        )
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+
+        with sqlite3.connect(db_path) as conn:
+            rows = conn.execute('SELECT "Date", typeof("Date"), typeof("Value") FROM test_table').fetchall()
+            schema = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'test_table'").fetchone()[0]
+        assert rows == [(1, 'integer', 'integer'), (19723, 'integer', 'integer')]
+        assert schema.endswith("WITHOUT ROWID")
+
+        result_df = sqlite.db_read_sql_to_df(db_path, "test_table")
+        assert result_df.index.dtype == 'datetime64[ns]'
+        assert result_df['Value'].dtype == 'int64'
+        pd.testing.assert_frame_equal(result_df, test_df)
+
+
+def test_db_migrate_table_text_dates():
+    """Test that a table keyed on text timestamps is migrated to integer day numbers"""
+    import sqlite3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        with sqlite3.connect(db_path) as conn:
+            conn.execute('CREATE TABLE test_table ("Date" TIMESTAMP PRIMARY KEY, "Value" INTEGER)')
+            conn.executemany(
+                "INSERT INTO test_table VALUES (?, ?)",
+                [('2024-01-01 00:00:00', 1), ('2024-02-29 00:00:00', 2)],
+            )
+
+        assert sqlite.db_migrate_table(db_path, "test_table") == 0
+        with sqlite3.connect(db_path) as conn:
+            assert conn.execute('SELECT "Date" FROM test_table').fetchall() == [(19723,), (19782,)]
+
+        result_df = sqlite.db_read_sql_to_df(db_path, "test_table")
+        assert list(result_df.index) == [pd.Timestamp('2024-01-01'), pd.Timestamp('2024-02-29')]
+        from datetime import date
+        assert sqlite.db_read_months(db_path, "test_table") == {date(2024, 1, 1), date(2024, 2, 1)}
+
+
+def test_db_query_top_n():
+    """Test that top N is ranked in SQL by the requested column"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        test_df = pd.DataFrame(
+            {'Equity': [5, 1, 4, 2], 'OCC Total': [10, 40, 30, 20]},
+            index=pd.DatetimeIndex(['2024-01-01', '2024-01-02', '2024-01-03', '2024-01-04'], name='Date'),
+        )
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 2)
+        assert list(result_df['OCC Total']) == [40, 30]
+        assert result_df.index[0] == pd.Timestamp('2024-01-02')
+
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 1, column="Equity")
+        assert list(result_df['Equity']) == [5]
+
+        with pytest.raises(ValueError, match="Unknown column"):
+            sqlite.db_query_top_n(db_path, "test_table", 1, column="Bogus")
+
+        assert len(sqlite.db_query_top_n("/nonexistent/path/test.db", "test_table", 1)) == 0
+        assert len(sqlite.db_query_top_n(db_path, "other_table", 1)) == 0
+
+
+def test_db_query_top_n_by_group():
+    """Test that the top N is selected within each year, month or weekday"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        # Friday, Tuesday, Wednesday, Thursday, Friday
+        test_df = pd.DataFrame(
+            {'Equity': [5, 1, 4, 2, 3], 'OCC Total': [10, 40, 30, 20, 50]},
+            index=pd.DatetimeIndex(['2023-12-29', '2024-01-02', '2024-01-03', '2024-01-04', '2024-02-02'], name='Date'),
+        )
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 2, by="year")
+        assert list(result_df['OCC Total']) == [10, 50, 40]
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 1, column="Equity", by="month")
+        assert list(result_df['Equity']) == [5, 4, 3]
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 1, by="weekday")
+        assert list(result_df.index.day_name()) == ['Tuesday', 'Wednesday', 'Thursday', 'Friday']
+        assert list(result_df['OCC Total']) == [40, 30, 20, 50]
+
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 1, granularity="month", by="year")
+        assert list(result_df['OCC Total Sum']) == [10, 90]
+
+        with pytest.raises(ValueError, match="Unknown grouping"):
+            sqlite.db_query_top_n(db_path, "test_table", 1, by="quarter")
+
+
+def test_db_query_top_n_date_window():
+    """Test that top N only ranks rows inside the requested dates or latest rows"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        test_df = pd.DataFrame(
+            {'OCC Total': [10, 40, 30, 20, 50]},
+            index=pd.DatetimeIndex(['2023-12-29', '2024-01-02', '2024-01-03', '2024-01-04', '2024-02-02'], name='Date'),
+        )
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 2, start='2024-01-01', end='2024-01-31')
+        assert list(result_df['OCC Total']) == [40, 30]
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 5, last=2)
+        assert list(result_df['OCC Total']) == [50, 20]
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 1, end='2024-01-03', last=2)
+        assert list(result_df['OCC Total']) == [40]
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 5, by="month", start='2024-01-03')
+        assert list(result_df['OCC Total']) == [30, 20, 50]
+        assert sqlite.db_query_top_n(db_path, "test_table", 5, end='2020-01-01').empty
+
+        # Months overlapping the window are ranked whole
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 5, granularity="month", start='2024-01-15')
+        assert list(result_df['OCC Total Sum']) == [90, 50]
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 5, granularity="month", last=1)
+        assert list(result_df.index) == [pd.Timestamp('2024-02-01')]
+
+        with pytest.raises(ValueError, match="positive number"):
+            sqlite.db_query_top_n(db_path, "test_table", 5, last=0)
+
+
+def test_db_aggregates_maintained_on_write():
+    """Test that monthly and yearly aggregates follow daily writes, including revised days"""
+    import sqlite3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        test_df = pd.DataFrame(
+            {'Equity': [5, 1, 4, 2], 'OCC Total': [10, 40, 30, 20]},
+            index=pd.DatetimeIndex(['2023-12-29', '2024-01-02', '2024-01-03', '2024-02-01'], name='Date'),
+        )
+        with sqlite.DbBatchWriter(db_path, "test_table", batch_size=1) as writer:
+            writer.write(test_df.iloc[:3])
+            writer.write(test_df.iloc[3:])
+
+        monthly_df = sqlite.db_query_top_n(db_path, "test_table", 10, granularity="month")
+        assert list(monthly_df.index) == [pd.Timestamp('2024-01-01'), pd.Timestamp('2024-02-01'), pd.Timestamp('2023-12-01')]
+        assert list(monthly_df['OCC Total Sum']) == [70, 20, 10]
+        assert list(monthly_df['OCC Total Mean']) == [35, 20, 10]
+        assert monthly_df['OCC Total Max Date'].iloc[0] == pd.Timestamp('2024-01-02')
+        assert list(monthly_df['Trading Days']) == [2, 1, 1]
+        assert list(monthly_df.columns) == [
+            'OCC Total Sum', 'OCC Total Mean', 'OCC Total Max', 'OCC Total Max Date', 'Trading Days'
+        ]
+
+        # Revising one day updates its month and year only
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df.iloc[[1]] * 0)
+        yearly_df = sqlite.db_query_top_n(db_path, "test_table", 10, column="Equity", granularity="year")
+        assert list(yearly_df['Equity Sum']) == [6, 5]
+        assert yearly_df['Equity Max Date'].iloc[0] == pd.Timestamp('2024-01-03')
+        assert list(sqlite.db_query_top_n(db_path, "test_table", 1, granularity="month")['OCC Total Sum']) == [30]
+
+        with pytest.raises(ValueError, match="Unknown column"):
+            sqlite.db_query_top_n(db_path, "test_table", 1, column="Bogus", granularity="year")
+        with pytest.raises(ValueError, match="Unknown granularity"):
+            sqlite.db_query_top_n(db_path, "test_table", 1, granularity="week")
+
+        # Only the columns queries rank by are indexed, and migrating drops any other index
+        with sqlite3.connect(db_path) as conn:
+            conn.execute('CREATE INDEX ix_test_tableYearly_Trading_Days ON test_tableYearly ("Trading Days")')
+        sqlite.db_migrate_table(db_path, "test_table")
+        with sqlite3.connect(db_path) as conn:
+            indexes = {
+                table: sorted(row[1] for row in conn.execute(f"PRAGMA index_list({table})") if row[1].startswith("ix_"))
+                for table in ("test_table", "test_tableYearly")
+            }
+        assert indexes == {
+            "test_table": ["ix_test_table_Equity", "ix_test_table_OCC_Total"],
+            "test_tableYearly": ["ix_test_tableYearly_Equity_Sum", "ix_test_tableYearly_OCC_Total_Sum"],
+        }
+
+        # Aggregates are built for tables that predate them and dropped with the table
+        with sqlite3.connect(db_path) as conn:
+            conn.execute("DROP TABLE test_tableMonthly")
+        sqlite.db_migrate_table(db_path, "test_table")
+        assert len(sqlite.db_query_top_n(db_path, "test_table", 10, granularity="month")) == 3
+        sqlite.db_drop_table(db_path, "test_table")
+        assert sqlite.db_query_top_n(db_path, "test_table", 10, granularity="year").empty
+
+
+def test_db_query_top_n_cache(mocker):
+    """Test that repeated queries are answered from the cache until the next write"""
+    import sqlite3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        test_df = pd.DataFrame(
+            {'OCC Total': [10, 40, 30]},
+            index=pd.DatetimeIndex(['2024-01-02', '2024-01-03', '2024-02-01'], name='Date'),
+        )
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+        build = mocker.spy(sqlite.common.schema, "db_top_n_query")
+
+        first_df = sqlite.db_query_top_n(db_path, "test_table", 2, by="year", start=pd.Timestamp('2024-01-01'))
+        with sqlite3.connect(db_path) as conn:
+            stored = conn.execute("SELECT stored_at FROM queryCache").fetchall()
+        cached_df = sqlite.db_query_top_n(db_path, "test_table", 2, by="year", start=pd.Timestamp('2024-01-01'))
+        assert build.call_count == 1
+        pd.testing.assert_frame_equal(first_df, cached_df)
+        # A hit writes nothing
+        with sqlite3.connect(db_path) as conn:
+            assert conn.execute("SELECT stored_at FROM queryCache").fetchall() == stored
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 2, granularity="month", by="year")
+        assert build.call_count == 2
+        assert list(result_df['OCC Total Sum']) == [50, 30]
+
+        # Queries without by are answered from the indexes and never cached
+        sqlite.db_query_top_n(db_path, "test_table", 2)
+        sqlite.db_query_top_n(db_path, "test_table", 2)
+        assert build.call_count == 4
+
+        # A write changes the version, so the same query reads the new data
+        sqlite.db_write_df_to_sql(
+            db_path, "test_table", pd.DataFrame({'OCC Total': [90]}, index=pd.DatetimeIndex(['2024-02-02'], name='Date'))
+        )
+        result_df = sqlite.db_query_top_n(db_path, "test_table", 2, by="year", start=pd.Timestamp('2024-01-01'))
+        assert build.call_count == 5
+        assert list(result_df['OCC Total']) == [90, 40]
+
+
+def test_db_query_top_n_cache_evicts_oldest():
+    """Test that the cache keeps only the most recently stored results"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        test_df = pd.DataFrame({'OCC Total': [10, 40]}, index=pd.DatetimeIndex(['2024-01-02', '2024-01-03'], name='Date'))
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+        try:
+            sqlite.configure_query_cache(2)
+            for number in (1, 2, 1, 3):
+                sqlite.db_query_top_n(db_path, "test_table", number, by="month")
+            with sqlite.db_connection(db_path) as conn:
+                keys = [row[0] for row in conn.execute(f"SELECT key FROM {sqlite.QUERY_CACHE_TABLE}")]
+            assert sorted('"number": 3' in key for key in keys) == [False, True]
+            assert any('"number": 2' in key for key in keys)
+
+            sqlite.configure_query_cache(0)
+            sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+            sqlite.db_query_top_n(db_path, "test_table", 1, by="month")
+            with sqlite.db_connection(db_path) as conn:
+                assert conn.execute(f"SELECT COUNT(*) FROM {sqlite.QUERY_CACHE_TABLE}").fetchone()[0] == 0
+            with pytest.raises(ValueError):
+                sqlite.configure_query_cache(-1)
+        finally:
+            sqlite.configure_query_cache()
+
+
+def test_db_query_top_n_cache_size(mocker):
+    """Test that the cache is bounded by size, and caches of the earlier layout are replaced"""
+    import sqlite3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        test_df = pd.DataFrame(
+            {'OCC Total': range(10)}, index=pd.date_range('2024-01-01', periods=10, freq='D', name='Date')
+        )
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+        with sqlite3.connect(db_path) as conn:
+            conn.execute(
+                "CREATE TABLE queryCache (key TEXT PRIMARY KEY, version TEXT NOT NULL, "
+                "columns TEXT NOT NULL, rows TEXT NOT NULL, used INTEGER NOT NULL)"
+            )
+        sqlite.db_query_top_n(db_path, "test_table", 1, by="month")
+        with sqlite3.connect(db_path) as conn:
+            (small,) = conn.execute("SELECT length(rows) FROM queryCache").fetchone()
+
+        mocker.patch.object(sqlite.common.schema, "QUERY_CACHE_BYTES", small * 3)
+        sqlite.db_query_top_n(db_path, "test_table", 10, by="month")
+        for number in (1, 2):
+            sqlite.db_query_top_n(db_path, "test_table", number, by="year")
+        with sqlite3.connect(db_path) as conn:
+            keys = [row[0] for row in conn.execute("SELECT key FROM queryCache")]
+            assert sum(length for (length,) in conn.execute("SELECT length(rows) FROM queryCache")) <= small * 3
+        # The 10 row result is too large to store, and the oldest small one was evicted
+        assert len(keys) == 2 and not any('"number": 10' in key for key in keys)
+        assert not any('"by": "month"' in key for key in keys)
+
+
+def test_db_read_months():
+    """Test that stored months are read with one aggregate query"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        assert sqlite.db_read_months(db_path, "test_table") == set()
+        test_df = pd.DataFrame(
+            {'Value': [1, 2, 3]},
+            index=pd.DatetimeIndex(['2024-01-02', '2024-01-31', '2024-03-01'], name='Date'),
+        )
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+
+        from datetime import date
+        assert sqlite.db_read_months(db_path, "test_table") == {date(2024, 1, 1), date(2024, 3, 1)}
+
+
+def test_db_batch_writer_record_fetch_journal():
+    """Test that fetch outcomes are journaled per month with an attempt count"""
+    from datetime import date
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        assert sqlite.db_read_journal(db_path) == {}
+
+        with sqlite.DbBatchWriter(db_path, "test_table") as writer:
+            writer.record_fetch(date(2024, 1, 1), "failed", "Timeout")
+            writer.record_fetch(date(2024, 2, 1), "unavailable", "not publically available")
+        with sqlite.DbBatchWriter(db_path, "test_table") as writer:
+            writer.record_fetch(date(2024, 1, 1), "ok")
+
+        journal = sqlite.db_read_journal(db_path)
+        assert journal[date(2024, 1, 1)]["status"] == "ok"
+        assert journal[date(2024, 1, 1)]["attempts"] == 2
+        assert journal[date(2024, 1, 1)]["last_error"] is None
+        assert journal[date(2024, 2, 1)]["status"] == "unavailable"
+        assert journal[date(2024, 2, 1)]["attempts"] == 1
+        assert journal[date(2024, 1, 1)]["sections"] is None
+
+
+def test_db_journal_adds_sections_column():
+    """Test that a journal written before sections were recorded gains the column"""
+    import sqlite3
+    from datetime import date
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        with sqlite3.connect(db_path) as conn:
+            conn.execute(
+                "CREATE TABLE fetchJournal (month TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL, last_error TEXT, updated_at TEXT NOT NULL)"
+            )
+            conn.execute("INSERT INTO fetchJournal VALUES ('2024-01', 'ok', 1, NULL, '2024-02-01T00:00:00')")
+        assert sqlite.db_read_journal(db_path)[date(2024, 1, 1)]["sections"] is None
+
+        with sqlite.DbBatchWriter(db_path, "test_table") as writer:
+            writer.record_fetch(date(2024, 2, 1), "ok", sections=["contracts"])
+        journal = sqlite.db_read_journal(db_path)
+        assert journal[date(2024, 2, 1)]["sections"] == ["contracts"]
+        assert journal[date(2024, 1, 1)]["sections"] is None
+
+
+def test_db_connection_shared_wal():
+    """Test that calls reuse one WAL connection per file and readers are not blocked by an open batch"""
+    import sqlite3
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        test_df = pd.DataFrame(
+            {'Value': [1]}, index=pd.DatetimeIndex(['2024-01-01'], name='Date')
+        )
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+        with sqlite.db_connection(db_path) as first, sqlite.db_connection(db_path) as second:
+            assert first is second
+            assert first.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            assert first.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+
+        with sqlite.DbBatchWriter(db_path, "test_table") as writer:
+            writer.write(test_df + 1)
+            # Another process reads the last committed data while the batch is open
+            reader = sqlite3.connect(db_path, timeout=0)
+            assert reader.execute('SELECT "Value" FROM test_table').fetchall() == [(1,)]
+            reader.close()
+            # Shared-connection calls neither see nor commit the open batch, even on error
+            assert list(sqlite.db_read_sql_to_df(db_path, "test_table")['Value']) == [1]
+            with pytest.raises(RuntimeError):
+                with sqlite.db_connection(db_path):
+                    raise RuntimeError("failed read")
+            writer.write(test_df + 2)
+        assert list(sqlite.db_read_sql_to_df(db_path, "test_table")['Value']) == [3]
+
+        # A block inside another leaves the outer block's transaction open
+        with sqlite.db_connection(db_path) as outer:
+            outer.execute('UPDATE test_table SET "Value" = 4')
+            with sqlite.db_connection(db_path):
+                pass
+            assert outer.in_transaction
+        sqlite.close_connections()
+
+
+def test_configure_connections():
+    """Test that pragmas are taken from the config and unknown or unsafe ones are rejected"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        try:
+            sqlite.configure_connections(synchronous="full", busy_timeout=100)
+            with sqlite.db_connection(db_path) as conn:
+                assert conn.execute("PRAGMA synchronous").fetchone()[0] == 2
+                assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 100
+                assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            with pytest.raises(ValueError, match="Unknown pragma"):
+                sqlite.configure_connections(locking_mode="exclusive")
+            with pytest.raises(ValueError, match="Invalid value"):
+                sqlite.configure_connections(synchronous="off; DROP TABLE x")
+        finally:
+            sqlite.configure_connections()
+
+
+def test_db_read_sql_to_df_projection_range_chunks():
+    """Test column projection, date range, chunked reads and dtype downcasting"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = os.path.join(tmpdir, "test.db")
+        dates = pd.date_range('2024-01-01', periods=10, freq='D', name='Date')
+        test_df = pd.DataFrame(
+            {'Equity': range(10), 'OCC Total': [v * 100_000 for v in range(10)]}, index=dates
+        )
+        sqlite.db_write_df_to_sql(db_path, "test_table", test_df)
+
+        result_df = sqlite.db_read_sql_to_df(
+            db_path, "test_table", columns=['OCC Total'], start='2024-01-03', end='2024-01-05'
+        )
+        assert list(result_df.columns) == ['OCC Total']
+        assert list(result_df.index) == list(dates[2:5])
+        assert result_df['OCC Total'].dtype == 'int64'
+
+        chunks = sqlite.db_read_sql_to_df(db_path, "test_table", chunksize=4, downcast=True)
+        first = next(chunks)
+        # Other threads are not kept waiting while the caller holds a chunk
+        reader = threading.Thread(target=sqlite.db_read_version, args=(db_path,))
+        reader.start()
+        reader.join(timeout=5)
+        assert not reader.is_alive()
+        chunks = [first, *chunks]
+        assert [len(c) for c in chunks] == [4, 4, 2]
+        assert all(c['Equity'].dtype == 'int8' and c['OCC Total'].dtype == 'int32' for c in chunks)
+        pd.testing.assert_frame_equal(pd.concat(chunks), test_df, check_dtype=False, check_freq=False)
+
+        with pytest.raises(ValueError, match="Unknown column"):
+            sqlite.db_read_sql_to_df(db_path, "test_table", columns=['Bogus'])
+        # Checked before the first chunk is asked for
+        with pytest.raises(ValueError, match="Unknown column"):
+            sqlite.db_read_sql_to_df(db_path, "test_table", columns=['Bogus'], chunksize=4)
+        assert sqlite.db_read_sql_to_df(db_path, "other_table").empty
+        assert list(sqlite.db_read_sql_to_df(db_path, "other_table", chunksize=4)) == []
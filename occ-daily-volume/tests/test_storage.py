@@ -0,0 +1,120 @@
+"""
+Tests for common/storage.py
+"""
+import sys
+import os
+import tempfile
+from datetime import date
+from pathlib import Path
+import pytest
+import pandas as pd
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import storage
+
+
+def test_storage_from_config():
+    """Test that the backend, paths and tables are taken from the database section"""
+    database_conf = {
+        "backend": "sqlite",
+        "sqlite": {"db_filepath": "data/test.sqlite", "db_table": "volHist", "db_table_futures": "volHistFutures"},
+        "parquet": {"dir": "data/parquet"},
+    }
+    sqlite_storage = storage.storage_from_config(database_conf, "/base")
+    assert isinstance(sqlite_storage, storage.SqliteStorage)
+    assert sqlite_storage.db_filepath == "/base/data/test.sqlite"
+    assert sqlite_storage.tables() == ["volHist", "volHistFutures"]
+
+    database_conf["backend"] = "parquet"
+    parquet_storage = storage.storage_from_config(database_conf, "/base", location="/elsewhere")
+    assert isinstance(parquet_storage, storage.ParquetStorage)
+    assert parquet_storage.data_dir == Path("/elsewhere")
+    assert parquet_storage.dataset_table("futures") == "volHistFutures"
+
+    database_conf["backend"] = "csv"
+    with pytest.raises(ValueError, match="Unknown storage backend"):
+        storage.storage_from_config(database_conf, "/base")
+    # The base class is only an interface
+    with pytest.raises(TypeError):
+        storage.Storage()
+
+
+def test_parquet_storage_round_trip():
+    """Test that the parquet backend upserts into year partitions and ranks like the sqlite backend"""
+    pytest.importorskip("pyarrow")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        parquet_storage = storage.ParquetStorage(tmpdir, "volHist", "volHistFutures")
+        sqlite_storage = storage.SqliteStorage(os.path.join(tmpdir, "test.db"), "volHist", "volHistFutures")
+        contracts = pd.DataFrame(
+            {'Equity': [5, 1, 4], 'OCC Total': [10, 40, 30]},
+            index=pd.DatetimeIndex(['2023-12-29', '2024-01-02', '2024-01-03'], name='Date'),
+        )
+        futures = pd.DataFrame(
+            {'OOF': [7]}, index=pd.DatetimeIndex(['2024-01-02'], name='Date')
+        )
+        for backend in (parquet_storage, sqlite_storage):
+            with backend.writer() as writer:
+                writer.write(contracts)
+                writer.write(futures, db_table=backend.futures_table)
+                writer.record_fetch(date(2024, 1, 1), "failed", "Timeout", ["contracts", "futures"])
+            with backend.writer() as writer:
+                writer.write(contracts.iloc[[0]] * 10)
+                writer.record_fetch(date(2024, 1, 1), "ok")
+            backend.write_validators({"http://x": {"ETag": "abc"}})
+
+        assert sorted(p.parent.name for p in Path(tmpdir, "volHist").glob("*/*.parquet")) == ['year=2023', 'year=2024']
+        for column in ('OCC Total', 'Equity'):
+            pd.testing.assert_frame_equal(
+                parquet_storage.query_top_n(2, column=column),
+                sqlite_storage.query_top_n(2, column=column),
+                check_dtype=False,
+                check_index_type=False,
+            )
+        for granularity in ('month', 'year'):
+            pd.testing.assert_frame_equal(
+                parquet_storage.query_top_n(2, granularity=granularity),
+                sqlite_storage.query_top_n(2, granularity=granularity),
+                check_dtype=False,
+                check_index_type=False,
+            )
+        for granularity, by in (('day', 'year'), ('day', 'weekday'), ('month', 'year')):
+            pd.testing.assert_frame_equal(
+                parquet_storage.query_top_n(1, granularity=granularity, by=by),
+                sqlite_storage.query_top_n(1, granularity=granularity, by=by),
+                check_dtype=False,
+                check_index_type=False,
+            )
+        windows = (
+            ('day', {'start': '2024-01-01'}),
+            ('day', {'last': 2}),
+            ('month', {'end': '2023-12-31'}),
+            ('month', {'start': '2024-01-03', 'last': 1}),
+        )
+        for granularity, window in windows:
+            pd.testing.assert_frame_equal(
+                parquet_storage.query_top_n(5, granularity=granularity, **window),
+                sqlite_storage.query_top_n(5, granularity=granularity, **window),
+                check_dtype=False,
+                check_index_type=False,
+            )
+        assert list(parquet_storage.query_top_n(1, column="OOF", db_table="volHistFutures")['OOF']) == [7]
+        assert parquet_storage.read_months() == {date(2023, 12, 1), date(2024, 1, 1)}
+        for backend in (parquet_storage, sqlite_storage):
+            assert backend.read_months("volHistFutures") == {date(2024, 1, 1)}
+            journal = backend.read_journal()[date(2024, 1, 1)]
+            # Sections recorded earlier are kept when a fetch does not report them
+            assert (journal["status"], journal["attempts"], journal["sections"]) == ("ok", 2, ["contracts", "futures"])
+        assert parquet_storage.read_validators() == {"http://x": {"ETag": "abc"}}
+
+        for backend in (parquet_storage, sqlite_storage):
+            ranged = backend.read_table(columns=['OCC Total'], start='2024-01-01', end='2024-01-02')
+            assert list(ranged.columns) == ['OCC Total']
+            assert list(ranged.index) == [pd.Timestamp('2024-01-02')]
+            assert list(backend.read_table(end='2023-12-31')['OCC Total']) == [100]
+
+        assert parquet_storage.query_top_n(5, granularity='year', end='2020-12-31').empty
+        with pytest.raises(ValueError, match="Unknown column"):
+            parquet_storage.query_top_n(1, column="Bogus")
+        parquet_storage.drop("volHist")
+        assert parquet_storage.query_top_n(1).empty
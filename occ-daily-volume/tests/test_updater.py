@@ -2,6 +2,7 @@
 Tests for common/updater.py
 """
 from datetime import date
+from dateutil.relativedelta import relativedelta
 import pandas as pd
 from unittest.mock import MagicMock, patch
 import sys
@@ -9,24 +10,25 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from common import updater
+from common.storage import SqliteStorage
 
 def test_backfill_db_to_previous_month_empty_db(mocker):
     """
     Test the backfill_db_to_previous_month function with an empty database
     """
     # Mock the sqlite functions
-    mocker.patch('common.sqlite.db_read_sql_to_df', return_value=pd.DataFrame())
-    mock_db_write = mocker.patch('common.sqlite.db_write_df_to_sql')
+    mocker.patch('common.sqlite.db_read_months', return_value=set())
+    mock_batch_writer = mocker.patch('common.sqlite.DbBatchWriter')
 
     # Mock the occ function
-    mock_get_volume = mocker.patch('common.occ.get_volume_by_month_to_df', return_value=pd.DataFrame({'A': [1, 2, 3]}))
+    mock_get_volume = mocker.patch('common.occ.get_volume_by_month_to_dfs', return_value={'contracts': pd.DataFrame({'A': [1, 2, 3]}), 'futures': None})
 
     # Call the function
-    updater.backfill_db_to_previous_month("http://fake.url", "csv", "fake.db", "fake_table")
+    updater.backfill_db_to_previous_month("http://fake.url", "csv", SqliteStorage("fake.db", "fake_table"))
 
     # Assert that the functions were called
     mock_get_volume.assert_called()
-    mock_db_write.assert_called()
+    mock_batch_writer.return_value.__enter__.return_value.write.assert_called()
 
 def test_backfill_db_to_previous_month_up_to_date_db(mocker):
     """
@@ -35,16 +37,193 @@ def test_backfill_db_to_previous_month_up_to_date_db(mocker):
     # Mock the sqlite functions
     today = date.today()
     backfill_end_date = date(2008, 1, 1)
-    mock_df = pd.DataFrame(index=pd.to_datetime(pd.date_range(start=backfill_end_date, end=today, freq='MS')))
-    mocker.patch('common.sqlite.db_read_sql_to_df', return_value=mock_df)
-    mock_db_write = mocker.patch('common.sqlite.db_write_df_to_sql')
+    present = {d.date() for d in pd.date_range(start=backfill_end_date, end=today, freq='MS')}
+    mocker.patch('common.sqlite.db_read_months', return_value=present)
+    mock_batch_writer = mocker.patch('common.sqlite.DbBatchWriter')
 
     # Mock the occ function
-    mock_get_volume = mocker.patch('common.occ.get_volume_by_month_to_df')
+    mock_get_volume = mocker.patch('common.occ.get_volume_by_month_to_dfs')
 
     # Call the function
-    updater.backfill_db_to_previous_month("http://fake.url", "csv", "fake.db", "fake_table")
+    updater.backfill_db_to_previous_month("http://fake.url", "csv", SqliteStorage("fake.db", "fake_table"))
 
     # Assert that the functions were not called
     mock_get_volume.assert_not_called()
-    mock_db_write.assert_not_called()
+    mock_batch_writer.assert_not_called()
+
+def test_plan_update_finds_interior_gaps(mocker):
+    """
+    Test that the planner returns every missing month, including gaps inside the stored range
+    """
+    prev_month = date.today() + relativedelta(day=1) - relativedelta(months=1)
+    present = {d.date() for d in pd.date_range(start=date(2008, 1, 1), end=prev_month, freq='MS')}
+    present -= {date(2012, 5, 1), date(2019, 11, 1), prev_month}
+    mocker.patch('common.sqlite.db_read_months', return_value=present)
+
+    missing, refresh = updater.plan_update(SqliteStorage("fake.db", "fake_table"), refresh_months=2)
+
+    assert missing == [prev_month, date(2019, 11, 1), date(2012, 5, 1)]
+    assert refresh == sorted(present, reverse=True)[:2]
+
+def test_fill_months_concurrent_single_writer(mocker):
+    """
+    Test that concurrent fetching writes every fetched month from the calling thread and skips failures
+    """
+    import threading
+    months = [date(2020, m, 1) for m in range(1, 7)]
+    main_thread = threading.get_ident()
+    write_threads = []
+
+    def fake_get_volume(req_url, req_date, req_format, **kwargs):
+        if req_date.month == 2:
+            raise ValueError("Unavailable")
+        if req_date.month == 3:
+            raise TimeoutError("Timeout")
+        return {'contracts': pd.DataFrame({'A': [req_date.month]}), 'futures': None}
+
+    mocker.patch('common.occ.get_volume_by_month_to_dfs', side_effect=fake_get_volume)
+    mock_batch_writer = mocker.patch('common.sqlite.DbBatchWriter')
+    mock_write = mock_batch_writer.return_value.__enter__.return_value.write
+    mock_write.side_effect = lambda df, **kwargs: write_threads.append(threading.get_ident())
+
+    updater.fill_months("http://fake.url", "csv", SqliteStorage("fake.db", "fake_table"), months, fetch_workers=3)
+
+    mock_batch_writer.assert_called_once_with("fake.db", "fake_table", batch_size=12)
+    assert mock_write.call_count == 4
+    assert set(write_threads) == {main_thread}
+    written = [c.args[0]['A'][0] for c in mock_write.call_args_list]
+    assert written == [1, 4, 5, 6]
+
+
+def test_rebuild_db_from_cache(mocker):
+    """
+    Test that an offline rebuild rewrites cached months in one batch without dropping stored ones
+    """
+    cached = [date(2020, 1, 1), date(2020, 2, 1)]
+    mocker.patch('common.cache.cache_months', return_value=cached)
+    mock_drop = mocker.patch('common.sqlite.db_drop_table')
+    mock_batch_writer = mocker.patch('common.sqlite.DbBatchWriter')
+    mock_write = mock_batch_writer.return_value.__enter__.return_value.write
+    mock_from_cache = mocker.patch(
+        'common.occ.get_volume_by_month_from_cache',
+        side_effect=[{'contracts': pd.DataFrame({'A': [1]}), 'futures': None}, ValueError("corrupt")],
+    )
+    mock_get_volume = mocker.patch('common.occ.get_volume_by_month_to_dfs')
+
+    updater.rebuild_db_from_cache("cache", "csv", SqliteStorage("fake.db", "fake_table"))
+
+    mock_drop.assert_not_called()
+    mock_batch_writer.assert_called_once_with("fake.db", "fake_table", batch_size=2)
+    assert mock_from_cache.call_count == 2
+    assert mock_write.call_count == 1
+    mock_get_volume.assert_not_called()
+
+
+def test_rebuild_db_from_cache_keeps_uncached_months(mocker):
+    """
+    Test that months missing from the cache survive an offline rebuild, and a failed rebuild changes nothing
+    """
+    import tempfile
+    import pytest
+    with tempfile.TemporaryDirectory() as tmpdir:
+        storage = SqliteStorage(os.path.join(tmpdir, "test.db"), "volHist")
+        index = pd.DatetimeIndex(['2019-12-02', '2020-01-02'], name='Date')
+        with storage.writer() as writer:
+            writer.write(pd.DataFrame({'OCC Total': [10, 20]}, index=index))
+        mocker.patch('common.cache.cache_months', return_value=[date(2020, 1, 1), date(2020, 2, 1)])
+        cached = {
+            date(2020, 1, 1): pd.DataFrame({'OCC Total': [25]}, index=pd.DatetimeIndex(['2020-01-02'], name='Date')),
+            date(2020, 2, 1): pd.DataFrame({'OCC Total': [30]}, index=pd.DatetimeIndex(['2020-02-03'], name='Date')),
+        }
+        mocker.patch(
+            'common.occ.get_volume_by_month_from_cache',
+            side_effect=lambda cache_dir, req_date, req_format: {'contracts': cached[req_date], 'futures': None},
+        )
+
+        updater.rebuild_db_from_cache("cache", "csv", storage)
+        assert list(storage.read_table()['OCC Total']) == [10, 25, 30]
+
+        mocker.patch('common.occ.get_volume_by_month_from_cache', side_effect=[
+            {'contracts': cached[date(2020, 1, 1)] * 2, 'futures': None}, OSError("disk"),
+        ])
+        with pytest.raises(OSError):
+            updater.rebuild_db_from_cache("cache", "csv", storage)
+        assert list(storage.read_table()['OCC Total']) == [10, 25, 30]
+
+
+def test_plan_update_uses_journal(mocker):
+    """
+    Test that the planner never re-requests unavailable months and backs off failed ones
+    """
+    from datetime import datetime, timedelta
+    prev_month = date.today() + relativedelta(day=1) - relativedelta(months=1)
+    present = {d.date() for d in pd.date_range(start=date(2008, 4, 1), end=prev_month, freq='MS')}
+    now = datetime.now()
+    journal = {
+        date(2008, 1, 1): {"status": "unavailable", "attempts": 1, "last_error": "", "updated_at": now},
+        # Third failure an hour ago must wait 4 hours
+        date(2008, 2, 1): {"status": "failed", "attempts": 3, "last_error": "", "updated_at": now - timedelta(hours=1)},
+        # First failure two hours ago is due again
+        date(2008, 3, 1): {"status": "failed", "attempts": 1, "last_error": "", "updated_at": now - timedelta(hours=2)},
+    }
+    mocker.patch('common.sqlite.db_read_months', return_value=present)
+    mocker.patch('common.sqlite.db_read_journal', return_value=journal)
+
+    missing, _ = updater.plan_update(SqliteStorage("fake.db", "fake_table"))
+
+    assert missing == [date(2008, 3, 1)]
+
+
+def test_plan_update_backfills_futures(mocker):
+    """
+    Test that stored months without futures rows are planned unless their report had no futures section
+    """
+    from datetime import datetime
+    prev_month = date.today() + relativedelta(day=1) - relativedelta(months=1)
+    present = {d.date() for d in pd.date_range(start=date(2008, 1, 1), end=prev_month, freq='MS')}
+    futures = present - {date(2010, 1, 1), date(2010, 2, 1), date(2010, 3, 1)}
+    now = datetime.now()
+    journal = {
+        # Fetched before futures were stored
+        date(2010, 1, 1): {"status": "ok", "attempts": 1, "last_error": None, "updated_at": now, "sections": None},
+        # Report had no futures section
+        date(2010, 2, 1): {"status": "ok", "attempts": 1, "last_error": None, "updated_at": now, "sections": ["contracts"]},
+    }
+    mocker.patch(
+        'common.sqlite.db_read_months',
+        side_effect=lambda db_filepath, db_table: futures if db_table == "futures_table" else present,
+    )
+    mocker.patch('common.sqlite.db_read_journal', return_value=journal)
+
+    missing, _ = updater.plan_update(SqliteStorage("fake.db", "fake_table", futures_table="futures_table"))
+    assert missing == [date(2010, 3, 1), date(2010, 1, 1)]
+    missing, _ = updater.plan_update(SqliteStorage("fake.db", "fake_table"))
+    assert missing == []
+
+
+def test_fill_months_journals_status(mocker):
+    """
+    Test that every fetched month is journaled, and only past months are marked permanently unavailable
+    """
+    from common import occ
+    prev_month = date.today() + relativedelta(day=1) - relativedelta(months=1)
+    months = [prev_month, date(2010, 1, 1), date(2010, 2, 1), date(2010, 3, 1)]
+    mocker.patch('common.occ.get_volume_by_month_to_dfs', side_effect=[
+        occ.ReportUnavailableError("not publically available"),
+        occ.ReportUnavailableError("not publically available"),
+        TimeoutError("Timeout"),
+        {'contracts': pd.DataFrame({'A': [1]}), 'futures': None},
+    ])
+    mock_batch_writer = mocker.patch('common.sqlite.DbBatchWriter')
+    writer = mock_batch_writer.return_value.__enter__.return_value
+
+    updater.fill_months("http://fake.url", "csv", SqliteStorage("fake.db", "fake_table"), months)
+
+    statuses = [c.args[:2] for c in writer.record_fetch.call_args_list]
+    assert statuses == [
+        (prev_month, "failed"),
+        (date(2010, 1, 1), "unavailable"),
+        (date(2010, 2, 1), "failed"),
+        (date(2010, 3, 1), "ok"),
+    ]
+    assert writer.write.call_count == 1
@@ -13,6 +13,7 @@ from unittest.mock import patch, MagicMock
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from common import dataframe
+from common import schema
 from common import logging as common_logging
 from common import yaml as common_yaml
 
@@ -44,6 +45,58 @@ def test_pretty_print_df(capsys):
     # Check for position index (column with empty name)
     assert " 1 |" in output or "| 1 |" in output
 
+def test_format_numbers():
+    """Test vectorized formatting matches str.format with thousands separators"""
+    values = [0, 7, 999.5, 1000, -1234567.4, 12345678901234, float('nan'), 2.675, float('inf'), float('-inf')]
+    assert list(dataframe.format_numbers(values)) == [
+        '0', '7', '1,000', '1,000', '-1,234,567', '12,345,678,901,234', 'nan', '3', 'inf', '-inf'
+    ]
+    assert list(dataframe.format_numbers(values, decimals=2)) == [
+        f'{v:,.2f}' if v == v else 'nan' for v in values
+    ]
+    assert len(dataframe.format_numbers([])) == 0
+
+
+def test_pretty_print_df_columns(capsys, mocker):
+    """Test that date and score columns are formatted and the table is printed row by row"""
+    df = pd.DataFrame({
+        'OCC Total': [1234567, None],
+        'OCC Total Max Date': pd.to_datetime(['2024-01-03', None]),
+        'Z-Score': [3.14159, -0.5],
+    }, index=pd.to_datetime(['2024-01-01', '2024-02-01']).rename('Date'))
+    import builtins
+    print_spy = mocker.spy(builtins, 'print')
+
+    dataframe.pretty_print_df(df, date_format='%Y-%m', decimals={'Z-Score': 2})
+
+    lines = capsys.readouterr().out.splitlines()
+    assert print_spy.call_count == len(lines) == 6
+    assert lines[1] == '|    |    Date |   OCC Total |   OCC Total Max Date |   Z-Score |'
+    assert lines[3] == '|  1 | 2024-01 |   1,234,567 |           2024-01-03 |      3.14 |'
+    assert lines[4] == '|  2 | 2024-02 |         nan |                      |     -0.50 |'
+
+
+def test_volume_aggregate_df():
+    """Test monthly aggregates, including a month with no values in a column"""
+    df = pd.DataFrame(
+        {'OCC Total': [10, 40, 30, None]},
+        index=pd.DatetimeIndex(['2024-01-02', '2024-01-03', '2024-02-01', '2024-03-01'], name='Date'),
+    )
+    aggregate_df = dataframe.volume_aggregate_df(df, "month")
+    assert list(aggregate_df.index) == list(pd.to_datetime(['2024-01-01', '2024-02-01', '2024-03-01']))
+    assert list(aggregate_df.columns) == schema.aggregate_columns('OCC Total')
+    assert aggregate_df['OCC Total Sum'].iloc[0] == 50
+    assert aggregate_df['OCC Total Max Date'].iloc[0] == pd.Timestamp('2024-01-03')
+    assert pd.isna(aggregate_df['OCC Total Sum'].iloc[2])
+    assert pd.isna(aggregate_df['OCC Total Max Date'].iloc[2])
+    assert list(aggregate_df['Trading Days']) == [2, 1, 1]
+
+    yearly_df = dataframe.volume_aggregate_df(df, "year")
+    assert list(yearly_df['OCC Total Sum']) == [80]
+
+    dataframe.pretty_print_df(aggregate_df, date_format='%Y-%m')
+
+
 # --- common.logging tests ---
 
 @patch('logging.config.dictConfig')
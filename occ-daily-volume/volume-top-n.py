@@ -8,39 +8,216 @@ Project available on GitHub: https://github.com/nomad64/occdailyvolume
 """
 
 import argparse
+import itertools
 import logging
 import os
+import sys
+from datetime import date
 
-import common.dataframe
+import common.fastpath
 import common.logging
-import common.sqlite
-import common.updater
+import common.output
+import common.schema
 import common.yaml
 
+# How the period of each ranked row is shown
+DATE_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+# Address of --serve when none is given, local connections only
+SERVE_ADDRESS = ("127.0.0.1", 8064)
+
+
+def print_empty_result(args_, db_table: str, columns: list) -> None:
+    # Machine-readable formats get an empty result on stdout and the reason on stderr
+    stream = sys.stdout if args_.format == "table" else sys.stderr
+    if args_.start or args_.end:
+        print(
+            f"No volume data in {db_table} between {args_.start or 'the start'} and {args_.end or 'today'}",
+            file=stream,
+        )
+    else:
+        print(f"No volume data in {db_table}, run with --update first", file=stream)
+    if args_.format in ("csv", "json", "ndjson"):
+        # CSV still gets its header line
+        common.output.write_rows(columns, [], args_.format)
+
 
 def main(args_):
     script_dir = os.path.dirname(os.path.abspath(__file__))
     if not os.path.isabs(args_.config):
         args_.config = os.path.join(script_dir, args_.config)
     yaml_conf = common.yaml.yaml_import_config(args_.config)
-    if args_.database:
-        database_filepath = args_.database
-    else:
-        database_filepath = yaml_conf["database"]["sqlite"]["db_filepath"]
-    if not os.path.isabs(database_filepath):
-        database_filepath = os.path.join(script_dir, database_filepath)
-    if args_.update:
+    date_format = DATE_FORMATS[args_.granularity]
+    if args_.by == "weekday":
+        date_format += " %a"
+    # Arrow output is built from numpy arrays, so needs the full code path
+    if not (args_.update or args_.plan or args_.offline or args_.spike or args_.serve or args_.format == "arrow"):
+        try:
+            found = common.fastpath.query_top_n(
+                yaml_conf["database"],
+                base_dir=script_dir,
+                location=args_.database,
+                dataset=args_.dataset,
+                number=args_.number,
+                column=args_.column,
+                granularity=args_.granularity,
+                by=args_.by,
+                start=args_.start,
+                end=args_.end,
+                last=args_.last,
+            )
+        except ValueError as e:
+            # e.g. an unknown --column
+            raise SystemExit(f"error: {e}")
+        if found is not None:
+            columns, rows = found
+            first = next(rows, None)
+            if first is None:
+                sqlite_conf = yaml_conf["database"]["sqlite"]
+                db_table = sqlite_conf["db_table_futures" if args_.dataset == "futures" else "db_table"]
+                print_empty_result(args_, db_table, columns)
+                return
+            rows = itertools.chain([first], rows)
+            if args_.format == "table":
+                common.fastpath.print_top_n(columns, rows, date_format=date_format)
+            else:
+                common.output.write_rows(columns, common.fastpath.decode_rows(columns, rows), args_.format)
+            return
+    run(args_, yaml_conf, script_dir, date_format)
+
+
+def run(args_, yaml_conf, script_dir, date_format):
+    # Imported here so read-only queries answered by common.fastpath never load pandas,
+    # numpy or requests
+    import common.analytics
+    import common.cache
+    import common.dataframe
+    import common.occ
+    import common.server
+    import common.snapshot
+    import common.storage
+    import common.updater
+
+    storage = common.storage.storage_from_config(
+        yaml_conf["database"], base_dir=script_dir, location=args_.database
+    )
+    storage.migrate()
+    cache_conf = yaml_conf.get("cache") or {}
+    cache_dir = cache_conf.get("dir")
+    if cache_dir and not os.path.isabs(cache_dir):
+        cache_dir = os.path.join(script_dir, cache_dir)
+    snapshot_dir = (yaml_conf.get("snapshot") or {}).get("dir")
+    if snapshot_dir and not os.path.isabs(snapshot_dir):
+        snapshot_dir = os.path.join(script_dir, snapshot_dir)
+    if args_.plan:
+        missing, refresh = common.updater.plan_update(
+            storage=storage,
+            refresh_months=yaml_conf["occweb"].get("refresh_months", 0),
+        )
+        print(f"{len(missing)} missing months would be fetched")
+        for month in missing:
+            print(f"  {month.strftime('%Y-%m')}")
+        print(f"{len(refresh)} stored months would be checked for revisions")
+        for month in refresh:
+            print(f"  {month.strftime('%Y-%m')}")
+        return
+    if args_.offline:
+        if not cache_dir:
+            raise SystemExit("--offline requires a cache dir in the config file")
+        common.updater.rebuild_db_from_cache(
+            cache_dir=cache_dir,
+            req_format=yaml_conf["occweb"]["daily_volume_format"],
+            storage=storage,
+        )
+    elif args_.update:
+        common.occ.configure_retries(
+            retries=yaml_conf["occweb"].get("retries", 0),
+            backoff_base=yaml_conf["occweb"].get("backoff_base", 1.0),
+            backoff_max=yaml_conf["occweb"].get("backoff_max", 60.0),
+        )
+        common.occ.configure_rate_limit(
+            rate=yaml_conf["occweb"].get("rate_limit"),
+            burst=yaml_conf["occweb"].get("fetch_workers", 1),
+        )
         common.updater.backfill_db_to_previous_month(
             req_url=yaml_conf["occweb"]["daily_volume_url"],
             req_format=yaml_conf["occweb"]["daily_volume_format"],
-            db_filepath=database_filepath,
-            db_table=yaml_conf["database"]["sqlite"]["db_table"],
+            storage=storage,
+            fetch_workers=yaml_conf["occweb"].get("fetch_workers", 1),
+            refresh_months=yaml_conf["occweb"].get("refresh_months", 0),
+            cache_dir=cache_dir,
         )
-    volume_df = common.sqlite.db_read_sql_to_df(
-        db_filepath=database_filepath,
-        db_table=yaml_conf["database"]["sqlite"]["db_table"],
-    )
-    common.dataframe.pretty_print_df(volume_df.nlargest(args_.number, "OCC Total"))
+        if cache_dir:
+            common.cache.cache_evict(
+                cache_dir,
+                max_bytes=cache_conf.get("max_bytes"),
+                max_age_days=cache_conf.get("max_age_days"),
+            )
+    if snapshot_dir and (args_.update or args_.offline):
+        for table in storage.tables():
+            common.snapshot.snapshot_load(storage, snapshot_dir, table)
+    if args_.serve:
+        common.server.serve(storage, host=args_.serve[0], port=args_.serve[1])
+        return
+    db_table = storage.dataset_table(args_.dataset)
+    if not db_table:
+        raise SystemExit("--dataset futures requires db_table_futures in the config file")
+    # Queries only use a snapshot that is already current; they are rebuilt by updates
+    version = snapshot_dir and args_.granularity == "day" and storage.read_version()
+    snapshot = version and common.snapshot.snapshot_open(snapshot_dir, db_table, version)
+    try:
+        if args_.spike:
+            volume_df = common.analytics.query_spikes(
+                storage,
+                number=args_.number,
+                column=args_.column,
+                db_table=db_table,
+                snapshot=snapshot or None,
+                metric=args_.spike,
+                window=args_.window,
+                by=args_.by,
+                start=args_.start,
+                end=args_.end,
+                last=args_.last,
+            )
+        elif snapshot:
+            volume_df = snapshot.top_n(
+                number=args_.number,
+                column=args_.column,
+                by=args_.by,
+                start=args_.start,
+                end=args_.end,
+                last=args_.last,
+            )
+        else:
+            volume_df = storage.query_top_n(
+                number=args_.number,
+                column=args_.column,
+                db_table=db_table,
+                granularity=args_.granularity,
+                by=args_.by,
+                start=args_.start,
+                end=args_.end,
+                last=args_.last,
+            )
+    except ValueError as e:
+        # e.g. an unknown --column
+        raise SystemExit(f"error: {e}")
+    if volume_df.empty:
+        # The Date column alone if no table was read
+        columns = common.dataframe.df_rows(volume_df)[0] if len(volume_df.columns) else ["Date"]
+        print_empty_result(args_, db_table, columns)
+        return
+    if args_.format == "table":
+        common.dataframe.pretty_print_df(
+            volume_df,
+            date_format=date_format,
+            decimals={name: 2 for name in common.analytics.SPIKE_COLUMNS.values()},
+        )
+    elif args_.format == "arrow":
+        sys.stdout.flush()
+        common.dataframe.write_arrow(volume_df, sys.stdout.buffer)
+    else:
+        common.output.write_rows(*common.dataframe.df_rows(volume_df), args_.format)
 
 
 if __name__ == "__main__":
@@ -58,7 +235,7 @@ if __name__ == "__main__":
         "--database",
         metavar="filepath",
         type=str,
-        help="Specify an alternate database file to use",
+        help="Specify an alternate database file (or Parquet directory) to use",
     )
     parser.add_argument(
         "-n",
@@ -66,14 +243,105 @@ if __name__ == "__main__":
         metavar="N",
         type=int,
         default=10,
-        help="Number of top volume days to return",
+        help="Number of top volume days to return (per group with --by)",
+    )
+    parser.add_argument(
+        "-c",
+        "--column",
+        metavar="NAME",
+        type=str,
+        default="OCC Total",
+        help="Volume column to rank days by (default: OCC Total)",
     )
     parser.add_argument(
+        "-d",
+        "--dataset",
+        type=str,
+        default="contracts",
+        choices=["contracts", "futures"],
+        help="Volume table to rank days from (default: contracts)",
+    )
+    parser.add_argument(
+        "-g",
+        "--granularity",
+        type=str,
+        default="day",
+        choices=list(DATE_FORMATS),
+        help="Rank days, or months or years by their total volume (default: day)",
+    )
+    parser.add_argument(
+        "-b",
+        "--by",
+        type=str,
+        choices=list(common.schema.GROUP_BY_SQL),
+        help="Return the top N of each year, month or weekday instead of overall",
+    )
+    parser.add_argument(
+        "-s",
+        "--spike",
+        type=str,
+        choices=list(common.schema.SPIKE_METRICS),
+        help="Rank days by z-score or ratio to the trailing average, or percentile within the year",
+    )
+    parser.add_argument(
+        "-w",
+        "--window",
+        metavar="N",
+        type=int,
+        default=common.schema.DEFAULT_WINDOW,
+        help="Trailing trading days for --spike zscore|ratio (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--start",
+        metavar="YYYY-MM-DD",
+        type=date.fromisoformat,
+        help="Only rank days on or after this date",
+    )
+    parser.add_argument(
+        "--end",
+        metavar="YYYY-MM-DD",
+        type=date.fromisoformat,
+        help="Only rank days on or before this date",
+    )
+    parser.add_argument(
+        "--last",
+        metavar="N",
+        type=int,
+        help="Only rank the latest N trading days (or months or years with --granularity)",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        default="table",
+        choices=common.output.OUTPUT_FORMATS,
+        help="Print a table, or write CSV, JSON, NDJSON or an Arrow IPC stream (default: table)",
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="[HOST:]PORT",
+        type=str,
+        nargs="?",
+        const=f"{SERVE_ADDRESS[0]}:{SERVE_ADDRESS[1]}",
+        help=f"Keep the history in memory and answer JSON queries over HTTP (default: {SERVE_ADDRESS[0]}:{SERVE_ADDRESS[1]})",
+    )
+    update_group = parser.add_mutually_exclusive_group()
+    update_group.add_argument(
         "-u",
         "--update",
         action="store_true",
         help="Update local database before analysis",
     )
+    update_group.add_argument(
+        "--plan",
+        action="store_true",
+        help="Show which months an update would fetch, then exit",
+    )
+    update_group.add_argument(
+        "--offline",
+        action="store_true",
+        help="Rewrite the cached months in the local database from the raw response cache without network access",
+    )
     parser.add_argument(
         "-l",
         "--log-level",
@@ -84,6 +352,23 @@ if __name__ == "__main__":
         help="Set the logging level (DEBUG, INFO, WARNING, ERROR, CRITICAL)",
     )
     args = parser.parse_args()
-    common.logging.setup_logging(os.path.splitext(os.path.basename(__file__))[0], args.log_level)
+    if args.by == "weekday" and args.granularity != "day":
+        parser.error("--by weekday requires --granularity day")
+    if args.spike and args.granularity != "day":
+        parser.error("--spike requires --granularity day")
+    if args.window < 2:
+        parser.error("--window must be at least 2")
+    if args.last is not None and args.last < 1:
+        parser.error("--last must be at least 1")
+    if args.serve is not None:
+        host, _, port = args.serve.rpartition(":")
+        if not port.isdigit():
+            parser.error(f"--serve expects [HOST:]PORT, not {args.serve}")
+        args.serve = (host or SERVE_ADDRESS[0], int(port))
+    common.logging.setup_logging(
+        os.path.splitext(os.path.basename(__file__))[0],
+        args.log_level,
+        console_stream="stdout" if args.format == "table" else "stderr",
+    )
     logger = logging.getLogger(os.path.splitext(os.path.basename(__file__))[0])
     main(args)